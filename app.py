@@ -1,8 +1,13 @@
+import json
 import os
+import time
 import click
 from dotenv import load_dotenv
+from backend.ocr_cache import get_ocr_cache
 from backend.ocr_processing import process_uploads
-from backend.vector_store import create_vector_store
+from backend.vector_store import create_vector_store, record_sources, INDEX_TYPES
+from backend.manifest import Manifest
+from backend.llm import LLMError
 from backend.query_gemini import GeminiQuery
 
 @click.group()
@@ -12,30 +17,98 @@ def cli():
 @cli.command()
 @click.option("--uploads", default="uploads", help="Uploads folder path")
 @click.option("--text", default="text", help="Text output folder path")
-def process(uploads, text):
-    """Process PDFs from uploads folder"""
-    processed = process_uploads(uploads, text)
-    click.echo(f"Processed {len(processed)} files")
+@click.option("--rag", default="rag", help="RAG storage folder path (holds the ingestion manifest)")
+@click.option("--workers", default=None, type=int, help="OCR worker processes (default: one per CPU core)")
+@click.option("--full", is_flag=True, help="Re-OCR every PDF, even unchanged ones")
+def process(uploads, text, rag, workers, full):
+    """Process new or modified PDFs from uploads folder"""
+    start = time.perf_counter()
+    manifest = Manifest.for_index(rag)
+    before = dict(manifest.sources)
+    if full:
+        manifest.sources = {}
+    cache = get_ocr_cache()
+    processed = process_uploads(uploads, text, workers=workers, manifest=manifest, cache=cache)
+    # The API may have published generations while OCR ran; apply our changes to the latest one
+    record_sources(rag, before, manifest.sources)
+    click.echo(f"Processed {len(processed)} files in {time.perf_counter() - start:.1f}s")
+    if cache is not None:
+        stats = cache.stats()
+        click.echo(f"OCR cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%} hit rate), "
+                   f"{stats['pages']} pages / {stats['bytes'] / (1024 * 1024):.1f} MiB stored")
 
 @cli.command()
 @click.option("--text", default="text", help="Text folder path")
 @click.option("--rag", default="rag", help="RAG storage folder path")
-def vectorize(text, rag):
-    """Create vector store from text files"""
-    create_vector_store(text, rag)
-    click.echo("Vector store created successfully")
+@click.option("--full", is_flag=True, help="Rebuild the index from scratch")
+@click.option("--index-type", type=click.Choice(INDEX_TYPES), default=None,
+              help="FAISS index type (default: $INDEX_TYPE, else the existing index's type, else flat)")
+def vectorize(text, rag, full, index_type):
+    """Create or update vector store from text files"""
+    create_vector_store(text, rag, full=full, index_type=index_type)
+    click.echo("Vector store updated successfully")
 
 @cli.command()
 @click.argument("question")
 @click.option("--rag", default="rag", help="RAG storage folder path")
-def ask(question, rag):
+@click.option("--nprobe", default=None, type=int, help="IVF lists to probe")
+@click.option("--ef-search", default=None, type=int, help="HNSW search depth")
+@click.option("--patient", default=None, help="Only search this patient's records")
+@click.option("--source", default=None, help="Only search this source document")
+def ask(question, rag, nprobe, ef_search, patient, source):
     if not os.path.exists(rag):
         raise click.ClickException("Vector store not found. Run vectorize first.")
     
     qa = GeminiQuery(rag)
-    response = qa.query(question)
+    try:
+        response = qa.query(question, nprobe=nprobe, ef_search=ef_search,
+                            filters={"patient_id": patient, "source": source})
+    except LLMError as e:
+        raise click.ClickException(str(e))
     click.echo("\nResponse:")
     click.echo(response)
 
+@cli.command("ask-batch")
+@click.argument("questions", type=click.File("r"))
+@click.option("--output", "-o", type=click.File("w"), default="-", help="JSONL answers (default: stdout)")
+@click.option("--rag", default="rag", help="RAG storage folder path")
+@click.option("--concurrency", default=None, type=int, help="LLM calls in flight at once (default: $BATCH_CONCURRENCY, else 8)")
+@click.option("--rate", default=None, type=float, help="LLM calls per second (default: $BATCH_RATE, else unlimited)")
+@click.option("--nprobe", default=None, type=int, help="IVF lists to probe")
+@click.option("--ef-search", default=None, type=int, help="HNSW search depth")
+def ask_batch(questions, output, rag, concurrency, rate, nprobe, ef_search):
+    """Answer every question in a JSONL file of {"question", "patient_id"?, "source"?, ...}.
+
+    Each answer is written as the input line plus an "answer" field, in input order;
+    questions the LLM failed on get "answer": null and an "error" instead.
+    """
+    if not os.path.exists(rag):
+        raise click.ClickException("Vector store not found. Run vectorize first.")
+
+    items = [json.loads(line) for line in questions if line.strip()]
+    qa = GeminiQuery(rag)
+    start = time.perf_counter()
+    answers = qa.query_batch(
+        [item["question"] for item in items],
+        concurrency=concurrency,
+        rate=rate,
+        nprobe=nprobe,
+        ef_search=ef_search,
+        filters=[{"patient_id": item.get("patient_id"), "source": item.get("source")} for item in items],
+        return_exceptions=True,
+    )
+    elapsed = time.perf_counter() - start
+
+    failed = 0
+    for item, answer in zip(items, answers):
+        if isinstance(answer, Exception):
+            failed += 1
+            item = {**item, "answer": None, "error": str(answer)}
+        else:
+            item = {**item, "answer": answer}
+        output.write(json.dumps(item) + "\n")
+    click.echo(f"Answered {len(items) - failed} of {len(items)} questions in {elapsed:.1f}s "
+               f"({len(items) / elapsed:.1f} questions/s)", err=True)
+
 if __name__ == "__main__":
     cli()
\ No newline at end of file
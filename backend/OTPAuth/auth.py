@@ -1,12 +1,36 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
+import os
 import secrets
-import redis
+import redis.asyncio as redis
 from datetime import datetime
 import json
+from note_store import NoteStore
 
-app = FastAPI()
+# Hooking up to Redis 'cause we ain't got time for slow storage
+# One explicit pool shared by every request; connections are reused, never opened per call
+redis_pool = redis.ConnectionPool(
+    host=os.getenv("REDIS_HOST", "localhost"),
+    port=int(os.getenv("REDIS_PORT", "6379")),
+    db=0,
+    decode_responses=True,
+    max_connections=int(os.getenv("REDIS_MAX_CONNECTIONS", "64")),
+)
+redis_client = redis.Redis(connection_pool=redis_pool)
+
+@asynccontextmanager
+async def lifespan(app):
+    # Opened here rather than at import, so importing the module touches no files or threads
+    app.state.note_store = NoteStore(os.getenv("NOTES_DB", "./notes/notes.db"))
+    yield
+    await redis_client.aclose()
+    await redis_pool.aclose()
+    app.state.note_store.close()
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS setup so the frontend doesn’t    freak out
 app.add_middleware(
@@ -17,8 +41,59 @@ app.add_middleware(
     allow_headers=["*"],  # No gatekeeping on headers
 )
 
-# Hooking up to Redis 'cause we ain't got time for slow storage
-redis_client = redis.Redis(host="localhost", port=6379, db=0, decode_responses=True)
+OTP_TTL = 30  # seconds
+SESSION_TTL = 3600  # seconds
+
+# session:{user_id} holds the session; doctor_sessions:{doctor_id} is the set of user_ids
+# a doctor has sessions with, so lookups by doctor never scan every session.
+# Multi-step updates run as Lua scripts: one round trip each, and atomic. The scripts
+# derive session keys from stored values, which is fine on a single Redis (not Cluster).
+def doctor_sessions_key(doctor_id):
+    return f"doctor_sessions:{doctor_id}"
+
+# KEYS[1] otp key; ARGV doctor_id, session json, ttl. Returns the user_id, or nil for a bad OTP
+CREATE_SESSION = redis_client.register_script("""
+local user_id = redis.call('GET', KEYS[1])
+if not user_id then return false end
+local session_key = 'session:' .. user_id
+local previous = redis.call('GET', session_key)
+if previous then
+    -- A new OTP replaces the patient's earlier session, possibly with another doctor
+    redis.call('SREM', 'doctor_sessions:' .. cjson.decode(previous)['doctor_id'], user_id)
+end
+redis.call('SET', session_key, ARGV[2], 'EX', ARGV[3])
+local index_key = 'doctor_sessions:' .. ARGV[1]
+redis.call('SADD', index_key, user_id)
+-- The index lives as long as the doctor's newest session
+redis.call('EXPIRE', index_key, ARGV[3])
+return user_id
+""")
+
+# KEYS[1] session key; ARGV[1] user_id. Deletes the session, its index entry and its OTP
+END_SESSION = redis_client.register_script("""
+local session = redis.call('GET', KEYS[1])
+if not session then return 0 end
+local data = cjson.decode(session)
+redis.call('DEL', KEYS[1])
+redis.call('SREM', 'doctor_sessions:' .. data['doctor_id'], ARGV[1])
+if data['otp_key'] then redis.call('DEL', data['otp_key']) end
+return 1
+""")
+
+# KEYS[1] doctor index; ARGV[1] doctor_id. Returns how many of its sessions are alive,
+# pruning members whose session expired or now belongs to another doctor
+LIVE_SESSIONS = redis_client.register_script("""
+local alive = 0
+for _, user_id in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    local session = redis.call('GET', 'session:' .. user_id)
+    if session and cjson.decode(session)['doctor_id'] == ARGV[1] then
+        alive = alive + 1
+    else
+        redis.call('SREM', KEYS[1], user_id)
+    end
+end
+return alive
+""")
 
 class OTPRequest(BaseModel):
     user_id: str
@@ -37,7 +112,7 @@ async def generate_otp(request: OTPRequest):
     try:
         otp = secrets.token_hex(3)  # 6-char OTP
         otp_key = f"otp:{otp}"
-        redis_client.setex(otp_key, 30, request.user_id)  # OTP expires in 30 seconds
+        await redis_client.setex(otp_key, OTP_TTL, request.user_id)
         return {"message": "OTP generated, don't waste time", "otp": otp}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -45,19 +120,21 @@ async def generate_otp(request: OTPRequest):
 @app.post("/api/verify-otp")
 async def verify_otp(request: OTPVerify):
     try:
-        user_id = redis_client.get(f"otp:{request.otp}")
-        print(user_id)
-        
-        if not user_id:
-            raise HTTPException(status_code=400, detail="OTP’s either dead or fake")
-
         # Store session data with the OTP key for easy invalidation
         session_data = {
             "doctor_id": request.doctor_id,
             "start_time": datetime.now().isoformat(),
             "otp_key": f"otp:{request.otp}"  # Store the OTP key in session data
         }
-        redis_client.setex(f"session:{user_id}", 3600, json.dumps(session_data))  # Session expires in 1 hour
+        user_id = await CREATE_SESSION(
+            keys=[f"otp:{request.otp}"],
+            args=[request.doctor_id, json.dumps(session_data), SESSION_TTL],
+            client=redis_client,
+        )
+        print(user_id)
+
+        if not user_id:
+            raise HTTPException(status_code=400, detail="OTP’s either dead or fake")
 
         return {
             "message": "OTP verified, connection established",
@@ -74,45 +151,51 @@ async def verify_otp(request: OTPVerify):
 @app.post("/api/end-session")
 async def end_session(request: OTPRequest):
     try:
-        session_key = f"session:{request.user_id}"
-        session_data = redis_client.get(session_key)
+        ended = await END_SESSION(
+            keys=[f"session:{request.user_id}"],
+            args=[request.user_id],
+            client=redis_client,
+        )
         
-        if not session_data:
+        if not ended:
             raise HTTPException(status_code=400, detail="No session to end, move along")
         
-        # Parse session data to get the OTP key
-        session = json.loads(session_data)
-        otp_key = session.get("otp_key")
-        
-        # Delete the session
-        redis_client.delete(session_key)
-        
-        # Delete the OTP if it exists
-        if otp_key:
-            redis_client.delete(otp_key)
-        
         return {"message": "Session ended, see ya"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+async def require_session(user_id, doctor_id):
+    """Raise 403 unless doctor_id has a live session with patient user_id."""
+    session_data = await redis_client.get(f"session:{user_id}")
+    
+    if not session_data:
+        raise HTTPException(status_code=403, detail="No session found, try harder")
+    
+    session = json.loads(session_data)
+    if session["doctor_id"] != doctor_id:
+        raise HTTPException(status_code=403, detail="Not your session, buddy")
+
 @app.post("/api/save-notes")
 async def save_notes(note: NoteCreate):
     try:
-        session_data = redis_client.get(f"session:{note.user_id}")
-        
-        if not session_data:
-            raise HTTPException(status_code=403, detail="No session found, try harder")
-        
-        session = json.loads(session_data)
-        if session["doctor_id"] != note.doctor_id:
-            raise HTTPException(status_code=403, detail="Not your session, buddy")
-
-        # Saving notes, old-school style
-        filename = f"notes_{note.user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-        with open(f"./notes/{filename}", "w") as f:
-            f.write(note.content)
+        await require_session(note.user_id, note.doctor_id)
+
+        # Group-committed by the note store's writer thread; the event loop only awaits it
+        note_id = await app.state.note_store.aadd(note.user_id, note.doctor_id, note.content)
         
-        return {"message": "Notes saved, don’t lose ‘em", "filename": filename}
+        return {"message": "Notes saved, don’t lose ‘em", "note_id": note_id}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/notes")
+async def get_notes(user_id: str, doctor_id: str, limit: int = 100):
+    # Only the doctor in a live session with the patient may read the patient's notes
+    try:
+        await require_session(user_id, doctor_id)
+        notes = await run_in_threadpool(app.state.note_store.notes, user_id, None, limit)
+        return {"notes": notes}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -120,14 +203,8 @@ async def save_notes(note: NoteCreate):
 async def check_session(doctor_id: str):
     try:
         # Check if any session exists for the doctor
-        session_keys = redis_client.keys("session:*")
-        for key in session_keys:
-            session_data = redis_client.get(key)
-            if session_data:
-                session = json.loads(session_data)
-                if session["doctor_id"] == doctor_id:
-                    return {"session_exists": True}
-        return {"session_exists": False}
+        alive = await LIVE_SESSIONS(keys=[doctor_sessions_key(doctor_id)], args=[doctor_id], client=redis_client)
+        return {"session_exists": alive > 0}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -0,0 +1,122 @@
+import asyncio
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+from datetime import datetime
+
+class NoteStore:
+    """Append-only doctor notes in SQLite (WAL), written by one thread with group commit.
+
+    add() hands the note to the writer thread and returns once its transaction has
+    committed. Notes that arrive while a commit is in flight are written together in
+    the next transaction, so a burst of saves costs one fsync instead of one each.
+    Reads use their own connections and never wait for the writer.
+    """
+
+    def __init__(self, path, max_batch=512):
+        self.path = path
+        self.max_batch = max_batch
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        db = self._connect()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS notes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                doctor_id TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS notes_by_user ON notes (user_id, id);
+            CREATE INDEX IF NOT EXISTS notes_by_doctor ON notes (doctor_id, id);
+        """)
+        db.close()
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="note-writer", daemon=True)
+        self._thread.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        # Notes are medical records: every commit is fsynced, batching keeps that affordable
+        db.execute("PRAGMA synchronous=FULL")
+        return db
+
+    def add(self, user_id, doctor_id, content):
+        """Queue a note; the returned Future resolves to its id once committed."""
+        future = Future()
+        self._queue.put(((user_id, doctor_id, content, datetime.now().isoformat()), future))
+        return future
+
+    async def aadd(self, user_id, doctor_id, content):
+        return await asyncio.wrap_future(self.add(user_id, doctor_id, content))
+
+    def notes(self, user_id=None, doctor_id=None, limit=100):
+        """Newest notes first, filtered by patient and/or doctor."""
+        clauses, params = [], []
+        if user_id is not None:
+            clauses.append("user_id = ?")
+            params.append(user_id)
+        if doctor_id is not None:
+            clauses.append("doctor_id = ?")
+            params.append(doctor_id)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+        db = self._connect()
+        try:
+            rows = db.execute(
+                f"SELECT id, user_id, doctor_id, content, created_at FROM notes {where} ORDER BY id DESC LIMIT ?",
+                params + [limit],
+            ).fetchall()
+        finally:
+            db.close()
+        keys = ("id", "user_id", "doctor_id", "content", "created_at")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        db = self._connect()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                db.close()
+                return
+
+            # Everything that queued up during the previous commit goes into this one
+            batch = [item]
+            stop = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            try:
+                with db:
+                    ids = [
+                        db.execute(
+                            "INSERT INTO notes (user_id, doctor_id, content, created_at) VALUES (?, ?, ?, ?)",
+                            row,
+                        ).lastrowid
+                        for row, _ in batch
+                    ]
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for note_id, (_, future) in zip(ids, batch):
+                    future.set_result(note_id)
+
+            if stop:
+                db.close()
+                return
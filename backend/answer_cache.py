@@ -0,0 +1,91 @@
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+class AnswerCache:
+    """LRU cache of LLM answers keyed by (question embedding, retrieved chunk ids, index version).
+
+    A lookup hits when an entry built from the same chunks of the same index version
+    has a question embedding with cosine similarity >= threshold and is younger than
+    ttl seconds, so paraphrases of a question answered from the same context share
+    one Gemini call.
+    """
+
+    def __init__(self, threshold=0.95, ttl=3600, max_size=1024):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # entry id -> (context key, unit vector, answer, created)
+        self._by_context = {}          # context key -> set of entry ids
+        self._next_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, question_vector, chunk_ids, version):
+        context = (version, tuple(chunk_ids))
+        query = self._unit(question_vector)
+        now = time.monotonic()
+
+        with self._lock:
+            best_id, best_score = None, self.threshold
+            for entry_id in list(self._by_context.get(context, ())):
+                _, vector, _, created = self._entries[entry_id]
+                if now - created > self.ttl:
+                    self._remove(entry_id)
+                    continue
+                score = float(np.dot(query, vector))
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+
+            if best_id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best_id)
+            return self._entries[best_id][2]
+
+    def put(self, question_vector, chunk_ids, version, answer):
+        if self.max_size <= 0:
+            return
+        context = (version, tuple(chunk_ids))
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (context, self._unit(question_vector), answer, time.monotonic())
+            self._by_context.setdefault(context, set()).add(entry_id)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, entry_id):
+        context = self._entries.pop(entry_id)[0]
+        ids = self._by_context[context]
+        ids.discard(entry_id)
+        if not ids:
+            del self._by_context[context]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_context.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+            }
@@ -0,0 +1,160 @@
+import json
+import os
+import re
+from collections import Counter
+import numpy as np
+
+# Stored next to index.faiss in each index generation; row i is chunk i there too
+VOCAB_FILE = "bm25.vocab.json"
+OFFSETS_FILE = "bm25.offsets.npy"
+ROWS_FILE = "bm25.rows.npy"
+TFS_FILE = "bm25.tfs.npy"
+LENGTHS_FILE = "bm25.lengths.npy"
+
+# Keeps codes and doses such as "e11.9", "hba1c", "co-amoxiclav" or "5mg/kg" as single terms
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.\-/][a-z0-9]+)*")
+
+K1 = 1.2
+B = 0.75
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+def write_bm25(texts, folder):
+    """Write an inverted index over texts (in row order) to folder.
+
+    Postings are stored CSR-style: for term t, rows[offsets[t]:offsets[t + 1]] are
+    the chunks containing it and tfs[...] how often. All arrays are memory-mapped
+    at query time, so only the postings of the query's terms are ever read.
+    """
+    vocab = {}
+    term_parts, tf_parts = [], []
+    lengths = np.zeros(len(texts), dtype=np.uint32)
+    for row, text in enumerate(texts):
+        terms = tokenize(text)
+        lengths[row] = len(terms)
+        counts = Counter(terms)
+        term_parts.append(np.fromiter((vocab.setdefault(term, len(vocab)) for term in counts),
+                                      dtype=np.int64, count=len(counts)))
+        tf_parts.append(np.fromiter(counts.values(), dtype=np.int64, count=len(counts)))
+
+    term_ids = np.concatenate(term_parts) if term_parts else np.zeros(0, dtype=np.int64)
+    tfs = np.concatenate(tf_parts) if tf_parts else np.zeros(0, dtype=np.int64)
+    rows = np.repeat(np.arange(len(texts), dtype=np.int64), [len(part) for part in term_parts])
+
+    # Group by term; the stable sort keeps rows ascending within each term
+    order = np.argsort(term_ids, kind="stable")
+    offsets = np.zeros(len(vocab) + 1, dtype=np.uint64)
+    np.cumsum(np.bincount(term_ids, minlength=len(vocab)), out=offsets[1:])
+
+    with open(os.path.join(folder, VOCAB_FILE), "w", encoding="utf-8") as f:
+        json.dump(list(vocab), f)
+    np.save(os.path.join(folder, OFFSETS_FILE), offsets)
+    np.save(os.path.join(folder, ROWS_FILE), rows[order].astype(np.uint32))
+    np.save(os.path.join(folder, TFS_FILE), np.minimum(tfs[order], np.iinfo(np.uint16).max).astype(np.uint16))
+    # Written last: BM25Index.open looks for it
+    np.save(os.path.join(folder, LENGTHS_FILE), lengths)
+
+class BM25Index:
+    """Okapi BM25 over the chunks of one index folder."""
+
+    def __init__(self, folder):
+        with open(os.path.join(folder, VOCAB_FILE), "r", encoding="utf-8") as f:
+            self.vocab = {term: term_id for term_id, term in enumerate(json.load(f))}
+        self.offsets = np.load(os.path.join(folder, OFFSETS_FILE), mmap_mode="r")
+        self.rows = np.load(os.path.join(folder, ROWS_FILE), mmap_mode="r")
+        self.tfs = np.load(os.path.join(folder, TFS_FILE), mmap_mode="r")
+        self.lengths = np.load(os.path.join(folder, LENGTHS_FILE), mmap_mode="r")
+        self.total_length = float(self.lengths.sum())
+
+    @classmethod
+    def open(cls, folder):
+        """The BM25 index in folder, or None for indexes written before it existed."""
+        if not os.path.exists(os.path.join(folder, LENGTHS_FILE)):
+            return None
+        return cls(folder)
+
+    def postings(self, term):
+        """Rows containing term and its frequency in each, or None if no chunk does."""
+        term_id = self.vocab.get(term)
+        if term_id is None:
+            return None
+        start, stop = int(self.offsets[term_id]), int(self.offsets[term_id + 1])
+        return np.asarray(self.rows[start:stop], dtype=np.int64), np.asarray(self.tfs[start:stop], dtype=np.float32)
+
+    def search(self, query, k=20, allowed=None):
+        """Rows of the k best-scoring chunks for query, best first.
+
+        allowed (sorted rows) restricts the search to those chunks.
+        """
+        return SegmentedBM25([(0, self)]).search(query, k, allowed)
+
+class SegmentedBM25:
+    """BM25 over the segments of an index (see backend/index_store.py).
+
+    segments is [(first row, BM25Index)]; rows are numbered across them, and idf
+    and the average length are computed over all of them. deleted rows are never
+    returned.
+    """
+
+    def __init__(self, segments, deleted=None):
+        self.segments = segments
+        self.deleted = deleted if deleted is not None and len(deleted) else None
+        self.count = sum(len(index.lengths) for _, index in segments)
+        total_length = sum(index.total_length for _, index in segments)
+        self.avg_length = total_length / self.count if self.count else 0.0
+
+    def search(self, query, k=20, allowed=None):
+        """Rows of the k best-scoring chunks for query, best first.
+
+        allowed (sorted rows) restricts the search to those chunks.
+        """
+        count = self.count
+        row_parts, score_parts = [], []
+        for term in set(tokenize(query)):
+            found = [(start, index, index.postings(term)) for start, index in self.segments]
+            found = [(start, index, postings) for start, index, postings in found if postings is not None]
+            if not found:
+                continue
+            # idf stays corpus-wide so scores do not depend on the filter
+            df = sum(len(rows) for _, _, (rows, _) in found)
+            idf = np.log(1 + (count - df + 0.5) / (df + 0.5))
+            for start, index, (rows, tfs) in found:
+                keep = np.ones(len(rows), dtype=bool)
+                if allowed is not None:
+                    keep &= np.isin(rows + start, allowed, assume_unique=True)
+                if self.deleted is not None:
+                    keep &= ~np.isin(rows + start, self.deleted, assume_unique=True)
+                rows, tfs = rows[keep], tfs[keep]
+                norm = K1 * (1 - B + B * index.lengths[rows] / self.avg_length)
+                row_parts.append(rows + start)
+                score_parts.append(idf * tfs * (K1 + 1) / (tfs + norm))
+
+        if not row_parts:
+            return []
+        postings = sum(len(rows) for rows in row_parts)
+        if postings * 8 > count:
+            # Common terms touch much of the corpus: a dense accumulator beats sorting the postings
+            rows = np.arange(count)
+            scores = np.zeros(count, dtype=np.float32)
+            for part_rows, part_scores in zip(row_parts, score_parts):
+                scores[part_rows] += part_scores  # rows are unique within one term
+        else:
+            rows, inverse = np.unique(np.concatenate(row_parts), return_inverse=True)
+            scores = np.bincount(inverse, weights=np.concatenate(score_parts))
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[scores[top] > 0]
+        return rows[top[np.argsort(-scores[top], kind="stable")]].tolist()
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Merge ranked lists of rows: each contributes 1 / (k + rank).
+
+    Returns (row, score) pairs, best first.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking):
+            scores[row] = scores.get(row, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
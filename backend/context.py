@@ -0,0 +1,144 @@
+import os
+from functools import lru_cache
+import numpy as np
+from langchain_core.documents import Document
+
+RERANKERS = ("none", "mmr", "cross-encoder")
+CROSS_ENCODER_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+# Adjacent chunks share up to chunk_overlap (200) characters; shorter matches are coincidence
+MIN_OVERLAP = 40
+MAX_OVERLAP = 400
+
+def count_tokens(text):
+    # Gemini's tokenizer averages about four characters per token on English text
+    return len(text) // 4 + 1
+
+def _shingles(text, size=5):
+    words = text.lower().split()
+    return {" ".join(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+def _overlap(previous, text):
+    """Length of the longest prefix of text that ends previous, if long enough to be splitter overlap."""
+    window = previous[-MAX_OVERLAP:]
+    probe = text[:MIN_OVERLAP]
+    # Any overlap starts where the first MIN_OVERLAP characters of text occur in previous's tail
+    start = window.find(probe)
+    while start != -1:
+        if text.startswith(window[start:]):
+            return len(window) - start
+        start = window.find(probe, start + 1)
+    return 0
+
+def dedupe(docs, threshold=0.8):
+    """Drop chunks whose word shingles are mostly (threshold) contained in a higher-ranked chunk."""
+    kept, kept_shingles = [], []
+    for doc in docs:
+        shingles = _shingles(doc.page_content)
+        if any(len(shingles & other) >= threshold * min(len(shingles), len(other)) for other in kept_shingles):
+            continue
+        kept.append(doc)
+        kept_shingles.append(shingles)
+    return kept
+
+def mmr(query_vector, docs, vectors, k, lambda_mult=0.5, relevance=None):
+    """Maximal marginal relevance: relevant to the query, but unlike what was already picked.
+
+    relevance defaults to cosine similarity with query_vector; callers that ranked
+    docs another way (e.g. hybrid search) can pass their own scores in [0, 1].
+    """
+    if not docs:
+        return []
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+    if relevance is None:
+        query = np.asarray(query_vector, dtype=np.float32)
+        relevance = vectors @ (query / (np.linalg.norm(query) + 1e-12))
+    relevance = np.asarray(relevance, dtype=np.float32)
+
+    selected = [int(np.argmax(relevance))]
+    while len(selected) < min(k, len(docs)):
+        redundancy = (vectors @ vectors[selected].T).max(axis=1)
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[selected] = -np.inf
+        selected.append(int(np.argmax(scores)))
+    return [docs[i] for i in selected]
+
+@lru_cache(maxsize=None)
+def _cross_encoder(model_name):
+    # Optional dependency, only loaded when cross-encoder re-ranking is switched on
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(model_name)
+
+def cross_encoder_rerank(question, docs, model_name=CROSS_ENCODER_MODEL):
+    if not docs:
+        return []
+    scores = _cross_encoder(model_name).predict([(question, doc.page_content) for doc in docs])
+    return [docs[i] for i in np.argsort(-np.asarray(scores), kind="stable")]
+
+def pack(docs, token_budget, max_chunks=None):
+    """Take chunks in rank order while they fit in token_budget (and max_chunks).
+
+    Text a chunk shares with either end of a chunk already packed, as left by the
+    splitter's chunk_overlap, is cut so the prompt does not carry it twice.
+    """
+    packed, used = [], 0
+    for doc in docs:
+        if max_chunks is not None and len(packed) >= max_chunks:
+            break
+        text = doc.page_content
+        head = max((_overlap(other.page_content, text) for other in packed), default=0)
+        text = text[head:]
+        tail = max((_overlap(text, other.page_content) for other in packed), default=0)
+        text = text[:len(text) - tail].strip()
+        if not text:
+            continue
+        tokens = count_tokens(text)
+        if used + tokens > token_budget:
+            continue  # a shorter, lower-ranked chunk may still fit
+        packed.append(Document(id=doc.id, page_content=text, metadata=doc.metadata))
+        used += tokens
+    return packed
+
+class ContextBuilder:
+    """Turns a wide candidate set from the index into the context sent to the LLM.
+
+    Candidates are de-duplicated, optionally re-ranked (MMR against the question
+    embedding, or a local cross-encoder), then packed up to a token budget.
+    """
+
+    def __init__(self, embeddings, candidates=20, token_budget=1000, max_chunks=None, rerank="mmr",
+                 lambda_mult=0.5):
+        if rerank not in RERANKERS:
+            raise ValueError(f"Unknown reranker {rerank!r}, expected one of {RERANKERS}")
+        self.embeddings = embeddings
+        self.candidates = candidates
+        self.token_budget = token_budget
+        self.max_chunks = max_chunks
+        self.rerank = rerank
+        self.lambda_mult = lambda_mult
+
+    @classmethod
+    def from_env(cls, embeddings):
+        return cls(
+            embeddings,
+            candidates=int(os.getenv("CONTEXT_CANDIDATES", "20")),
+            token_budget=int(os.getenv("CONTEXT_TOKENS", "1000")),
+            rerank=os.getenv("CONTEXT_RERANK", "mmr"),
+        )
+
+    def build(self, question, question_vector, docs, max_chunks=None, relevance=None):
+        """Select and pack docs; relevance optionally gives each doc's retrieval score for MMR."""
+        max_chunks = max_chunks or self.max_chunks
+        kept = dedupe(docs)
+        if relevance is not None:
+            kept_ids = {id(doc) for doc in kept}
+            relevance = [score for doc, score in zip(docs, relevance) if id(doc) in kept_ids]
+        docs = kept
+        if self.rerank == "mmr":
+            # Chunk vectors come straight from the embedding cache
+            vectors = self.embeddings.embed_documents([doc.page_content for doc in docs])
+            docs = mmr(question_vector, docs, vectors, len(docs), self.lambda_mult, relevance)
+        elif self.rerank == "cross-encoder":
+            docs = cross_encoder_rerank(question, docs)
+        return pack(docs, self.token_budget, max_chunks)
@@ -0,0 +1,105 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from functools import lru_cache
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_community.embeddings import HuggingFaceEmbeddings
+
+MODEL_NAME = "all-MiniLM-L6-v2"
+
+class CachedEmbeddings(Embeddings):
+    """Sentence-transformers embeddings with batching control and an on-disk cache.
+
+    Vectors are cached in SQLite keyed by a hash of the model settings and the text,
+    so a chunk or question that was embedded once is never embedded again.
+    backend is "torch", "onnx" or "openvino"; onnx_file picks a specific (e.g.
+    quantized) ONNX export such as "onnx/model_qint8_avx512_vnni.onnx".
+    """
+
+    def __init__(self, model_name=MODEL_NAME, batch_size=64, threads=None,
+                 backend="torch", onnx_file=None, cache_dir=".embedding_cache"):
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+
+        model_kwargs = {}
+        if backend != "torch":
+            model_kwargs["backend"] = backend
+        if onnx_file:
+            model_kwargs["model_kwargs"] = {"file_name": onnx_file}
+
+        self.model = HuggingFaceEmbeddings(
+            model_name=model_name,
+            model_kwargs=model_kwargs,
+            encode_kwargs={"batch_size": batch_size},
+        )
+        self._key_prefix = f"{model_name}|{backend}|{onnx_file or ''}|".encode("utf-8")
+
+        self._db = None
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._db = sqlite3.connect(os.path.join(cache_dir, "embeddings.db"), check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+
+    def _key(self, text):
+        return hashlib.sha256(self._key_prefix + text.encode("utf-8")).hexdigest()
+
+    def _cache_get(self, keys):
+        found = {}
+        if self._db is None:
+            return found
+        unique = list(set(keys))
+        with self._lock:
+            for start in range(0, len(unique), 500):
+                batch = unique[start:start + 500]
+                rows = self._db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def _cache_put(self, items):
+        if self._db is None:
+            return
+        rows = [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items]
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", rows)
+            self._db.commit()
+
+    def embed_documents(self, texts):
+        keys = [self._key(text) for text in texts]
+        vectors = self._cache_get(keys)
+
+        # Embed each distinct uncached text once, in model-sized batches
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        if missing:
+            computed = self.model.embed_documents(list(missing.values()))
+            new_items = list(zip(missing.keys(), computed))
+            self._cache_put(new_items)
+            vectors.update(new_items)
+
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+@lru_cache(maxsize=None)
+def get_embeddings():
+    """The process-wide embedding service, configured from the environment."""
+    return CachedEmbeddings(
+        model_name=os.getenv("EMBED_MODEL", MODEL_NAME),
+        batch_size=int(os.getenv("EMBED_BATCH_SIZE", "64")),
+        threads=int(os.getenv("EMBED_THREADS", "0")) or None,
+        backend=os.getenv("EMBED_BACKEND", "torch"),
+        onnx_file=os.getenv("EMBED_ONNX_FILE") or None,
+        cache_dir=os.getenv("EMBED_CACHE_DIR", ".embedding_cache"),
+    )
@@ -0,0 +1,89 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from backend.vector_store import add_text_files
+
+class IndexManager:
+    """Single writer for one rag folder.
+
+    Every index change in the API process goes through one writer thread. Additions
+    that arrive together (within batch_window seconds of each other) are applied as
+    one batch: a single appended segment and published generation. Other operations,
+    such as a full /kb sync, run exclusively via submit().
+    """
+
+    def __init__(self, rag_folder, batch_window=0.05, max_batch=256):
+        self.rag_folder = rag_folder
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="index-writer", daemon=True)
+        self._thread.start()
+
+    def add_text_file(self, text_path, source_path=None):
+        """Queue a text file for indexing; the returned Future resolves once it is live."""
+        future = Future()
+        self._queue.put(("add", (text_path, source_path), future))
+        return future
+
+    def submit(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) on the writer thread, after everything queued before it."""
+        future = Future()
+        self._queue.put(("call", (fn, args, kwargs), future))
+        return future
+
+    def shutdown(self):
+        self._queue.put(("stop", None, None))
+        self._thread.join()
+
+    def _run(self):
+        held = None
+        while True:
+            kind, payload, future = held or self._queue.get()
+            held = None
+
+            if kind == "stop":
+                return
+            if kind == "call":
+                fn, args, kwargs = payload
+                self._resolve([future], lambda: fn(*args, **kwargs))
+                continue
+
+            batch = [(payload, future)]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item[0] != "add":
+                    held = item
+                    break
+                batch.append((item[1], item[2]))
+
+            self._add_batch(batch)
+
+    def _add_batch(self, batch):
+        files = [payload for payload, _ in batch]
+        futures = [future for _, future in batch]
+        if self._resolve(futures, lambda: add_text_files(files, self.rag_folder)) or len(batch) == 1:
+            return
+
+        # Retry one by one so a single unreadable file doesn't fail its neighbours
+        for payload, future in batch:
+            self._resolve([future], lambda: add_text_files([payload], self.rag_folder))
+
+    @staticmethod
+    def _resolve(futures, fn):
+        try:
+            result = fn()
+        except Exception as e:
+            if len(futures) == 1:
+                futures[0].set_exception(e)
+            else:
+                print(f"Batched index update of {len(futures)} files failed: {str(e)}")
+            return False
+        for future in futures:
+            future.set_result(result)
+        return True
@@ -0,0 +1,435 @@
+import bisect
+import json
+import mmap
+import os
+import re
+import shutil
+import tempfile
+from collections.abc import Mapping
+from contextlib import contextmanager
+import faiss
+import numpy as np
+try:
+    import fcntl
+except ImportError:  # Windows: single-process use only
+    fcntl = None
+from langchain_community.docstore.base import Docstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from backend.bm25 import BM25Index, SegmentedBM25, write_bm25
+
+# A rag folder holds immutable index generations and a pointer to the live one:
+#   CURRENT             name of the current generation directory, swapped atomically
+#   gen-000042/         one generation, laid out as below
+#   LOCK                held by whoever is writing a new generation
+# Each index segment contains:
+#   index.faiss         FAISS index, row i is the vector of chunk i
+#   chunks.jsonl        one {"id", "text", "metadata"} record per chunk, in row order
+#   chunks.offsets.npy  uint64 byte offsets of each record (n + 1 entries), written last
+#   bm25.*              lexical inverted index over the same rows (see backend/bm25.py)
+#   filters.<field>.*   rows per value of the metadata fields queries can filter on (CSR, like bm25)
+# A generation is a base segment at its top level, plus:
+#   delta-000007/       segments appended since the base was written, in row order
+#   segments.json       names of those delta segments
+#   deleted.npy         sorted rows, counted across segments, whose chunks were replaced
+# Appending links every file of the previous generation into the new one and writes
+# only the new segment. Rows are numbered across segments, base first.
+# Rag folders from before generations existed hold a single index at the top level.
+CURRENT_FILE = "CURRENT"
+LOCK_FILE = "LOCK"
+INDEX_FILE = "index.faiss"
+CHUNKS_FILE = "chunks.jsonl"
+OFFSETS_FILE = "chunks.offsets.npy"
+FILTER_VALUES_FILE = "filters.{}.json"
+FILTER_OFFSETS_FILE = "filters.{}.offsets.npy"
+FILTER_ROWS_FILE = "filters.{}.rows.npy"
+FILTER_FIELDS = ("patient_id", "source")
+SEGMENTS_FILE = "segments.json"
+DELETED_FILE = "deleted.npy"
+DELTA_PATTERN = re.compile(r"^delta-(\d+)$")
+LEGACY_DOCSTORE_FILE = "index.pkl"
+LEGACY_FILES = (INDEX_FILE, CHUNKS_FILE, OFFSETS_FILE, LEGACY_DOCSTORE_FILE, "manifest.json")
+
+# Old generations kept around for readers that still have them mapped
+KEEP_GENERATIONS = 3
+GENERATION_PATTERN = re.compile(r"^gen-(\d+)$")
+
+# Map vectors/codes straight from the page cache so every worker shares one copy
+MMAP_FLAGS = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+
+class ChunkStore(Docstore):
+    """Read-only docstore over chunks.jsonl, addressed by row number through the offsets array."""
+
+    def __init__(self, folder):
+        self._offsets = np.load(os.path.join(folder, OFFSETS_FILE), mmap_mode="r")
+        self._data = b""
+        with open(os.path.join(folder, CHUNKS_FILE), "rb") as f:
+            if os.fstat(f.fileno()).st_size:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def search(self, search):
+        row = int(search)
+        if not 0 <= row < len(self):
+            return f"ID {search} not found."
+        record = json.loads(self._data[self._offsets[row]:self._offsets[row + 1]])
+        return Document(id=record["id"], page_content=record["text"], metadata=record["metadata"])
+
+class _RowIds(Mapping):
+    # index_to_docstore_id for a ChunkStore: FAISS row i is chunk row i
+    def __init__(self, count):
+        self._count = count
+
+    def __getitem__(self, row):
+        if not 0 <= row < self._count:
+            raise KeyError(row)
+        return int(row)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return iter(range(self._count))
+
+class _SegmentedChunks(Docstore):
+    # The docstore of a SegmentedStore: rows are numbered across its segments
+    def __init__(self, segments):
+        self._starts = [start for start, _ in segments]
+        self._stores = [store.docstore for _, store in segments]
+
+    def search(self, search):
+        row = int(search)
+        i = bisect.bisect_right(self._starts, row) - 1
+        if i < 0:
+            return f"ID {search} not found."
+        return self._stores[i].search(row - self._starts[i])
+
+class SegmentedStore:
+    """Read-only view of a generation with delta segments, one FAISS store per segment.
+
+    segments is [(first row, FAISS)]; deleted holds the rows whose chunks were
+    replaced, which searches skip (see vector_store.search_rows_batch). docstore and
+    index_to_docstore_id address rows across all segments, like a single store's.
+    """
+
+    def __init__(self, embeddings, segments, deleted):
+        self.embeddings = embeddings
+        self.segments = segments
+        self.deleted = deleted
+        self.docstore = _SegmentedChunks(segments)
+        start, last = segments[-1]
+        self.index_to_docstore_id = _RowIds(start + last.index.ntotal)
+
+def current_index_dir(rag_folder):
+    """The index folder readers should load: the current generation, or rag_folder itself for old layouts."""
+    try:
+        with open(os.path.join(rag_folder, CURRENT_FILE), "r", encoding="utf-8") as f:
+            return os.path.join(rag_folder, f.read().strip())
+    except FileNotFoundError:
+        return rag_folder
+
+def index_version(rag_folder):
+    """Return a stamp that changes whenever a new index is published in rag_folder, or None if there is no index."""
+    try:
+        with open(os.path.join(rag_folder, CURRENT_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+
+    # Old single-index layout: the offsets file is replaced last, so it changes only once the index is complete
+    for name in (OFFSETS_FILE, LEGACY_DOCSTORE_FILE):
+        path = os.path.join(rag_folder, name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            return (name, stat.st_mtime_ns, stat.st_size)
+    return None
+
+@contextmanager
+def writer_lock(rag_folder):
+    """Serialise index writers across threads and processes (CLI and API) on one rag folder."""
+    os.makedirs(rag_folder, exist_ok=True)
+    with open(os.path.join(rag_folder, LOCK_FILE), "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def _generations(rag_folder):
+    numbers = []
+    for name in os.listdir(rag_folder):
+        match = GENERATION_PATTERN.match(name)
+        if match and os.path.isdir(os.path.join(rag_folder, name)):
+            numbers.append(int(match.group(1)))
+    return sorted(numbers)
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def publish_generation(rag_folder, write):
+    """Build a new index generation with write(folder) and atomically make it current.
+
+    The generation is written to a temp directory, renamed into place, and only then
+    does CURRENT switch to it. A crash at any point leaves the previous generation
+    live, and readers of older generations keep working until those are pruned.
+    Callers must hold writer_lock.
+    """
+    os.makedirs(rag_folder, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".gen-", dir=rag_folder)
+    try:
+        write(tmp_dir)
+        for folder, dirs, files in os.walk(tmp_dir):
+            for name in dirs + files:
+                _fsync(os.path.join(folder, name))
+
+        existing = _generations(rag_folder)
+        name = f"gen-{(existing[-1] + 1 if existing else 1):06d}"
+        os.rename(tmp_dir, os.path.join(rag_folder, name))
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    first_generation = not os.path.exists(os.path.join(rag_folder, CURRENT_FILE))
+    current_tmp = os.path.join(rag_folder, CURRENT_FILE + ".tmp")
+    with open(current_tmp, "w", encoding="utf-8") as f:
+        f.write(name)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(current_tmp, os.path.join(rag_folder, CURRENT_FILE))
+
+    if first_generation:
+        # The single top-level index has been superseded
+        for legacy_name in LEGACY_FILES:
+            legacy_path = os.path.join(rag_folder, legacy_name)
+            if os.path.exists(legacy_path):
+                os.remove(legacy_path)
+
+    for number in _generations(rag_folder)[:-KEEP_GENERATIONS]:
+        shutil.rmtree(os.path.join(rag_folder, f"gen-{number:06d}"), ignore_errors=True)
+
+    return os.path.join(rag_folder, name)
+
+def save_index(vector_store, folder):
+    """Write vector_store to folder as a single segment in the mmap-friendly layout.
+
+    Each file is written to a temp name and renamed, offsets last, so readers that
+    still have the previous files mapped are unaffected.
+    """
+    os.makedirs(folder, exist_ok=True)
+
+    offsets = [0]
+    texts = []
+    values = {field: [] for field in FILTER_FIELDS}
+    with open(os.path.join(folder, CHUNKS_FILE + ".tmp"), "wb") as f:
+        for row in range(vector_store.index.ntotal):
+            chunk_id = vector_store.index_to_docstore_id[row]
+            doc = vector_store.docstore.search(chunk_id)
+            record = {"id": chunk_id, "text": doc.page_content, "metadata": doc.metadata}
+            f.write(json.dumps(record).encode("utf-8") + b"\n")
+            offsets.append(f.tell())
+            texts.append(doc.page_content)
+            for field in FILTER_FIELDS:
+                values[field].append(doc.metadata.get(field))
+    write_bm25(texts, folder)
+    _write_filters(values, folder)
+    faiss.write_index(vector_store.index, os.path.join(folder, INDEX_FILE + ".tmp"))
+    with open(os.path.join(folder, OFFSETS_FILE + ".tmp"), "wb") as f:
+        np.save(f, np.asarray(offsets, dtype=np.uint64))
+
+    for name in (CHUNKS_FILE, INDEX_FILE, OFFSETS_FILE):
+        os.replace(os.path.join(folder, name + ".tmp"), os.path.join(folder, name))
+
+    # The pickled docstore of the old layout is superseded
+    legacy_path = os.path.join(folder, LEGACY_DOCSTORE_FILE)
+    if os.path.exists(legacy_path):
+        os.remove(legacy_path)
+
+def _write_filters(values, folder):
+    # values: {field: value or None for each row}. Stored like the BM25 postings: for the
+    # v-th value of a field, rows[offsets[v]:offsets[v + 1]] are the rows that have it
+    for field, column in values.items():
+        vocab = {}
+        value_ids = np.fromiter((-1 if value is None else vocab.setdefault(str(value), len(vocab))
+                                 for value in column), dtype=np.int64, count=len(column))
+        rows = np.flatnonzero(value_ids >= 0)
+        # The stable sort keeps rows ascending within each value
+        order = np.argsort(value_ids[rows], kind="stable")
+        offsets = np.zeros(len(vocab) + 1, dtype=np.uint64)
+        np.cumsum(np.bincount(value_ids[rows], minlength=len(vocab)), out=offsets[1:])
+
+        np.save(os.path.join(folder, FILTER_OFFSETS_FILE.format(field)), offsets)
+        np.save(os.path.join(folder, FILTER_ROWS_FILE.format(field)), rows[order].astype(np.uint32))
+        # Written last: load_filters looks for it
+        with open(os.path.join(folder, FILTER_VALUES_FILE.format(field)), "w", encoding="utf-8") as f:
+            json.dump(list(vocab), f)
+
+def index_segments(folder):
+    """The segments of the index in folder as (first row, end row, path), and the sorted deleted rows."""
+    names = []
+    try:
+        with open(os.path.join(folder, SEGMENTS_FILE), "r", encoding="utf-8") as f:
+            names = json.load(f)
+    except FileNotFoundError:
+        pass
+
+    segments = []
+    start = 0
+    for path in [folder] + [os.path.join(folder, name) for name in names]:
+        stop = start + len(np.load(os.path.join(path, OFFSETS_FILE), mmap_mode="r")) - 1
+        segments.append((start, stop, path))
+        start = stop
+
+    deleted = np.zeros(0, dtype=np.int64)
+    if os.path.exists(os.path.join(folder, DELETED_FILE)):
+        deleted = np.load(os.path.join(folder, DELETED_FILE))
+    return segments, deleted
+
+def appendable(folder):
+    """Whether append_segment can extend the index in folder, i.e. it is a generation in the current layout."""
+    return (GENERATION_PATTERN.match(os.path.basename(os.path.normpath(folder))) is not None
+            and os.path.exists(os.path.join(folder, FILTER_VALUES_FILE.format(FILTER_FIELDS[0]))))
+
+def _link(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        # File systems without hard links get a copy
+        shutil.copy2(source, target)
+
+def append_segment(previous, folder, vector_store=None, deleted=()):
+    """Write to folder the index in previous, plus vector_store as a delta segment, minus the deleted rows.
+
+    Generations are immutable, so the files of previous are hard-linked rather than
+    copied: the cost is that of the new chunks, not of the whole index.
+    """
+    os.makedirs(folder, exist_ok=True)
+    segments, previously_deleted = index_segments(previous)
+    names = [os.path.basename(path) for _, _, path in segments[1:]]
+
+    for name in os.listdir(previous):
+        path = os.path.join(previous, name)
+        if os.path.isfile(path) and name not in (SEGMENTS_FILE, DELETED_FILE):
+            _link(path, os.path.join(folder, name))
+    for name in names:
+        os.makedirs(os.path.join(folder, name))
+        for file_name in os.listdir(os.path.join(previous, name)):
+            _link(os.path.join(previous, name, file_name), os.path.join(folder, name, file_name))
+
+    if vector_store is not None and vector_store.index.ntotal:
+        numbers = [int(DELTA_PATTERN.match(name).group(1)) for name in names]
+        name = f"delta-{(max(numbers) + 1 if numbers else 1):06d}"
+        save_index(vector_store, os.path.join(folder, name))
+        names.append(name)
+    if names:
+        with open(os.path.join(folder, SEGMENTS_FILE), "w", encoding="utf-8") as f:
+            json.dump(names, f)
+
+    deleted = np.union1d(previously_deleted, np.asarray(deleted, dtype=np.int64))
+    if len(deleted):
+        np.save(os.path.join(folder, DELETED_FILE), deleted)
+
+def _load_postings(folder):
+    postings = {}
+    for field in FILTER_FIELDS:
+        try:
+            with open(os.path.join(folder, FILTER_VALUES_FILE.format(field)), "r", encoding="utf-8") as f:
+                values = {value: value_id for value_id, value in enumerate(json.load(f))}
+        except FileNotFoundError:
+            continue
+        offsets = np.load(os.path.join(folder, FILTER_OFFSETS_FILE.format(field)), mmap_mode="r")
+        rows = np.load(os.path.join(folder, FILTER_ROWS_FILE.format(field)), mmap_mode="r")
+        postings[field] = (values, offsets, rows)
+    return postings
+
+class FilterIndex:
+    """Rows per metadata value across the segments of an index folder, memory-mapped."""
+
+    def __init__(self, folder):
+        segments, self.deleted = index_segments(folder)
+        self.parts = [(start, _load_postings(path)) for start, _, path in segments]
+
+    def rows(self, field, value):
+        """Sorted rows whose field has value, deleted rows excluded."""
+        found = []
+        for start, postings in self.parts:
+            values, offsets, rows = postings.get(field, ({}, None, None))
+            value_id = values.get(str(value))
+            if value_id is not None:
+                part = rows[int(offsets[value_id]):int(offsets[value_id + 1])]
+                found.append(np.asarray(part, dtype=np.int64) + start)
+        rows = np.concatenate(found) if found else np.zeros(0, dtype=np.int64)
+        if len(self.deleted):
+            rows = rows[~np.isin(rows, self.deleted)]
+        return rows
+
+def load_filters(folder):
+    """The metadata filter index of folder, or None for indexes written before it existed."""
+    if not os.path.exists(os.path.join(folder, FILTER_VALUES_FILE.format(FILTER_FIELDS[0]))):
+        return None
+    return FilterIndex(folder)
+
+def filter_rows(filters_index, filters):
+    """Sorted rows whose metadata matches every field=value in filters, or None when filters is empty."""
+    filters = {field: value for field, value in (filters or {}).items() if value is not None}
+    if not filters:
+        return None
+    rows = None
+    for field, value in filters.items():
+        if field not in FILTER_FIELDS:
+            raise ValueError(f"Cannot filter on {field!r}, expected one of {FILTER_FIELDS}")
+        matched = np.zeros(0, dtype=np.int64) if filters_index is None else filters_index.rows(field, value)
+        rows = matched if rows is None else np.intersect1d(rows, matched)
+    return rows
+
+def load_bm25(folder):
+    """The BM25 index over every segment of folder, or None for indexes written before it existed."""
+    if not os.path.exists(os.path.join(folder, OFFSETS_FILE)):
+        return None
+    segments, deleted = index_segments(folder)
+    parts = [(start, BM25Index.open(path)) for start, _, path in segments]
+    if any(index is None for _, index in parts):
+        return None
+    if len(parts) == 1 and not len(deleted):
+        return parts[0][1]
+    return SegmentedBM25(parts, deleted)
+
+def _load_segment(folder, embeddings):
+    index_path = os.path.join(folder, INDEX_FILE)
+    try:
+        index = faiss.read_index(index_path, MMAP_FLAGS)
+    except RuntimeError:
+        index = faiss.read_index(index_path)
+    return FAISS(embeddings, index, ChunkStore(folder), _RowIds(index.ntotal))
+
+def load_index(folder, embeddings):
+    """Load the index in folder for querying, vectors and chunks memory-mapped read-only.
+
+    Returns a langchain FAISS store, or a SegmentedStore when files have been
+    appended since the generation's base segment was written.
+    """
+    if not os.path.exists(os.path.join(folder, OFFSETS_FILE)):
+        # Indexes written by FAISS.save_local before this layout existed
+        print(f"Loading legacy pickled index from {folder}; run 'vectorize --full' to convert it")
+        return FAISS.load_local(folder, embeddings, allow_dangerous_deserialization=True)
+
+    segments, deleted = index_segments(folder)
+    stores = [(start, _load_segment(path, embeddings)) for start, _, path in segments]
+    if len(stores) == 1 and not len(deleted):
+        return stores[0][1]
+    return SegmentedStore(embeddings, stores, deleted)
+
+def live_rows(vector_store):
+    """The rows a loaded index can return from searches: all of them except deleted ones."""
+    rows = np.arange(len(vector_store.index_to_docstore_id))
+    deleted = getattr(vector_store, "deleted", None)
+    if deleted is None or not len(deleted):
+        return rows
+    return np.setdiff1d(rows, deleted, assume_unique=True)
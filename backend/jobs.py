@@ -0,0 +1,95 @@
+import os
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+class Job:
+    """Status and per-file progress of one background ingestion run."""
+
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = "queued"  # queued -> running -> succeeded | failed
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.files = {}  # filename -> last stage reached ("ocr", "indexed", "removed", "failed")
+        self._lock = threading.Lock()
+
+    def progress(self, filename, stage):
+        with self._lock:
+            self.files[filename] = stage
+
+    def to_dict(self):
+        with self._lock:
+            files = dict(self.files)
+        end = self.finished_at or time.time()
+        elapsed = end - self.started_at if self.started_at else 0.0
+
+        stages = {}
+        for stage in files.values():
+            stages[stage] = stages.get(stage, 0) + 1
+        done = sum(count for stage, count in stages.items() if stage != "failed")
+
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "error": self.error,
+            "elapsed_s": round(elapsed, 3),
+            "stages": stages,
+            "files_per_s": round(done / elapsed, 3) if elapsed else 0.0,
+            "files": files,
+        }
+
+class JobQueue:
+    """In-process queue that runs ingestion jobs on a worker pool.
+
+    Handlers only use submit() and get(), so a queue that hands jobs to a separate
+    worker process can replace this one. executor may be any concurrent.futures
+    executor. Index writes are serialised by IndexManager, so several jobs can OCR
+    at once (the API still runs full /kb syncs one at a time).
+    """
+
+    def __init__(self, max_workers=4, executor=None, history=200):
+        self._executor = executor or ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest")
+        self._jobs = OrderedDict()
+        self._history = history
+        self._lock = threading.Lock()
+
+    def submit(self, kind, fn, *args):
+        """Queue fn(job, *args) and return the Job immediately."""
+        job = Job(kind)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self._history:
+                self._jobs.popitem(last=False)
+        self._executor.submit(self._run, job, fn, args)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job, fn, args):
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            fn(job, *args)
+            job.status = "succeeded"
+        except Exception as e:
+            traceback.print_exc()
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+def default_job_queue():
+    return JobQueue(max_workers=int(os.getenv("INGEST_WORKERS", "4")))
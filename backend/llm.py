@@ -0,0 +1,415 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from functools import lru_cache
+import google.generativeai as genai
+
+class LLMError(Exception):
+    """The LLM could not answer: a rejected or blocked request, or a server error that persisted."""
+
+class LLMUnavailable(LLMError):
+    """The LLM is overloaded, rate-limiting us or too slow right now; worth trying again later."""
+
+def is_retryable(error):
+    """Rate limits (429), server errors (5xx) and dropped connections are worth another attempt."""
+    # google.api_core errors carry their HTTP status as .code, as do FakeLLMError and LLMHTTPError
+    status = getattr(error, "code", None)
+    if isinstance(status, int):
+        return status == 429 or 500 <= status < 600
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+class TokenBucket:
+    """Rate limiter: acquire() returns once a call fits within rate calls per second.
+
+    Up to burst calls (default: one second's worth) may go at once after a quiet spell.
+    Works from threads (acquire_sync) and from any event loop (acquire).
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        # Take a token now, even if that leaves the bucket in debt; the debt is the wait
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    async def acquire(self):
+        await asyncio.sleep(self._reserve())
+
+    def acquire_sync(self):
+        time.sleep(self._reserve())
+
+class GeminiLLM:
+    """Gemini text generation with blocking, async and streaming entry points."""
+
+    def __init__(self, model_name="gemini-pro"):
+        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+        self.model = genai.GenerativeModel(model_name)
+
+    def generate(self, prompt, timeout=None):
+        # ResilientLLM does the retrying; the client's own retry would multiply attempts past our deadline
+        request_options = {"retry": None}
+        if timeout:
+            request_options["timeout"] = timeout
+        return self.model.generate_content(prompt, request_options=request_options).text
+
+    async def agenerate(self, prompt):
+        response = await self.model.generate_content_async(prompt, request_options={"retry": None})
+        return response.text
+
+    async def astream(self, prompt):
+        response = await self.model.generate_content_async(prompt, stream=True, request_options={"retry": None})
+        async for chunk in response:
+            # Safety-blocked or empty chunks carry no parts
+            if chunk.parts:
+                yield chunk.text
+
+class FakeLLMError(Exception):
+    """An injected provider error; code is the HTTP status it pretends to be."""
+
+    def __init__(self, code):
+        super().__init__(f"Fake LLM error {code}")
+        self.code = code
+
+class FakeLLM:
+    """Offline stand-in for Gemini, for tests and local development.
+
+    Answers with a fixed sentence naming the question, after `latency` seconds,
+    and streams it word by word `token_delay` seconds apart. A share error_rate of
+    calls fail with FakeLLMError(error_status), and latency varies by up to
+    `jitter` seconds, to exercise the retry and deadline handling.
+    """
+
+    def __init__(self, latency=0.0, token_delay=0.0, error_rate=0.0, error_status=503, jitter=0.0, seed=None):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.jitter = jitter
+        self.calls = 0
+        self._random = random.Random(seed)
+
+    def _answer(self, prompt):
+        question = prompt.rsplit("Question:", 1)[-1].split("\nAnswer:", 1)[0].strip()
+        return f"Fake answer to: {question}"
+
+    def _call(self):
+        """This call's latency, and whether it fails once that has elapsed."""
+        self.calls += 1
+        latency = self.latency + self._random.uniform(0, self.jitter)
+        fail = self._random.random() < self.error_rate
+        return latency, fail
+
+    def generate(self, prompt, timeout=None):
+        latency, fail = self._call()
+        if timeout is not None and latency > timeout:
+            time.sleep(timeout)
+            raise TimeoutError(f"Fake LLM timed out after {timeout:g}s")
+        time.sleep(latency)
+        if fail:
+            raise FakeLLMError(self.error_status)
+        return self._answer(prompt)
+
+    async def agenerate(self, prompt):
+        latency, fail = self._call()
+        await asyncio.sleep(latency)
+        if fail:
+            raise FakeLLMError(self.error_status)
+        return self._answer(prompt)
+
+    async def astream(self, prompt):
+        latency, fail = self._call()
+        await asyncio.sleep(latency)
+        if fail:
+            raise FakeLLMError(self.error_status)
+        for i, word in enumerate(self._answer(prompt).split(" ")):
+            if i:
+                await asyncio.sleep(self.token_delay)
+            yield word if i == 0 else " " + word
+
+class LLMHTTPError(Exception):
+    """An LLM server answered with an error; code is its HTTP status."""
+
+    def __init__(self, code, message=""):
+        super().__init__(f"LLM server error {code}: {message}" if message else f"LLM server error {code}")
+        self.code = code
+
+class HTTPLLM:
+    """Client for an LLM behind a plain HTTP API, such as the fake server of 'bench llm-server'.
+
+    POST {url}/generate {"prompt"} answers {"text"}; POST {url}/stream answers
+    newline-delimited {"text"} pieces. Error statuses raise LLMHTTPError, and
+    timeouts and dropped connections raise TimeoutError and ConnectionError,
+    so ResilientLLM retries them as it does Gemini's.
+    """
+
+    def __init__(self, url):
+        import httpx
+
+        self.httpx = httpx
+        self.url = url.rstrip("/")
+        # Clients are costly to create, so they are kept: one for blocking calls and one per event loop
+        self._client = httpx.Client(timeout=None)
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _async_client(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                client = self._async_clients[loop] = self.httpx.AsyncClient(timeout=None)
+        return client
+
+    def _check(self, response):
+        if response.status_code >= 400:
+            try:
+                message = response.json().get("error", "")
+            except ValueError:
+                message = response.text
+            raise LLMHTTPError(response.status_code, message)
+
+    def _translate(self, error):
+        if isinstance(error, self.httpx.TimeoutException):
+            return TimeoutError(f"LLM server timed out: {error}")
+        return ConnectionError(f"LLM server unreachable: {error}")
+
+    def generate(self, prompt, timeout=None):
+        try:
+            response = self._client.post(f"{self.url}/generate", json={"prompt": prompt}, timeout=timeout)
+        except self.httpx.TransportError as e:
+            raise self._translate(e) from e
+        self._check(response)
+        return response.json()["text"]
+
+    async def agenerate(self, prompt):
+        # No timeout here: ResilientLLM bounds async calls with its own deadline
+        try:
+            response = await self._async_client().post(f"{self.url}/generate", json={"prompt": prompt})
+        except self.httpx.TransportError as e:
+            raise self._translate(e) from e
+        self._check(response)
+        return response.json()["text"]
+
+    async def astream(self, prompt):
+        try:
+            async with self._async_client().stream("POST", f"{self.url}/stream", json={"prompt": prompt}) as response:
+                if response.status_code >= 400:
+                    await response.aread()
+                    self._check(response)
+                async for line in response.aiter_lines():
+                    if line:
+                        yield json.loads(line)["text"]
+        except self.httpx.TransportError as e:
+            raise self._translate(e) from e
+
+class ResilientLLM:
+    """Wraps an LLM client so load spikes and provider hiccups degrade gracefully.
+
+    - at most `concurrency` calls in flight (per event loop, and again for blocking calls)
+    - at most `rate` calls per second overall (token bucket; None for no limit)
+    - rate limits and server errors are retried `retries` times with jittered exponential backoff
+    - a call, retries included, gives up after `timeout` seconds
+    - a prompt identical to one already in flight waits for that call instead of sending another
+
+    Failures raise LLMUnavailable (overloaded, rate limited, out of time) or LLMError.
+    """
+
+    def __init__(self, llm, concurrency=8, rate=None, retries=3, backoff=0.5, max_backoff=8.0, timeout=30.0):
+        self.llm = llm
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self._bucket = TokenBucket(rate) if rate else None
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._pending = {}  # prompt -> Future of the blocking call in flight
+        self._loops = weakref.WeakKeyDictionary()  # event loop -> (semaphore, {prompt: task})
+        self._lock = threading.Lock()
+        self._counts = {"calls": 0, "coalesced": 0, "retries": 0, "timeouts": 0, "failures": 0}
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def _count(self, key):
+        with self._lock:
+            self._counts[key] += 1
+
+    def _delay(self, attempt):
+        return min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    def _timed_out(self):
+        self._count("timeouts")
+        return self._failure(LLMUnavailable(f"LLM call exceeded its {self.timeout:g}s deadline"))
+
+    def _failure(self, error):
+        self._count("failures")
+        if isinstance(error, LLMError):
+            return error
+        if is_retryable(error):
+            return LLMUnavailable(f"LLM unavailable: {str(error)}")
+        return LLMError(f"LLM request failed: {str(error)}")
+
+    def generate(self, prompt):
+        with self._lock:
+            future = self._pending.get(prompt)
+            owner = future is None
+            if owner:
+                future = self._pending[prompt] = Future()
+            else:
+                self._counts["coalesced"] += 1
+        if not owner:
+            return future.result()
+
+        try:
+            answer = self._generate(prompt)
+        except LLMError as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(answer)
+            return answer
+        finally:
+            with self._lock:
+                del self._pending[prompt]
+
+    def _generate(self, prompt):
+        self._count("calls")
+        deadline = time.monotonic() + self.timeout
+        for attempt in range(self.retries + 1):
+            with self._slots:
+                if self._bucket is not None:
+                    self._bucket.acquire_sync()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self._timed_out()
+                try:
+                    return self.llm.generate(prompt, timeout=remaining)
+                except Exception as e:
+                    if attempt == self.retries or not is_retryable(e):
+                        raise self._failure(e) from e
+            delay = self._delay(attempt)
+            if time.monotonic() + delay >= deadline:
+                raise self._timed_out()
+            self._count("retries")
+            time.sleep(delay)
+
+    def _loop_state(self):
+        # asyncio primitives belong to one loop; API workers and asyncio.run() batches each get their own
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            state = self._loops.get(loop)
+            if state is None:
+                state = self._loops[loop] = (asyncio.Semaphore(self.concurrency), {})
+        return state
+
+    async def agenerate(self, prompt):
+        semaphore, in_flight = self._loop_state()
+        task = in_flight.get(prompt)
+        if task is None:
+            task = asyncio.ensure_future(self._agenerate(prompt, semaphore))
+            in_flight[prompt] = task
+            task.add_done_callback(lambda _: in_flight.pop(prompt, None))
+        else:
+            self._count("coalesced")
+        # One caller going away must not cancel the call the others are waiting on
+        return await asyncio.shield(task)
+
+    async def _agenerate(self, prompt, semaphore):
+        self._count("calls")
+        try:
+            return await asyncio.wait_for(self._attempts(prompt, semaphore), self.timeout)
+        except TimeoutError:
+            raise self._timed_out() from None
+        except Exception as e:
+            raise self._failure(e) from e
+
+    async def _attempts(self, prompt, semaphore):
+        for attempt in range(self.retries + 1):
+            async with semaphore:
+                if self._bucket is not None:
+                    await self._bucket.acquire()
+                try:
+                    return await self.llm.agenerate(prompt)
+                except Exception as e:
+                    if attempt == self.retries or not is_retryable(e):
+                        raise
+            self._count("retries")
+            await asyncio.sleep(self._delay(attempt))
+
+    async def astream(self, prompt):
+        """Stream the answer; retries and the deadline cover the wait for the first piece."""
+        semaphore, _ = self._loop_state()
+        loop = asyncio.get_running_loop()
+        self._count("calls")
+        deadline = loop.time() + self.timeout
+        async with semaphore:
+            for attempt in range(self.retries + 1):
+                if self._bucket is not None:
+                    await self._bucket.acquire()
+                stream = self.llm.astream(prompt)
+                try:
+                    first = await asyncio.wait_for(anext(stream), max(0.0, deadline - loop.time()))
+                    break
+                except StopAsyncIteration:
+                    return
+                except TimeoutError:
+                    await stream.aclose()
+                    raise self._timed_out() from None
+                except Exception as e:
+                    await stream.aclose()
+                    if attempt == self.retries or not is_retryable(e):
+                        raise self._failure(e) from e
+                delay = self._delay(attempt)
+                if loop.time() + delay >= deadline:
+                    raise self._timed_out()
+                self._count("retries")
+                await asyncio.sleep(delay)
+
+            yield first
+            try:
+                async for token in stream:
+                    yield token
+            except Exception as e:
+                raise self._failure(e) from e
+
+@lru_cache(maxsize=None)
+def get_llm():
+    """The process-wide LLM client, behind ResilientLLM.
+
+    LLM_BACKEND=fake swaps in FakeLLM, and LLM_BACKEND=http an HTTPLLM at LLM_URL.
+    """
+    backend = os.getenv("LLM_BACKEND", "gemini")
+    if backend == "fake":
+        llm = FakeLLM(
+            latency=float(os.getenv("FAKE_LLM_LATENCY", "0")),
+            token_delay=float(os.getenv("FAKE_LLM_TOKEN_DELAY", "0")),
+            error_rate=float(os.getenv("FAKE_LLM_ERROR_RATE", "0")),
+            error_status=int(os.getenv("FAKE_LLM_ERROR_STATUS", "503")),
+        )
+    elif backend == "http":
+        llm = HTTPLLM(os.environ["LLM_URL"])
+    else:
+        llm = GeminiLLM(os.getenv("GEMINI_MODEL", "gemini-pro"))
+    return ResilientLLM(
+        llm,
+        concurrency=int(os.getenv("LLM_CONCURRENCY", "8")),
+        rate=float(os.getenv("LLM_RATE", "0")) or None,
+        retries=int(os.getenv("LLM_RETRIES", "3")),
+        timeout=float(os.getenv("LLM_TIMEOUT", "30")),
+    )
@@ -1,17 +1,22 @@
 from fastapi import FastAPI, HTTPException, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional
 import os
+import sys
 from pathlib import Path
 from google.oauth2.credentials import Credentials
 from google.oauth2 import credentials
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from io import BytesIO
 from googleapiclient.errors import HttpError
 import traceback
-import io
+from utils.drive_sync import DriveSync
+
+# OCR and indexing live in the backend package, imported from the repository root
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(REPO_ROOT))
+from backend.pipeline import IngestPipeline
 
 app = FastAPI()
 
@@ -29,79 +34,22 @@ UPLOADS_DIR = DATA_DIR / "uploads"
 
 UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
 
-GOOGLE_MIME_TYPES = {
-    'application/vnd.google-apps.document': ('application/pdf', '.pdf'),
-    'application/vnd.google-apps.spreadsheet': ('application/pdf', '.pdf'),
-    'application/vnd.google-apps.presentation': ('application/pdf', '.pdf'),
-    'application/vnd.google-apps.drawing': ('application/pdf', '.pdf'),
-}
+# Shared with rag_endpt.py, which serves questions from the same index
+TEXT_FOLDER = os.getenv("TEXT_FOLDER", str(REPO_ROOT / "text"))
+RAG_FOLDER = os.getenv("RAG_FOLDER", str(REPO_ROOT / "rag"))
+
+# Concurrent downloads per folder sync, each with its own Drive connection
+DRIVE_WORKERS = int(os.getenv("DRIVE_WORKERS", "8"))
 
 class DriveRequest(BaseModel):
     folder_id: str
     credentials: Optional[dict] = None
-
-def download_regular_file(service, file_id: str, folder_path: str, file_name: str) -> str:
-    try:
-        print(f"Downloading regular file: {file_name} (ID: {file_id})")
-        request = service.files().get_media(fileId=file_id)
-        file_path = os.path.join(folder_path, file_name)
-
-        with io.FileIO(file_path, 'wb') as file:
-            downloader = MediaIoBaseDownload(file, request)
-            done = False
-            while not done:
-                status, done = downloader.next_chunk()
-                print(f"Download progress: {int(status.progress() * 100)}%")
-                
-        print(f"File successfully downloaded to: {file_path}")
-        return file_path
-    except Exception as e:
-        print(f"Error downloading regular file {file_name}: {str(e)}")
-        return None
-
-def download_google_file(service, file_id: str, folder_path: str, file_name: str, mime_type: str) -> str:
-    try:
-        print(f"Downloading Google Workspace file: {file_name} (ID: {file_id})")
-        
-        if mime_type in GOOGLE_MIME_TYPES:
-            export_mime_type, extension = GOOGLE_MIME_TYPES[mime_type]
-            request = service.files().export_media(fileId=file_id, mimeType=export_mime_type)
-            
-            if not file_name.endswith(extension):
-                file_name += extension
-                
-            file_path = os.path.join(folder_path, file_name)
-            
-            with io.FileIO(file_path, 'wb') as file:
-                downloader = MediaIoBaseDownload(file, request)
-                done = False
-                while not done:
-                    status, done = downloader.next_chunk()
-                    print(f"Download progress: {int(status.progress() * 100)}%")
-                    
-            print(f"Google Workspace file successfully downloaded to: {file_path}")
-            return file_path
-        else:
-            print(f"Unsupported Google Workspace file type: {mime_type}")
-            return None
-            
-    except Exception as e:
-        print(f"Error downloading Google Workspace file {file_name}: {str(e)}")
-        return None
-
-def download_file(service, file_id: str, folder_path: str, file_name: str, mime_type: str) -> str:
-    try:
-        file = service.files().get(fileId=file_id, fields='mimeType').execute()
-        file_mime_type = file.get('mimeType', '')
-        
-        if file_mime_type.startswith('application/vnd.google-apps.'):
-            return download_google_file(service, file_id, folder_path, file_name, file_mime_type)
-        else:
-            return download_regular_file(service, file_id, folder_path, file_name)
-            
-    except Exception as e:
-        print(f"Error in file download process for {file_name}: {str(e)}")
-        return None
+    # Download everything again instead of only new or modified files
+    full: bool = False
+    # OCR and index each file as soon as it is downloaded
+    index: bool = False
+    # Patient the indexed files belong to; defaults to the Drive folder's name
+    patient_id: Optional[str] = None
 
 def get_folder_name(service, folder_id: str) -> str:
     print(f"Fetching folder name for ID: {folder_id}")
@@ -112,28 +60,11 @@ def get_folder_name(service, folder_id: str) -> str:
         print(f"Error getting folder name: {str(e)}")
         return f"folder_{folder_id}"
 
-def download_folder_contents(service, folder_id: str, folder_path: str):
-    print(f"Fetching contents of folder ID: {folder_id}")
-    try:
-        query = f"'{folder_id}' in parents"
-        results = service.files().list(
-            q=query,
-            fields="files(id, name, mimeType)",
-            pageSize=1000
-        ).execute()
-        items = results.get('files', [])
-        print(f"Found {len(items)} items in folder.")
-
-        for item in items:
-            print(f"Processing item: {item['name']} (Type: {item['mimeType']})")
-            if item['mimeType'] == 'application/vnd.google-apps.folder':
-                subfolder_path = os.path.join(folder_path, item['name'])
-                os.makedirs(subfolder_path, exist_ok=True)
-                download_folder_contents(service, item['id'], subfolder_path)
-            else:
-                download_file(service, item['id'], folder_path, item['name'], item['mimeType'])
-    except Exception as e:
-        print(f"Error processing folder contents: {str(e)}")
+def sync_and_index(sync, folder_id: str, folder_path: str, full: bool, patient_id: str):
+    with IngestPipeline(TEXT_FOLDER, RAG_FOLDER, patient_id=patient_id) as pipeline:
+        stats = sync.sync(folder_id, folder_path, full, on_file=pipeline.submit,
+                          on_removed=pipeline.remove)
+    return stats, pipeline.stats()
 
 @app.post("/api/drive/download-folder")
 async def download_folder(
@@ -151,7 +82,10 @@ async def download_folder(
             scopes=['https://www.googleapis.com/auth/drive.readonly']
         )
         
-        service = build('drive', 'v3', credentials=creds)
+        def service_factory():
+            return build('drive', 'v3', credentials=creds)
+
+        service = service_factory()
         print("Google Drive service initialized.")
 
         folder_name = get_folder_name(service, request.folder_id)
@@ -159,12 +93,26 @@ async def download_folder(
         folder_path.mkdir(parents=True, exist_ok=True)
         print(f"Created folder path: {folder_path}")
 
-        download_folder_contents(service, request.folder_id, str(folder_path))
+        sync = DriveSync(service_factory, workers=DRIVE_WORKERS)
+        ingest = None
+        if request.index:
+            stats, ingest = await run_in_threadpool(
+                sync_and_index, sync, request.folder_id, str(folder_path), request.full,
+                request.patient_id or folder_name
+            )
+        else:
+            stats = await run_in_threadpool(sync.sync, request.folder_id, str(folder_path), request.full)
         
         return {
             "status": "success",
             "message": "Folder downloaded successfully",
-            "folder_path": str(folder_path)
+            "folder_path": str(folder_path),
+            "files": len(stats["files"]),
+            "unchanged": stats["unchanged"],
+            "removed": stats["removed"],
+            "failed": stats["failed"],
+            "mb_per_s": stats["mb_per_s"],
+            "ingest": ingest
         }
 
     except HttpError as error:
@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+from urllib.parse import quote
+from backend.index_store import current_index_dir
+
+MANIFEST_NAME = "manifest.json"
+
+# Sidecar next to a text file (or an upload) carrying chunk metadata: source, patient_id
+METADATA_SUFFIX = ".meta.json"
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def source_key(path):
+    """How a file is keyed in a manifest: its real path, so same-named files in different folders never clash."""
+    return os.path.realpath(path)
+
+def patient_folder(folder, patient_id):
+    """The subfolder of folder holding patient_id's files, so same-named files of two patients never clash.
+
+    Files without a patient stay in folder itself.
+    """
+    if not patient_id:
+        return folder
+    name = quote(str(patient_id), safe="")
+    if name.startswith("."):
+        name = "%2E" + name[1:]
+    return os.path.join(folder, name)
+
+def read_metadata(path):
+    """Metadata recorded for path in its sidecar, or {} if it has none."""
+    try:
+        with open(path + METADATA_SUFFIX, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def write_metadata(path, metadata):
+    metadata = {key: value for key, value in metadata.items() if value is not None}
+    with open(path + METADATA_SUFFIX, "w", encoding="utf-8") as f:
+        json.dump(metadata, f)
+
+class Manifest:
+    """Records what the index was built from, so rebuilds only touch changed files.
+
+    sources: PDF path (source_key) -> {"hash", "text_path"} for OCR'd PDFs
+    texts:   text file path (source_key) -> {"hash", "chunk_ids", "rows"} for indexed text files, rows being
+             the [start, stop) index rows its chunks occupy,
+             or None when the index was not built incrementally (forces a full rebuild)
+    index_type: the FAISS index type the index was built with
+    """
+
+    def __init__(self, path):
+        self.path = path
+        data = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        self.sources = data.get("sources", {})
+        self.texts = data.get("texts")
+        self.index_type = data.get("index_type")
+
+    @classmethod
+    def for_index(cls, rag_folder):
+        """The manifest of the current index generation in rag_folder."""
+        return cls(os.path.join(current_index_dir(rag_folder), MANIFEST_NAME))
+
+    def update_sources(self, before, after):
+        """Apply the difference between two snapshots of another manifest's sources to this one."""
+        for name in before.keys() - after.keys():
+            self.sources.pop(name, None)
+        for name, entry in after.items():
+            if before.get(name) != entry:
+                self.sources[name] = entry
+
+    def save(self, folder=None):
+        """Save in place, or into folder (a new index generation) when given."""
+        if folder is not None:
+            self.path = os.path.join(folder, MANIFEST_NAME)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"sources": self.sources, "texts": self.texts, "index_type": self.index_type}, f)
+        os.replace(tmp_path, self.path)
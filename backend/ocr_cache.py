@@ -0,0 +1,108 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+@lru_cache(maxsize=None)
+def _connect(path, pid):
+    # One connection per process and cache file, shared by its threads under the lock.
+    # Keyed by pid: SQLite connections must not cross fork(), and the lock may have been
+    # held by another thread at the time, so forked pool workers open their own
+    db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY KEY, text TEXT NOT NULL,
+                                          size INTEGER NOT NULL, used REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS pages_by_use ON pages (used);
+    """)
+    return db, threading.Lock()
+
+class OCRCache:
+    """Content-addressed OCR results on local disk.
+
+    Keys hash the rendered page image together with whatever else shapes
+    Tesseract's output (its version, the language), so a page is OCRed once no
+    matter how often its PDF is re-ingested, while a change of DPI or colour mode
+    renders a different image and misses as it should. Once the stored text passes
+    max_bytes, the least recently used pages are evicted.
+
+    Instances are cheap to pickle and safe to use from the worker processes of a
+    pool; each process opens its own connection on first use. Hit counts are recorded by the caller with record(), since lookups in
+    workers happen on copies.
+    """
+
+    def __init__(self, cache_dir=".ocr_cache", max_bytes=DEFAULT_MAX_BYTES):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "ocr.db")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _connection(self):
+        return _connect(self.path, os.getpid())
+
+    @staticmethod
+    def key(img, *parts):
+        digest = hashlib.sha256("|".join(map(str, (*parts, img.mode, img.size))).encode("utf-8"))
+        digest.update(img.tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        db, lock = self._connection()
+        with lock:
+            row = db.execute("SELECT text FROM pages WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            with db:
+                db.execute("UPDATE pages SET used = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def put(self, key, text):
+        db, lock = self._connection()
+        size = len(text.encode("utf-8"))
+        with lock, db:
+            db.execute("INSERT OR REPLACE INTO pages (key, text, size, used) VALUES (?, ?, ?, ?)",
+                       (key, text, size, time.time()))
+            self._evict(db)
+
+    def _evict(self, db):
+        excess = db.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0] - self.max_bytes
+        if excess <= 0:
+            return
+        stale = []
+        for key, size in db.execute("SELECT key, size FROM pages ORDER BY used"):
+            stale.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        db.executemany("DELETE FROM pages WHERE key = ?", stale)
+
+    def record(self, hits, misses):
+        self.hits += hits
+        self.misses += misses
+
+    def stats(self):
+        db, lock = self._connection()
+        with lock:
+            pages, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "pages": pages,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+        }
+
+@lru_cache(maxsize=None)
+def get_ocr_cache():
+    """The process-wide OCR cache configured from the environment, or None if OCR_CACHE_DIR is empty."""
+    cache_dir = os.getenv("OCR_CACHE_DIR", ".ocr_cache")
+    if not cache_dir:
+        return None
+    return OCRCache(cache_dir, max_bytes=int(os.getenv("OCR_CACHE_MB", "512")) * 1024 * 1024)
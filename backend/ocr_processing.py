@@ -1,45 +1,326 @@
 import os
-import fitz  
+import tempfile
+import fitz
+import numpy as np
 from PIL import Image
 import pytesseract
-import io
-
-def pdf_to_text(pdf_path, output_folder):
-    text = ""
-    doc = fitz.open(pdf_path)
-    
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        page_text = page.get_text()
-        
-        if len(page_text.strip()) < 100:  # OCR 
-            pix = page.get_pixmap()
-            img = Image.open(io.BytesIO(pix.tobytes()))
-            page_text = pytesseract.image_to_string(img)
-            
-        text += page_text + "\n"
-    
-    # Save 
-    base_name = os.path.basename(pdf_path).replace(".pdf", ".txt")
-    output_path = os.path.join(output_folder, base_name)
-    
-    with open(output_path, "w", encoding="utf-8") as f:
-        f.write(text)
-    
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from backend.manifest import METADATA_SUFFIX, file_hash, patient_folder, read_metadata, source_key, write_metadata
+from backend.ocr_cache import get_ocr_cache
+
+# Written after every page so chunks can be attributed to the page they came from
+PAGE_BREAK = "\f"
+
+# Pages are handed to workers in small batches so one big scan spreads over many cores
+PAGES_PER_TASK = 4
+
+@lru_cache(maxsize=8)
+def _open_pdf(pdf_path, mtime_ns):
+    # Worker processes keep recently used documents open between page batches
+    return fitz.open(pdf_path)
+
+class OCRSettings:
+    """When and how a page is OCRed.
+
+    Pages with at least min_text_chars of embedded text are digital unless images
+    cover image_coverage or more of them (a scan with a stamped header, say). Short
+    pages with hardly any image area have nothing to OCR and keep their text as is.
+    The rest are rendered at dpi (in grayscale, which Tesseract prefers anyway) and
+    skipped as blank when fewer than blank_ink of their pixels are dark.
+    """
+
+    def __init__(self, dpi=300, grayscale=True, min_text_chars=100, image_coverage=0.5,
+                 min_image_coverage=0.05, blank_ink=0.002, lang="eng"):
+        self.dpi = dpi
+        self.grayscale = grayscale
+        self.min_text_chars = min_text_chars
+        self.image_coverage = image_coverage
+        self.min_image_coverage = min_image_coverage
+        self.blank_ink = blank_ink
+        self.lang = lang
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            dpi=int(os.getenv("OCR_DPI", "300")),
+            grayscale=os.getenv("OCR_GRAYSCALE", "1") == "1",
+            min_text_chars=int(os.getenv("OCR_MIN_TEXT_CHARS", "100")),
+            image_coverage=float(os.getenv("OCR_IMAGE_COVERAGE", "0.5")),
+            lang=os.getenv("OCR_LANG", "eng"),
+        )
+
+    def __repr__(self):
+        return f"OCRSettings({', '.join(f'{k}={v!r}' for k, v in vars(self).items())})"
+
+def _image_coverage(page):
+    """Fraction of the page area covered by images (overlaps counted once per image)."""
+    area = page.rect.width * page.rect.height
+    if not area:
+        return 0.0
+    covered = 0.0
+    for info in page.get_image_info():
+        box = fitz.Rect(info["bbox"]) & page.rect
+        if not box.is_empty:
+            covered += box.width * box.height
+    return min(covered / area, 1.0)
+
+def _render(page, settings):
+    colorspace = fitz.csGRAY if settings.grayscale else fitz.csRGB
+    pix = page.get_pixmap(dpi=settings.dpi, colorspace=colorspace, alpha=False)
+    # Raw samples straight into PIL; no PNG encode/decode in between
+    mode = "L" if pix.n == 1 else "RGB"
+    return Image.frombytes(mode, (pix.width, pix.height), pix.samples, "raw", mode, pix.stride)
+
+def _is_blank(img, settings):
+    pixels = np.asarray(img.convert("L"))
+    return np.count_nonzero(pixels < 128) < settings.blank_ink * pixels.size
+
+@lru_cache(maxsize=1)
+def _tesseract_version():
+    return str(pytesseract.get_tesseract_version())
+
+def _ocr(img, settings, cache):
+    """OCR text for img and whether it came from the cache (None without one)."""
+    if cache is None:
+        return pytesseract.image_to_string(img, lang=settings.lang), None
+    key = cache.key(img, _tesseract_version(), settings.lang)
+    text = cache.get(key)
+    if text is not None:
+        return text, True
+    text = pytesseract.image_to_string(img, lang=settings.lang)
+    cache.put(key, text)
+    return text, False
+
+def _page_text(page, settings, cache=None):
+    """The page's text, and for OCRed pages whether OCR was a cache hit (None if not OCRed)."""
+    page_text = page.get_text()
+    chars = len(page_text.strip())
+    coverage = _image_coverage(page)
+
+    if chars >= settings.min_text_chars and coverage < settings.image_coverage:
+        return page_text, None  # digital page
+    if coverage < settings.min_image_coverage:
+        return page_text, None  # blank or short digital page: no image to read
+
+    img = _render(page, settings)
+    if _is_blank(img, settings):
+        return page_text, None
+    ocr_text, hit = _ocr(img, settings, cache)
+    # A scan with a usable text layer keeps it if OCR found less
+    return (ocr_text if len(ocr_text.strip()) >= chars else page_text), hit
+
+def _extract_pages(pdf_path, start, stop, settings, cache):
+    doc = _open_pdf(pdf_path, os.stat(pdf_path).st_mtime_ns)
+    return [_page_text(doc.load_page(page_num), settings, cache) for page_num in range(start, stop)]
+
+def _serial_batches(pdf_path, settings, cache):
+    with fitz.open(pdf_path) as doc:
+        for page_num in range(len(doc)):
+            yield [_page_text(doc.load_page(page_num), settings, cache)]
+
+def _submit_pages(pdf_path, executor, settings, cache):
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+
+    return [
+        executor.submit(_extract_pages, pdf_path, start, min(start + PAGES_PER_TASK, page_count), settings, cache)
+        for start in range(0, page_count, PAGES_PER_TASK)
+    ]
+
+def _collect(futures):
+    # Results come back in page order no matter which worker finished first
+    try:
+        for future in futures:
+            yield future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+def _texts(batches, cache):
+    # Workers report cache hits per page; they are tallied here, in the caller's copy of the cache
+    for batch in batches:
+        if cache is not None:
+            cache.record(sum(hit is True for _, hit in batch), sum(hit is False for _, hit in batch))
+        yield [page_text for page_text, _ in batch]
+
+def _write_pages(batches, output_path):
+    # Stream pages to disk as they arrive; the .part file keeps failures from leaving half a text.
+    # Each writer gets its own, so two jobs OCRing the same PDF never interleave; the last replace wins
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    fd, part_path = tempfile.mkstemp(dir=os.path.dirname(output_path) or ".",
+                                     prefix=os.path.basename(output_path) + ".", suffix=".part")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            for batch in batches:
+                for page_text in batch:
+                    # Tesseract ends pages with a form feed of its own
+                    f.write(page_text.replace(PAGE_BREAK, "") + "\n" + PAGE_BREAK)
+        os.replace(part_path, output_path)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+def _text_path(pdf_path, output_folder, patient_id=None, uploads_folder=None):
+    # Text goes in the patient's subfolder; patient_id defaults to one recorded next to the PDF.
+    # Within it, the text mirrors the PDF's path under uploads_folder (or the patient's subfolder
+    # of it), so same-named PDFs in different folders never share a text file
+    if patient_id is None:
+        patient_id = read_metadata(pdf_path).get("patient_id")
+    relative = os.path.basename(pdf_path)
+    if uploads_folder is not None:
+        root = patient_folder(uploads_folder, patient_id)
+        if not source_key(pdf_path).startswith(source_key(root) + os.sep):
+            root = uploads_folder
+        relative = os.path.relpath(pdf_path, root)
+    return os.path.join(patient_folder(output_folder, patient_id), os.path.splitext(relative)[0] + ".txt")
+
+def _write_text(pdf_path, batches, output_path, patient_id=None):
+    _write_pages(batches, output_path)
+    # Sidecar naming the source PDF and patient; patient_id defaults to one recorded next to the PDF
+    metadata = read_metadata(pdf_path)
+    metadata["source"] = os.path.basename(pdf_path)
+    if patient_id is not None:
+        metadata["patient_id"] = patient_id
+    write_metadata(output_path, metadata)
+
+def pdf_to_text(pdf_path, output_folder, executor=None, patient_id=None, settings=None, cache=None,
+                uploads_folder=None):
+    """Write pdf_path's text to output_folder, page by page; returns the text file's path.
+
+    uploads_folder is the folder pdf_path was found in, whose layout the text
+    folder mirrors. cache (an OCRCache) defaults to the one configured by OCR_CACHE_DIR.
+    """
+    settings = settings or OCRSettings.from_env()
+    cache = cache or get_ocr_cache()
+    output_path = _text_path(pdf_path, output_folder, patient_id, uploads_folder)
+    if executor is None:
+        batches = _serial_batches(pdf_path, settings, cache)
+    else:
+        batches = _collect(_submit_pages(pdf_path, executor, settings, cache))
+
+    _write_text(pdf_path, _texts(batches, cache), output_path, patient_id)
     return output_path
 
-def process_uploads(uploads_folder, text_folder):
+def process_uploads(uploads_folder, text_folder, workers=None, manifest=None, progress=None, settings=None,
+                    cache=None):
+    """OCR every PDF in uploads_folder and its patient subfolders, fanning pages out over `workers` processes.
+
+    workers=None uses one process per core; workers=1 runs everything in this process.
+    With a manifest, PDFs whose content is unchanged since the last run are skipped and
+    text files of PDFs that were deleted from uploads_folder are removed.
+    progress(filename, stage) is called as each PDF finishes ("ocr") or fails ("failed").
+    settings (an OCRSettings) defaults to one read from the environment, cache (an
+    OCRCache, whose hit counts this run adds to) to the one configured by OCR_CACHE_DIR.
+    """
+    progress = progress or (lambda filename, stage: None)
+    settings = settings or OCRSettings.from_env()
+    cache = cache or get_ocr_cache()
     if not os.path.exists(text_folder):
         os.makedirs(text_folder)
-    
-    processed_files = []
-    for filename in os.listdir(uploads_folder):
-        if filename.lower().endswith(".pdf"):
-            pdf_path = os.path.join(uploads_folder, filename)
+
+    pdf_paths = [
+        os.path.join(folder, filename)
+        for folder, _, filenames in os.walk(uploads_folder)
+        for filename in filenames
+        if filename.lower().endswith(".pdf")
+    ]
+
+    hashes = None
+    if manifest is not None:
+        hashes = _changed_uploads(pdf_paths, uploads_folder, text_folder, manifest)
+        pdf_paths = list(hashes)
+
+    if workers == 1:
+        converted = _process_serial(pdf_paths, uploads_folder, text_folder, progress, settings, cache)
+    else:
+        converted = _process_parallel(pdf_paths, uploads_folder, text_folder, workers, progress, settings, cache)
+
+    if manifest is not None:
+        moved = []
+        for pdf_path, output_path in converted:
+            previous = manifest.sources.get(source_key(pdf_path), {}).get("text_path")
+            if previous and source_key(previous) != source_key(output_path):
+                moved.append(previous)
+            manifest.sources[source_key(pdf_path)] = {
+                "hash": hashes[pdf_path],
+                "text_path": output_path,
+            }
+        # Texts written where an earlier layout put them; removing them drops their chunks too
+        kept = {source_key(entry["text_path"]) for entry in manifest.sources.values()}
+        for text_path in moved:
+            if source_key(text_path) not in kept:
+                _remove_text(text_path)
+
+    return [output_path for _, output_path in converted]
+
+def _remove_text(text_path):
+    for path in (text_path, text_path + METADATA_SUFFIX):
+        if os.path.exists(path):
+            os.remove(path)
+
+def _changed_uploads(pdf_paths, uploads_folder, text_folder, manifest):
+    """Return {pdf_path: hash} for new, modified or relocated PDFs and forget PDFs gone from uploads_folder.
+
+    Sources recorded from elsewhere (e.g. Google Drive syncs) are left alone.
+    """
+    changed = {}
+    for pdf_path in pdf_paths:
+        digest = file_hash(pdf_path)
+        entry = manifest.sources.get(source_key(pdf_path))
+        if (entry and entry["hash"] == digest and os.path.exists(entry["text_path"])
+                and source_key(entry["text_path"]) == source_key(_text_path(pdf_path, text_folder,
+                                                                            uploads_folder=uploads_folder))):
+            continue
+        changed[pdf_path] = digest
+
+    folder = source_key(uploads_folder) + os.sep
+    present = {source_key(pdf_path) for pdf_path in pdf_paths}
+    for key in list(manifest.sources):
+        if not os.path.isabs(key):
+            # Recorded by file name before sources were keyed by path; its text may be anyone's
+            manifest.sources.pop(key)
+        elif key.startswith(folder) and key not in present:
+            # Removing the text lets the next vectorize drop the document's vectors too
+            _remove_text(manifest.sources.pop(key)["text_path"])
+
+    return changed
+
+def _process_parallel(pdf_paths, uploads_folder, text_folder, workers, progress, settings, cache):
+    converted = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Queue every file's pages up front so the pool stays busy across file boundaries,
+        # then drain them file by file in order
+        pending = []
+        for pdf_path in pdf_paths:
             try:
-                output_path = pdf_to_text(pdf_path, text_folder)
-                processed_files.append(output_path)
+                pending.append((pdf_path, _submit_pages(pdf_path, executor, settings, cache)))
             except Exception as e:
-                print(f"Error processing {filename}: {str(e)}")
-    
-    return processed_files
\ No newline at end of file
+                print(f"Error processing {os.path.basename(pdf_path)}: {str(e)}")
+                progress(os.path.basename(pdf_path), "failed")
+
+        for pdf_path, futures in pending:
+            output_path = _text_path(pdf_path, text_folder, uploads_folder=uploads_folder)
+            try:
+                _write_text(pdf_path, _texts(_collect(futures), cache), output_path)
+                converted.append((pdf_path, output_path))
+                progress(os.path.basename(pdf_path), "ocr")
+            except Exception as e:
+                print(f"Error processing {os.path.basename(pdf_path)}: {str(e)}")
+                progress(os.path.basename(pdf_path), "failed")
+
+    return converted
+
+def _process_serial(pdf_paths, uploads_folder, text_folder, progress, settings, cache):
+    converted = []
+    for pdf_path in pdf_paths:
+        try:
+            output_path = pdf_to_text(pdf_path, text_folder, settings=settings, cache=cache,
+                                      uploads_folder=uploads_folder)
+            converted.append((pdf_path, output_path))
+            progress(os.path.basename(pdf_path), "ocr")
+        except Exception as e:
+            print(f"Error processing {os.path.basename(pdf_path)}: {str(e)}")
+            progress(os.path.basename(pdf_path), "failed")
+
+    return converted
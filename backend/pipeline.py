@@ -0,0 +1,169 @@
+import os
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from backend.embeddings import get_embeddings
+from backend.manifest import patient_folder, write_metadata
+from backend.ocr_processing import pdf_to_text
+from backend.vector_store import add_text_files, remove_files
+
+_DONE = object()
+
+class IngestPipeline:
+    """Turn files into searchable chunks as they arrive.
+
+    Files handed to submit() (typically as each download finishes) flow through two
+    bounded queues: OCR threads turn PDFs into text, fanning pages out over a shared
+    process pool, and a single index thread embeds and publishes whatever text is
+    ready in batches. Download, OCR and embedding therefore overlap, and a full queue
+    makes submit() block, so a fast producer cannot run far ahead of OCR.
+
+        with IngestPipeline(text_folder, rag_folder) as pipeline:
+            sync.sync(folder_id, folder_path, on_file=pipeline.submit, on_removed=pipeline.remove)
+        pipeline.stats()
+    """
+
+    def __init__(self, text_folder, rag_folder, embeddings=None, ocr_threads=2, ocr_processes=None,
+                 queue_size=8, batch_size=16, patient_id=None):
+        self.text_folder = text_folder
+        self.rag_folder = rag_folder
+        # Recorded on every chunk ingested through this pipeline
+        self.patient_id = patient_id
+        self.embeddings = embeddings or get_embeddings()
+        self.batch_size = batch_size
+        os.makedirs(text_folder, exist_ok=True)
+
+        self._ocr_queue = queue.Queue(maxsize=queue_size)
+        self._index_queue = queue.Queue(maxsize=queue_size)
+        self._executor = ProcessPoolExecutor(max_workers=ocr_processes)
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._busy = {"ocr": 0.0, "index": 0.0}
+        self._counts = {"submitted": 0, "ocr": 0, "indexed": 0, "removed": 0}
+        self.failed = []
+
+        self._ocr_threads = [
+            threading.Thread(target=self._ocr_loop, name=f"ingest-ocr-{i}", daemon=True)
+            for i in range(ocr_threads)
+        ]
+        self._index_thread = threading.Thread(target=self._index_loop, name="ingest-index", daemon=True)
+        for thread in self._ocr_threads + [self._index_thread]:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, path):
+        """Queue a downloaded file; blocks while the OCR stage is saturated."""
+        with self._lock:
+            self._counts["submitted"] += 1
+        self._ocr_queue.put(path)
+
+    def remove(self, path):
+        """Drop the chunks of a file submitted by an earlier run, e.g. one deleted from Drive."""
+        if path.lower().endswith(".txt"):
+            # submit() indexed the copy in the text folder, not the download
+            path = os.path.join(patient_folder(self.text_folder, self.patient_id), os.path.basename(path))
+        try:
+            remove_files([path], self.rag_folder, self.embeddings)
+        except Exception as e:
+            self._fail(path, e)
+            return
+        with self._lock:
+            self._counts["removed"] += 1
+
+    def close(self):
+        """Wait until everything submitted has been indexed (or has failed)."""
+        for _ in self._ocr_threads:
+            self._ocr_queue.put(_DONE)
+        for thread in self._ocr_threads:
+            thread.join()
+        self._index_queue.put(_DONE)
+        self._index_thread.join()
+        self._executor.shutdown()
+
+    def stats(self):
+        """Counts and per-stage busy time; wall time near the slowest stage means the stages overlapped."""
+        with self._lock:
+            return {
+                **self._counts,
+                "failed": list(self.failed),
+                "busy_s": {stage: round(seconds, 3) for stage, seconds in self._busy.items()},
+                "seconds": round(time.perf_counter() - self._started, 3),
+            }
+
+    def _record(self, stage, counter, start, count=1):
+        with self._lock:
+            self._busy[stage] += time.perf_counter() - start
+            self._counts[counter] += count
+
+    def _fail(self, path, error):
+        print(f"Error ingesting {os.path.basename(path)}: {str(error)}")
+        with self._lock:
+            self.failed.append(path)
+
+    def _ocr_loop(self):
+        while True:
+            path = self._ocr_queue.get()
+            if path is _DONE:
+                return
+
+            # Any error fails this file only; the thread must live on to take its _DONE in close()
+            try:
+                item = self._to_text(path)
+            except Exception as e:
+                self._fail(path, e)
+                continue
+            if item is not None:
+                self._index_queue.put(item)
+
+    def _to_text(self, path):
+        """The (text_path, source_path) to index for a submitted file, or None if it is skipped."""
+        if path.lower().endswith(".txt"):
+            # Indexed from a copy in the text folder, where create_vector_store (and /kb) will keep it
+            text_folder = patient_folder(self.text_folder, self.patient_id)
+            text_path = os.path.join(text_folder, os.path.basename(path))
+            os.makedirs(text_folder, exist_ok=True)
+            shutil.copyfile(path, text_path)
+            write_metadata(text_path, {"source": os.path.basename(path), "patient_id": self.patient_id})
+            return text_path, None
+        if path.lower().endswith(".pdf"):
+            start = time.perf_counter()
+            text_path = pdf_to_text(path, self.text_folder, self._executor, self.patient_id)
+            self._record("ocr", "ocr", start)
+            return text_path, path
+        print(f"Skipping {os.path.basename(path)}: only PDF and text files are indexed")
+        return None
+
+    def _index_loop(self):
+        done = False
+        while not done:
+            item = self._index_queue.get()
+            if item is _DONE:
+                return
+
+            # Index whatever else is already waiting along with it
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._index_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _DONE:
+                    done = True
+                    break
+                batch.append(item)
+
+            start = time.perf_counter()
+            try:
+                add_text_files(batch, self.rag_folder, self.embeddings)
+            except Exception as e:
+                for text_path, source_path in batch:
+                    self._fail(source_path or text_path, e)
+                continue
+            self._record("index", "indexed", start, len(batch))
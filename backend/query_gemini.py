@@ -1,25 +1,182 @@
+import asyncio
 import os
-import google.generativeai as genai
 from dotenv import load_dotenv
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
+from backend.bm25 import reciprocal_rank_fusion
+from backend.context import ContextBuilder
+from backend.embeddings import get_embeddings
+from backend.index_store import current_index_dir, filter_rows, load_bm25, load_filters, load_index
+from backend.llm import TokenBucket, get_llm
+from backend.vector_store import rows_to_documents, search_rows, search_rows_batch
 
 load_dotenv()
 
 class GeminiQuery:
-    def __init__(self, rag_folder):
-        self.embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-        self.vector_store = FAISS.load_local(rag_folder, self.embeddings, allow_dangerous_deserialization=True)
-        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-        self.model = genai.GenerativeModel('gemini-pro')
-    
-    def query(self, question, k=3):
-        docs = self.vector_store.similarity_search(question, k=k)
+    def __init__(self, rag_folder, embeddings=None, llm=None, answer_cache=None, version=None, context=None):
+        self.embeddings = embeddings or get_embeddings()
+        # Memory-mapped and read-only: API workers share one copy of the index
+        index_dir = current_index_dir(rag_folder)
+        self.vector_store = load_index(index_dir, self.embeddings)
+        # Lexical index over the same rows, for exact drug names, codes and abbreviations
+        self.bm25 = load_bm25(index_dir) if os.getenv("HYBRID_SEARCH", "1") == "1" else None
+        # Rows per patient / source document, for scoped questions
+        self.filters_index = load_filters(index_dir)
+        self.llm = llm or get_llm()
+        # Optional AnswerCache; version identifies this index in its keys
+        self.answer_cache = answer_cache
+        self.version = version
+        # Defaults for approximate indexes; ignored by flat indexes
+        self.nprobe = int(os.getenv("SEARCH_NPROBE", "16"))
+        self.ef_search = int(os.getenv("SEARCH_EF", "64"))
+        # Batch queries: LLM calls in flight at once, and per second (0 = unlimited)
+        self.batch_concurrency = int(os.getenv("BATCH_CONCURRENCY", "8"))
+        self.batch_rate = float(os.getenv("BATCH_RATE", "0"))
+        # Retrieves a wide candidate set and packs the best of it into a token budget
+        self.context = context or ContextBuilder.from_env(self.embeddings)
+
+    def retrieve(self, question, k=None, nprobe=None, ef_search=None, filters=None):
+        """Return the question embedding and the context chunks selected for it.
+
+        k caps the number of chunks; by default the token budget alone decides.
+        filters (e.g. {"patient_id": "p42"}) restricts the search to matching chunks.
+        """
+        question_vector = self.embeddings.embed_query(question)
+        allowed = filter_rows(self.filters_index, filters)
+        count = max(self.context.candidates, k or 0)
+        rows = search_rows(
+            self.vector_store,
+            question_vector,
+            k=count,
+            nprobe=nprobe or self.nprobe,
+            ef_search=ef_search or self.ef_search,
+            rows=allowed
+        )
+        return question_vector, self._select(question, question_vector, rows, allowed, count, k)
+
+    def retrieve_batch(self, questions, k=None, nprobe=None, ef_search=None, filters=None):
+        """retrieve() for many questions: one embedding call, one FAISS search per distinct filter.
+
+        filters is a single dict for every question or a list with one per question.
+        Returns the question vectors and each question's context chunks.
+        """
+        question_vectors = self.embeddings.embed_documents(list(questions))
+        if filters is None or isinstance(filters, dict):
+            filters = [filters] * len(questions)
+        count = max(self.context.candidates, k or 0)
+
+        # Questions scoped the same way share one search over the same allowed rows
+        groups = {}
+        for i, question_filters in enumerate(filters):
+            key = tuple(sorted((field, value) for field, value in (question_filters or {}).items()
+                               if value is not None))
+            groups.setdefault(key, []).append(i)
+
+        docs = [None] * len(questions)
+        for members in groups.values():
+            allowed = filter_rows(self.filters_index, filters[members[0]])
+            found = search_rows_batch(
+                self.vector_store,
+                [question_vectors[i] for i in members],
+                k=count,
+                nprobe=nprobe or self.nprobe,
+                ef_search=ef_search or self.ef_search,
+                rows=allowed
+            )
+            for i, rows in zip(members, found):
+                docs[i] = self._select(questions[i], question_vectors[i], rows, allowed, count, k)
+        return question_vectors, docs
+
+    def _select(self, question, question_vector, rows, allowed, count, k):
+        relevance = None
+        if self.bm25 is not None:
+            lexical = self.bm25.search(question, count, allowed)
+            fused = reciprocal_rank_fusion([rows, lexical])[:count]
+            rows = [row for row, _ in fused]
+            relevance = [score / fused[0][1] for _, score in fused]
+
+        candidates = rows_to_documents(self.vector_store, rows)
+        return self.context.build(question, question_vector, candidates, max_chunks=k, relevance=relevance)
+
+    @staticmethod
+    def build_prompt(question, docs):
         context = "\n\n".join([doc.page_content for doc in docs])
-        prompt = f"Context:\n{context}\n\nQuestion: {question}\nAnswer:"
-        
-        try:
-            response = self.model.generate_content(prompt)
-            return response.text
-        except Exception as e:
-            return f"Error generating response: {str(e)}"
\ No newline at end of file
+        return f"Context:\n{context}\n\nQuestion: {question}\nAnswer:"
+
+    def _cached(self, question_vector, docs):
+        if self.answer_cache is None:
+            return None
+        return self.answer_cache.get(question_vector, [doc.id for doc in docs], self.version)
+
+    def _remember(self, question_vector, docs, answer):
+        if self.answer_cache is not None:
+            self.answer_cache.put(question_vector, [doc.id for doc in docs], self.version, answer)
+
+    def query(self, question, **search_kwargs):
+        question_vector, docs = self.retrieve(question, **search_kwargs)
+        cached = self._cached(question_vector, docs)
+        if cached is not None:
+            return cached
+
+        # LLM failures (LLMError) propagate: an error is never cached or returned as an answer
+        answer = self.llm.generate(self.build_prompt(question, docs))
+        self._remember(question_vector, docs, answer)
+        return answer
+
+    async def aquery(self, question, **search_kwargs):
+        # Embedding and FAISS search are CPU-bound; keep them off the event loop
+        question_vector, docs = await asyncio.to_thread(self.retrieve, question, **search_kwargs)
+        cached = self._cached(question_vector, docs)
+        if cached is not None:
+            return cached
+
+        answer = await self.llm.agenerate(self.build_prompt(question, docs))
+        self._remember(question_vector, docs, answer)
+        return answer
+
+    def query_batch(self, questions, **kwargs):
+        """Answers to many questions, in order; see aquery_batch."""
+        return asyncio.run(self.aquery_batch(questions, **kwargs))
+
+    async def aquery_batch(self, questions, concurrency=None, rate=None, return_exceptions=False, **search_kwargs):
+        """Answers to many questions, in order.
+
+        Retrieval runs batched (see retrieve_batch) off the event loop; LLM calls then
+        run concurrently, at most concurrency at a time and rate per second. As with
+        asyncio.gather, return_exceptions=True puts a failed question's exception in
+        its place instead of raising it.
+        """
+        concurrency = concurrency or self.batch_concurrency
+        rate = rate if rate is not None else self.batch_rate
+        question_vectors, contexts = await asyncio.to_thread(self.retrieve_batch, questions, **search_kwargs)
+        semaphore = asyncio.Semaphore(concurrency)
+        limiter = TokenBucket(rate) if rate else None
+
+        async def answer(question, question_vector, docs):
+            cached = self._cached(question_vector, docs)
+            if cached is not None:
+                return cached
+            async with semaphore:
+                if limiter is not None:
+                    await limiter.acquire()
+                answer = await self.llm.agenerate(self.build_prompt(question, docs))
+            self._remember(question_vector, docs, answer)
+            return answer
+
+        return await asyncio.gather(*(
+            answer(question, question_vector, docs)
+            for question, question_vector, docs in zip(questions, question_vectors, contexts)
+        ), return_exceptions=return_exceptions)
+
+    async def astream(self, question, **search_kwargs):
+        """Yield the answer in pieces as the LLM produces them."""
+        question_vector, docs = await asyncio.to_thread(self.retrieve, question, **search_kwargs)
+        cached = self._cached(question_vector, docs)
+        if cached is not None:
+            yield cached
+            return
+
+        tokens = []
+        async for token in self.llm.astream(self.build_prompt(question, docs)):
+            tokens.append(token)
+            yield token
+
+        self._remember(question_vector, docs, "".join(tokens))
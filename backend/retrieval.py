@@ -0,0 +1,59 @@
+import os
+import threading
+from backend.answer_cache import AnswerCache
+from backend.embeddings import get_embeddings
+from backend.query_gemini import GeminiQuery
+from backend.index_store import index_version
+
+
+class RetrievalService:
+    """Process-wide GeminiQuery shared by every request.
+
+    The embedding model and FAISS index are loaded once and only reloaded
+    when the index on disk changes (checked via `index_version`). The answer
+    cache is shared across reloads and emptied whenever the index changes.
+    """
+
+    def __init__(self, rag_folder):
+        self.rag_folder = rag_folder
+        self.answer_cache = AnswerCache(
+            threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95")),
+            ttl=float(os.getenv("ANSWER_CACHE_TTL", "3600")),
+            max_size=int(os.getenv("ANSWER_CACHE_SIZE", "1024")),
+        )
+        self._lock = threading.Lock()
+        self._qa = None
+        self._version = None
+
+    def get(self):
+        version = index_version(self.rag_folder)
+        if version is None:
+            raise FileNotFoundError("Vector store not found. Create the knowledge base first.")
+
+        qa = self._qa
+        if qa is not None and version == self._version:
+            return qa
+
+        # Only one request reloads; the others keep answering from the old index
+        if not self._lock.acquire(blocking=qa is None):
+            return qa
+        try:
+            if self._qa is None or version != self._version:
+                self._load(version)
+            return self._qa
+        finally:
+            self._lock.release()
+
+    def warm_up(self):
+        get_embeddings()
+        try:
+            self.get()
+        except FileNotFoundError:
+            print(f"No vector store in {self.rag_folder} yet, skipping warm-up")
+
+    def _load(self, version):
+        print(f"Loading vector store from {self.rag_folder}")
+        self._qa = GeminiQuery(self.rag_folder, answer_cache=self.answer_cache, version=version)
+        self._version = version
+        # Entries are keyed by version and can never hit again
+        self.answer_cache.clear()
@@ -1,34 +1,530 @@
+import math
 import os
+import uuid
 import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.embeddings import HuggingFaceEmbeddings
-
-def create_vector_store(text_folder, rag_folder):
-    if not os.path.exists(rag_folder):
-        os.makedirs(rag_folder)
-    
-
-    documents = []
-    for filename in os.listdir(text_folder):
-        if filename.endswith(".txt"):
-            file_path = os.path.join(text_folder, filename)
-            with open(file_path, "r", encoding="utf-8") as f:
-                text = f.read()
-            documents.append(text)
-    
+from langchain_core.documents import Document
+from backend.embeddings import get_embeddings
+from backend.index_store import (
+    append_segment, appendable, current_index_dir, index_segments, index_version, live_rows, load_index,
+    publish_generation, save_index, writer_lock
+)
+from backend.manifest import METADATA_SUFFIX, Manifest, file_hash, read_metadata, source_key
+from backend.ocr_processing import PAGE_BREAK
+
+INDEX_TYPES = ("flat", "ivf", "ivfpq", "hnsw")
+
+# Vectors sampled for IVF / PQ training
+TRAIN_SAMPLE = 100_000
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+
+def build_index(vectors, index_type="flat"):
+    """Return an empty, trained FAISS index of index_type suited to these vectors.
+
+    Corpora too small to train IVF-PQ codebooks, or empty, fall back to a flat index.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    count, dim = vectors.shape
+
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, HNSW_M)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        return index
+
+    # FAISS wants ~39 training points per centroid
+    nlist = max(1, min(int(4 * math.sqrt(count)), count // 39))
+    pq_bits = min(8, int(math.log2(max(count // 39, 1))))
+
+    if index_type == "flat" or not count or (index_type == "ivfpq" and pq_bits < 4):
+        if index_type != "flat":
+            print(f"Only {count} vectors, too few to train {index_type}; using a flat index")
+        return faiss.IndexFlatL2(dim)
+
+    quantizer = faiss.IndexFlatL2(dim)
+    if index_type == "ivf":
+        index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+    else:
+        # Largest sub-quantizer count that splits the vector into chunks of at least 8 dims
+        pq_m = max(m for m in range(1, dim // 8 + 1) if dim % m == 0)
+        index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, pq_bits)
+
+    sample = vectors
+    if count > TRAIN_SAMPLE:
+        sample = vectors[np.random.default_rng(0).choice(count, TRAIN_SAMPLE, replace=False)]
+    index.train(sample)
+    return index
+
+def search_params(index, nprobe=None, ef_search=None, selector=None):
+    """Per-query FAISS search parameters: nprobe for IVF, efSearch for HNSW, and an optional ID selector."""
+    if faiss.try_extract_index_ivf(index) is not None and (nprobe or selector is not None):
+        params = faiss.SearchParametersIVF()
+        params.nprobe = nprobe or faiss.extract_index_ivf(index).nprobe
+    elif isinstance(index, faiss.IndexHNSW) and (ef_search or selector is not None):
+        params = faiss.SearchParametersHNSW()
+        params.efSearch = ef_search or index.hnsw.efSearch
+    elif selector is not None:
+        params = faiss.SearchParameters()
+    else:
+        return None
+
+    if selector is not None:
+        params.sel = selector
+    return params
+
+# Filters that leave at most this many rows of a flat or HNSW segment are searched exactly
+EXACT_SEARCH_ROWS = 4096
+
+def search_rows(vector_store, query_vector, k=3, nprobe=None, ef_search=None, rows=None):
+    """Index rows of the top-k vectors for an embedded query, with optional nprobe / efSearch tuning.
+
+    rows restricts the search to those index rows (e.g. one patient's chunks); FAISS
+    skips every other vector instead of filtering results afterwards. Few rows are
+    searched exactly; otherwise nprobe / efSearch grow with the filter's selectivity,
+    since approximate indexes only check the rows their search happens to visit.
+    """
+    return search_rows_batch(vector_store, [query_vector], k, nprobe, ef_search, rows)[0]
+
+def _segments(vector_store):
+    # load_index returns a SegmentedStore once files have been appended to a generation
+    segments = getattr(vector_store, "segments", None) or [(0, vector_store)]
+    deleted = getattr(vector_store, "deleted", None)
+    return segments, (deleted if deleted is not None else np.zeros(0, dtype=np.int64))
+
+def search_rows_batch(vector_store, query_vectors, k=3, nprobe=None, ef_search=None, rows=None):
+    """search_rows for many embedded queries, one FAISS call per index segment; one row list per query."""
+    if rows is not None:
+        if len(rows) == 0:
+            return [[] for _ in query_vectors]
+        rows = np.asarray(rows, dtype=np.int64)
+    vectors = np.asarray(query_vectors, dtype=np.float32)
+    segments, deleted = _segments(vector_store)
+
+    distance_parts, row_parts = [], []
+    for start, store in segments:
+        index = store.index
+        stop = start + index.ntotal
+        local = None
+        if rows is not None:
+            local = rows[(rows >= start) & (rows < stop)] - start
+            if not len(local):
+                continue
+        if not index.ntotal:
+            continue
+        # Ask for enough extra hits to still have k once replaced chunks are dropped
+        skip = deleted[(deleted >= start) & (deleted < stop)]
+        distances, found = _search_segment(index, vectors, min(k + len(skip), index.ntotal), nprobe, ef_search, local)
+        found = np.where(found == -1, -1, found + start)
+        if len(skip):
+            found[np.isin(found, skip)] = -1
+        distance_parts.append(np.where(found == -1, np.inf, distances))
+        row_parts.append(found)
+
+    if not row_parts:
+        return [[] for _ in query_vectors]
+    distances = np.concatenate(distance_parts, axis=1)
+    found = np.concatenate(row_parts, axis=1)
+    order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+    return [[int(i) for i in hits if i != -1] for hits in np.take_along_axis(found, order, axis=1)]
+
+def _search_segment(index, vectors, k, nprobe, ef_search, rows):
+    # rows: the allowed rows of this index, or None for all of them
+    if rows is None:
+        return index.search(vectors, k, params=search_params(index, nprobe, ef_search))
+
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is None and len(rows) <= EXACT_SEARCH_ROWS:
+        # Few allowed rows: compare the queries with each of them; flat and HNSW indexes keep raw vectors
+        exact = faiss.IndexFlat(index.d, index.metric_type)
+        exact.add(index.reconstruct_batch(rows))
+        distances, found = exact.search(vectors, min(k, len(rows)))
+        return distances, np.where(found == -1, -1, rows[found])
+
+    # A selector only filters the inverted lists or graph nodes a search visits anyway; visit
+    # more of them the more selective the filter, so about as many allowed rows are seen
+    share = len(rows) / index.ntotal
+    if ivf is not None:
+        nprobe = min(ivf.nlist, math.ceil((nprobe or ivf.nprobe) / share))
+    elif isinstance(index, faiss.IndexHNSW):
+        ef_search = min(index.ntotal, math.ceil((ef_search or index.hnsw.efSearch) / share))
+    selector = faiss.IDSelectorBatch(rows)
+    return index.search(vectors, k, params=search_params(index, nprobe, ef_search, selector))
+
+def rows_to_documents(vector_store, rows):
+    return [vector_store.docstore.search(vector_store.index_to_docstore_id[row]) for row in rows]
+
+def similarity_search(vector_store, query_vector, k=3, nprobe=None, ef_search=None):
+    """Top-k documents for an embedded query, with optional nprobe / efSearch tuning."""
+    return rows_to_documents(vector_store, search_rows(vector_store, query_vector, k, nprobe, ef_search))
+
+def _new_vector_store(splits, ids, embeddings, index_type):
+    texts = [doc.page_content for doc in splits]
+    vectors = embeddings.embed_documents(texts)
+    if not vectors:
+        vectors = np.empty((0, len(embeddings.embed_query(""))), dtype=np.float32)
+
+    vector_store = FAISS(embeddings, build_index(vectors, index_type), InMemoryDocstore(), {})
+    if texts:
+        vector_store.add_embeddings(
+            zip(texts, vectors),
+            metadatas=[doc.metadata for doc in splits],
+            ids=ids
+        )
+    return vector_store
+
+# Chunks embedded and added per step when appending files, bounding memory by this, not file size
+ADD_BATCH = 256
+# Appended segments are folded back into one full rewrite once there are this many,
+# or once they and the replaced rows reach this share of the base segment
+MAX_DELTAS = 16
+COMPACT_SHARE = 0.25
+READ_BLOCK = 1024 * 1024
+
+def _iter_pages(text_path):
+    """Yield (page number, text) from a text file without reading it whole.
+
+    OCR output ends every page with PAGE_BREAK; other text files are one page
+    with number None. No piece is much longer than READ_BLOCK: a longer page
+    comes as consecutive pieces with the same number.
+    """
+    with open(text_path, "r", encoding="utf-8") as f:
+        paged = any(PAGE_BREAK in block for block in iter(lambda: f.read(READ_BLOCK), ""))
+        f.seek(0)
+        pending = ""
+        number = 1
+        for block in iter(lambda: f.read(READ_BLOCK), ""):
+            *pages, pending = (pending + block).split(PAGE_BREAK)
+            for page in pages:
+                yield (number if paged else None), page
+                number += 1
+            if len(pending) >= READ_BLOCK:
+                yield (number if paged else None), pending
+                pending = ""
+        if pending:
+            yield (number if paged else None), pending
+
+def _iter_chunks(text_path):
+    # Every chunk records where it came from: source file, patient and (for OCR output) page
+    metadata = {"source": os.path.basename(text_path)}
+    metadata.update(read_metadata(text_path))
+
     # Splitting docs
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=1000,
         chunk_overlap=200
     )
-    splits = text_splitter.create_documents(documents)
-    
-    # Embedding 
-    embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-    
-    # save FAISS index
-    vector_store = FAISS.from_documents(splits, embeddings)
-    vector_store.save_local(rag_folder)
-    
-    return vector_store
\ No newline at end of file
+
+    def documents(number, chunks):
+        page_metadata = metadata if number is None else {**metadata, "page": number}
+        return [Document(page_content=chunk, metadata=dict(page_metadata)) for chunk in chunks]
+
+    page, text = None, ""
+    for number, piece in _iter_pages(text_path):
+        if number != page and text:
+            yield from documents(page, text_splitter.split_text(text))
+            text = ""
+        page = number
+        text += piece
+        chunks = text_splitter.split_text(text)
+        start = text.rfind(chunks[-1]) if len(chunks) > 1 else -1
+        if start > 0:
+            # The last chunk may run on into the page's next piece: split it again with that,
+            # so chunks overlap across pieces as they do within one
+            yield from documents(page, chunks[:-1])
+            text = text[start:]
+    if text:
+        yield from documents(page, text_splitter.split_text(text))
+
+def _split_text_file(text_path):
+    return list(_iter_chunks(text_path))
+
+def create_vector_store(text_folder, rag_folder, embeddings=None, full=False, index_type=None,
+                        progress=None, manifest=None):
+    """Bring the index in rag_folder up to date with the .txt files in text_folder and its subfolders.
+
+    Only new or modified files are split and embedded, and chunks of modified or
+    deleted files are removed. A full rebuild happens when asked for, when the
+    existing index has no manifest describing its contents, or when the index
+    type changes - the embedding cache keeps that rebuild cheap.
+
+    The result is published as a new index generation; readers keep using the
+    previous one until it is complete. Returns the generation's folder.
+
+    index_type is one of INDEX_TYPES; it defaults to $INDEX_TYPE, then to the
+    type the existing index was built with, then to "flat".
+    progress(filename, stage) is called for each file (its path within text_folder) once
+    the new index is saved, with stage "indexed" or "removed".
+    manifest lets a caller pass in source records it updated (e.g. by process_uploads).
+    """
+    # Embedding
+    embeddings = embeddings or get_embeddings()
+
+    with writer_lock(rag_folder):
+        manifest = manifest or Manifest.for_index(rag_folder)
+        return _sync_vector_store(text_folder, rag_folder, embeddings, manifest, full, index_type, progress)
+
+def _sync_vector_store(text_folder, rag_folder, embeddings, manifest, full, index_type, progress):
+    index_type = index_type or os.getenv("INDEX_TYPE") or manifest.index_type or "flat"
+    if index_type != manifest.index_type:
+        full = True
+    manifest.index_type = index_type
+
+    if full or manifest.texts is None or index_version(rag_folder) is None:
+        full = True
+        manifest.texts = {}
+
+    # Keyed by source_key, so one patient's visit.txt is never taken for another's
+    current = {}
+    for folder, _, filenames in os.walk(text_folder):
+        for filename in filenames:
+            if filename.endswith(".txt"):
+                path = source_key(os.path.join(folder, filename))
+                current[path] = file_hash(path)
+
+    stale = [name for name, entry in manifest.texts.items() if current.get(name) != entry["hash"]]
+    changed = [name for name, digest in current.items()
+               if name not in manifest.texts or manifest.texts[name]["hash"] != digest]
+
+    if not full and not stale and not changed:
+        # Source records may still have changed
+        manifest.save()
+        print("Vector store already up to date")
+        return current_index_dir(rag_folder)
+
+    index_dir = _update_index(rag_folder, embeddings, manifest, stale, {path: path for path in changed}, full)
+
+    if progress is not None:
+        root = source_key(text_folder)
+        for path in stale:
+            if path not in current:
+                progress(os.path.relpath(path, root), "removed")
+        for path in changed:
+            progress(os.path.relpath(path, root), "indexed")
+
+    print(f"Indexed {len(changed)} new or modified files, removed {len(stale)} stale files")
+    return index_dir
+
+def add_text_files(files, rag_folder, embeddings=None):
+    """Add text files to the index as one new generation, creating the index if there is none.
+
+    files is a list of (text_path, source_path) pairs. Earlier chunks of the same
+    files are replaced. source_path is the upload the text was extracted from, or
+    None; it is recorded so the next process_uploads run does not OCR it again.
+    Returns the folder of the published generation.
+    """
+    embeddings = embeddings or get_embeddings()
+
+    with writer_lock(rag_folder):
+        manifest = Manifest.for_index(rag_folder)
+        latest = {}
+        for text_path, source_path in files:
+            _record_source(manifest, source_path, text_path)
+            latest[source_key(text_path)] = text_path
+
+        if index_version(rag_folder) is None:
+            # First files into an empty rag folder start a new, fully tracked index
+            manifest.texts = {}
+            manifest.index_type = os.getenv("INDEX_TYPE") or "flat"
+
+        # Indexes built before the manifest existed stay untracked until the next full rebuild
+        tracked = manifest.texts if manifest.texts is not None else {}
+        replaced = [path for path in latest if path in tracked]
+        # Entries keyed by file name before texts were keyed by path
+        replaced += [os.path.basename(path) for path in latest if os.path.basename(path) in tracked]
+        return _update_index(rag_folder, embeddings, manifest, replaced, latest)
+
+def _update_index(rag_folder, embeddings, manifest, stale, files, full=False):
+    """Publish a generation without the chunks of the stale files and with those of files.
+
+    files maps manifest keys (source_key) to text paths. Normally the new chunks become a delta
+    segment and the rest of the current generation is linked, so the cost follows
+    the change rather than the corpus. full discards the current index; it and
+    generations with too many deltas are written out whole.
+    """
+    tracked = manifest.texts if manifest.texts is not None else {}
+    removed = [tracked.pop(name) for name in stale]
+
+    index_dir = current_index_dir(rag_folder)
+    if full or index_version(rag_folder) is None:
+        return _rewrite(rag_folder, embeddings, manifest, files)
+    if _needs_compaction(index_dir, removed):
+        dropped = {chunk_id for entry in removed for chunk_id in entry["chunk_ids"]}
+        return _rewrite(rag_folder, embeddings, manifest, files, _live_chunks(index_dir, embeddings, dropped))
+
+    # Split, embed and add a batch of chunks at a time
+    segments, _ = index_segments(index_dir)
+    delta = None
+    pending = []
+
+    def flush():
+        nonlocal delta
+        if not pending:
+            return
+        docs = [doc for doc, _ in pending]
+        ids = [chunk_id for _, chunk_id in pending]
+        if delta is None:
+            # Deltas stay small between compactions, so an exact flat index suits them
+            delta = _new_vector_store(docs, ids, embeddings, "flat")
+        else:
+            delta.add_documents(docs, ids=ids)
+        pending.clear()
+
+    for chunk in _file_chunks(files, manifest, segments[-1][1]):
+        pending.append(chunk)
+        if len(pending) >= ADD_BATCH:
+            flush()
+    flush()
+
+    deleted = [row for entry in removed for row in range(*entry.get("rows", (0, 0)))]
+
+    def write(folder):
+        append_segment(index_dir, folder, delta, deleted)
+        manifest.save(folder)
+
+    return publish_generation(rag_folder, write)
+
+def _needs_compaction(index_dir, removed):
+    if not appendable(index_dir):
+        return True
+    # Files indexed before rows were recorded can only be removed by chunk id
+    if any(entry["chunk_ids"] and "rows" not in entry for entry in removed):
+        return True
+    segments, deleted = index_segments(index_dir)
+    base = segments[0][1]
+    appended = segments[-1][1] - base
+    # Rows this update replaces count too, so replacing most of the base rewrites it now
+    replacing = sum(stop - start for start, stop in (entry.get("rows", (0, 0)) for entry in removed))
+    return len(segments) > MAX_DELTAS or appended + len(deleted) + replacing > COMPACT_SHARE * base
+
+def _file_chunks(files, manifest, row):
+    """Yield (chunk, chunk id) for each text file, recording the file in the manifest
+    once all its chunks are out, with the rows they take from row on."""
+    for filename, text_path in files.items():
+        start, chunk_ids = row, []
+        for doc in _iter_chunks(text_path):
+            chunk_ids.append(str(uuid.uuid4()))
+            yield doc, chunk_ids[-1]
+            row += 1
+        if manifest.texts is not None:
+            manifest.texts[filename] = {"hash": file_hash(text_path), "chunk_ids": chunk_ids, "rows": [start, row]}
+
+def _live_chunks(index_dir, embeddings, dropped):
+    """Yield (chunk, chunk id) for each chunk of the index in index_dir that is neither deleted nor dropped."""
+    vector_store = load_index(index_dir, embeddings)
+    for row in live_rows(vector_store):
+        docstore_id = vector_store.index_to_docstore_id[int(row)]
+        doc = vector_store.docstore.search(docstore_id)
+        # Legacy pickled indexes key their docstore by chunk id and may not set doc.id
+        chunk_id = doc.id or docstore_id
+        if chunk_id not in dropped:
+            yield doc, chunk_id
+
+def _rewrite(rag_folder, embeddings, manifest, files, carried=()):
+    """Publish everything in carried plus the chunks of files as one new base segment."""
+    tracked = manifest.texts if manifest.texts is not None else {}
+    firsts = {entry["chunk_ids"][0]: entry for entry in tracked.values() if entry["chunk_ids"]}
+    splits, ids = [], []
+    for doc, chunk_id in carried:
+        # Carried files keep their chunks together, at new rows
+        entry = firsts.get(chunk_id)
+        if entry is not None:
+            entry["rows"] = [len(ids), len(ids) + len(entry["chunk_ids"])]
+        splits.append(doc)
+        ids.append(chunk_id)
+    for entry in firsts.values():
+        start, stop = entry.get("rows", (0, 0))
+        if stop > len(ids) or ids[start:stop] != entry["chunk_ids"]:
+            entry.pop("rows", None)
+
+    for doc, chunk_id in _file_chunks(files, manifest, len(ids)):
+        splits.append(doc)
+        ids.append(chunk_id)
+
+    # Indexes saved before the manifest existed record no type
+    manifest.index_type = manifest.index_type or os.getenv("INDEX_TYPE") or "flat"
+    vector_store = _new_vector_store(splits, ids, embeddings, manifest.index_type)
+    return _publish(rag_folder, vector_store, manifest)
+
+def add_text_file(text_path, rag_folder, embeddings=None, source_path=None):
+    """Add one text file to the existing index, replacing its previous chunks if any."""
+    return add_text_files([(text_path, source_path)], rag_folder, embeddings)
+
+def _publish(rag_folder, vector_store, manifest):
+    def write(index_dir):
+        save_index(vector_store, index_dir)
+        manifest.save(index_dir)
+
+    return publish_generation(rag_folder, write)
+
+def record_sources(rag_folder, before, after):
+    """Publish the change between two snapshots of manifest.sources, leaving the index as it is.
+
+    The change is applied to the latest manifest under the writer lock, so callers
+    can OCR without holding it while others publish. Returns the current index folder.
+    """
+    with writer_lock(rag_folder):
+        manifest = Manifest.for_index(rag_folder)
+        manifest.update_sources(before, after)
+        return _publish_manifest(rag_folder, manifest)
+
+def remove_files(paths, rag_folder, embeddings=None):
+    """Remove files from the index as one new generation: the inverse of add_text_files.
+
+    Each path is an indexed text file, or a source (e.g. a PDF) recorded in the
+    manifest, whose text file goes too. The text files and their sidecars are
+    deleted. Paths the index does not know are ignored. Returns the folder of
+    the current generation.
+    """
+    embeddings = embeddings or get_embeddings()
+
+    with writer_lock(rag_folder):
+        manifest = Manifest.for_index(rag_folder)
+        tracked = manifest.texts if manifest.texts is not None else {}
+        removed = []
+        for path in paths:
+            entry = manifest.sources.pop(source_key(path), None)
+            text_path = entry["text_path"] if entry else path
+            if entry or source_key(text_path) in tracked:
+                removed.append(text_path)
+        if not removed:
+            return current_index_dir(rag_folder)
+
+        stale = list(dict.fromkeys(source_key(path) for path in removed if source_key(path) in tracked))
+        if stale:
+            index_dir = _update_index(rag_folder, embeddings, manifest, stale, {})
+        else:
+            # Only sources were recorded; an index built before the manifest keeps their chunks until a full rebuild
+            index_dir = _publish_manifest(rag_folder, manifest)
+
+    for text_path in removed:
+        for path in (text_path, text_path + METADATA_SUFFIX):
+            if os.path.exists(path):
+                os.remove(path)
+    return index_dir
+
+def _publish_manifest(rag_folder, manifest):
+    # A generation whose index files are linked from the current one; callers hold writer_lock
+    index_dir = current_index_dir(rag_folder)
+    if index_dir == rag_folder:
+        # No generation yet: the first one starts from this manifest
+        manifest.save()
+        return index_dir
+
+    def write(folder):
+        append_segment(index_dir, folder)
+        manifest.save(folder)
+
+    return publish_generation(rag_folder, write)
+
+def _record_source(manifest, source_path, text_path):
+    if source_path is not None:
+        manifest.sources[source_key(source_path)] = {
+            "hash": file_hash(source_path),
+            "text_path": text_path,
+        }
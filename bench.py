@@ -0,0 +1,741 @@
+import difflib
+import hashlib
+import io
+import json
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+import click
+import fitz
+import numpy as np
+from backend.ocr_cache import OCRCache
+from backend.ocr_processing import PAGE_BREAK, OCRSettings, pdf_to_text, process_uploads
+from backend.embeddings import CachedEmbeddings, get_embeddings
+from backend.vector_store import _split_text_file, build_index, search_params, create_vector_store, similarity_search
+from backend.context import ContextBuilder, count_tokens
+from backend.bm25 import BM25Index, write_bm25
+from backend.index_manager import IndexManager
+from backend.llm import FakeLLM, HTTPLLM, LLMError, LLMUnavailable, ResilientLLM
+from backend.index_store import current_index_dir, live_rows, load_index
+from backend.manifest import Manifest
+from backend.utils.drive_sync import CHUNK_SIZE, DriveSync
+
+@click.group()
+def bench():
+    """Micro-benchmarks for the ingestion and query paths"""
+
+@bench.command()
+@click.option("--uploads", default="uploads", help="Folder of (ideally scanned) PDFs")
+@click.option("--workers", default="1,2,4,8", help="Comma-separated worker counts to try")
+def ocr(uploads, workers):
+    """OCR throughput in pages/sec for each worker count"""
+    pages = 0
+    for filename in os.listdir(uploads):
+        if filename.lower().endswith(".pdf"):
+            with fitz.open(os.path.join(uploads, filename)) as doc:
+                pages += len(doc)
+
+    baseline = None
+    for count in [int(w) for w in workers.split(",")]:
+        with tempfile.TemporaryDirectory() as text_folder:
+            start = time.perf_counter()
+            process_uploads(uploads, text_folder, workers=count)
+            elapsed = time.perf_counter() - start
+
+        rate = pages / elapsed
+        baseline = baseline or rate
+        click.echo(f"workers={count:<3} {pages} pages in {elapsed:6.2f}s  {rate:7.1f} pages/s  speedup x{rate / baseline:.2f}")
+
+WORDS = ("patient presented with acute chest pain radiating left arm troponin elevated ecg shows "
+         "st depression leads admitted cardiology started aspirin 300mg clopidogrel heparin infusion "
+         "history type diabetes mellitus hypertension hba1c metformin 500mg twice daily review "
+         "follow clinic weeks discharge summary blood pressure heart rate oxygen saturation").split()
+
+def _mixed_corpus(path, pages, seed=0):
+    """Write a PDF mixing digital, scanned, cover and blank pages; returns each page's true text."""
+    rng = random.Random(seed)
+    truth = []
+    with fitz.open() as doc:
+        for number in range(pages):
+            kind = ("digital", "scanned", "scanned", "cover", "blank", "blank-scan")[number % 6]
+            text = "\n".join(" ".join(rng.choice(WORDS) for _ in range(10)) for _ in range(30))
+            if kind == "cover":
+                text = "Discharge summary"
+            elif kind.startswith("blank"):
+                text = ""
+
+            page = doc.new_page()
+            if kind in ("digital", "cover"):
+                page.insert_textbox(page.rect + (50, 50, -50, -50), text, fontsize=10)
+            else:
+                # A scan is a picture of a page: render one at 150 dpi and paste it in
+                with fitz.open() as source:
+                    source_page = source.new_page()
+                    source_page.insert_textbox(source_page.rect + (50, 50, -50, -50), text, fontsize=10)
+                    pix = source_page.get_pixmap(dpi=150, colorspace=fitz.csGRAY)
+                page.insert_image(page.rect, pixmap=pix)
+            truth.append(text)
+        doc.save(path)
+    return truth
+
+def _char_accuracy(truth, pages):
+    """Share of the true characters (whitespace normalised) found, in order, in the extracted text."""
+    found = total = 0
+    for expected, got in zip(truth, pages):
+        expected, got = " ".join(expected.split()), " ".join(got.split())
+        if not expected:
+            continue
+        matcher = difflib.SequenceMatcher(None, expected, got, autojunk=False)
+        found += sum(block.size for block in matcher.get_matching_blocks())
+        total += len(expected)
+    return found / total if total else 1.0
+
+@bench.command("ocr-policy")
+@click.option("--pages", default=60, help="Pages in the synthetic corpus (digital, scanned, cover and blank)")
+@click.option("--dpis", default="150,200,300", help="Comma-separated render resolutions to try")
+def ocr_policy(pages, dpis):
+    """Pages/sec and character accuracy of OCR settings on a mixed digital/scanned corpus"""
+    configs = [
+        # The old behaviour: OCR every short page at PyMuPDF's default 72 dpi, in colour
+        ("legacy", OCRSettings(dpi=72, grayscale=False, image_coverage=2.0, min_image_coverage=0.0,
+                               blank_ink=0.0)),
+    ]
+    configs += [(f"dpi={dpi}", OCRSettings(dpi=int(dpi))) for dpi in dpis.split(",")]
+
+    with tempfile.TemporaryDirectory() as folder:
+        pdf_path = os.path.join(folder, "mixed.pdf")
+        truth = _mixed_corpus(pdf_path, pages)
+        # Each configuration starts from an empty OCR cache; the last one then runs again warm
+        cache = None
+        for name, settings in configs + [("re-run", configs[-1][1])]:
+            if name != "re-run":
+                cache = OCRCache(tempfile.mkdtemp(dir=folder))
+            start = time.perf_counter()
+            text_path = pdf_to_text(pdf_path, folder, settings=settings, cache=cache)
+            elapsed = time.perf_counter() - start
+            with open(text_path, "r", encoding="utf-8") as f:
+                extracted = f.read().split(PAGE_BREAK)
+            accuracy = _char_accuracy(truth, extracted)
+            click.echo(f"{name:<10} {pages} pages in {elapsed:6.2f}s  {pages / elapsed:7.1f} pages/s  "
+                       f"accuracy {accuracy:.1%}  cache hits {cache.hits}/{cache.hits + cache.misses}")
+            cache.hits = cache.misses = 0
+
+@bench.command()
+@click.option("--text", default="text", help="Folder of .txt files to chunk and embed")
+@click.option("--batch-sizes", default="16,32,64,128", help="Comma-separated batch sizes to try")
+@click.option("--threads", default=None, type=int, help="Torch CPU threads")
+@click.option("--backend", default="torch", help="torch, onnx or openvino")
+@click.option("--onnx-file", default=None, help="ONNX export to load, e.g. onnx/model_qint8_avx512_vnni.onnx")
+def embed(text, batch_sizes, threads, backend, onnx_file):
+    """Embedding throughput in chunks/sec, cold and from the on-disk cache"""
+    chunks = []
+    for filename in os.listdir(text):
+        if filename.endswith(".txt"):
+            chunks.extend(doc.page_content for doc in _split_text_file(os.path.join(text, filename)))
+    click.echo(f"{len(chunks)} chunks")
+
+    for batch_size in [int(b) for b in batch_sizes.split(",")]:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            embeddings = CachedEmbeddings(batch_size=batch_size, threads=threads, backend=backend,
+                                          onnx_file=onnx_file, cache_dir=cache_dir)
+            embeddings.embed_documents(chunks[:batch_size])  # warm up the model
+
+            timings = []
+            for _ in range(2):  # first pass computes, second is served from the cache
+                start = time.perf_counter()
+                embeddings.embed_documents(chunks)
+                timings.append(time.perf_counter() - start)
+
+        cold, warm = (len(chunks) / t for t in timings)
+        click.echo(f"batch={batch_size:<4} cold {cold:8.1f} chunks/s  cached {warm:10.1f} chunks/s")
+
+@bench.command()
+@click.option("--count", default=200_000, help="Number of synthetic vectors")
+@click.option("--dim", default=384, help="Vector dimension (all-MiniLM-L6-v2 is 384)")
+@click.option("--queries", default=500, help="Number of held-out queries")
+@click.option("--k", default=10, help="Neighbours per query")
+def ann(count, dim, queries, k):
+    """Recall@k and per-query latency of each index type against the flat baseline"""
+    rng = np.random.default_rng(0)
+    # Clustered data behaves more like real embeddings than uniform noise
+    centers = rng.normal(size=(max(count // 1000, 1), dim)).astype(np.float32)
+    data = centers[rng.integers(len(centers), size=count + queries)]
+    data += rng.normal(scale=0.3, size=data.shape).astype(np.float32)
+    vectors, query_vectors = data[:count], data[count:]
+
+    def timed_search(index, params=None):
+        start = time.perf_counter()
+        _, ids = index.search(query_vectors, k, params=params)
+        return ids, (time.perf_counter() - start) * 1000 / queries
+
+    flat = build_index(vectors, "flat")
+    flat.add(vectors)
+    truth, flat_ms = timed_search(flat)
+    click.echo(f"{'flat':<7} {'':<12} recall@{k} 1.000  {flat_ms:8.3f} ms/query")
+
+    sweeps = {"ivf": ("nprobe", [1, 4, 16, 64]), "ivfpq": ("nprobe", [1, 4, 16, 64]), "hnsw": ("efSearch", [16, 32, 64, 128])}
+    for index_type, (knob, values) in sweeps.items():
+        start = time.perf_counter()
+        index = build_index(vectors, index_type)
+        index.add(vectors)
+        click.echo(f"{index_type:<7} built in {time.perf_counter() - start:.1f}s")
+
+        for value in values:
+            if knob == "nprobe":
+                params = search_params(index, nprobe=value)
+            else:
+                params = search_params(index, ef_search=value)
+            ids, ms = timed_search(index, params)
+            recall = np.mean([len(set(ids[i]) & set(truth[i])) / k for i in range(queries)])
+            click.echo(f"{index_type:<7} {knob}={value:<5} recall@{k} {recall:.3f}  {ms:8.3f} ms/query")
+
+@bench.command("index-writes")
+@click.option("--uploads", default=50, help="Number of concurrent uploads")
+def index_writes(uploads):
+    """Concurrent additions through IndexManager: files/sec and a check that none were lost"""
+    with tempfile.TemporaryDirectory() as root:
+        text_folder = os.path.join(root, "text")
+        rag_folder = os.path.join(root, "rag")
+        os.makedirs(text_folder)
+        with open(os.path.join(text_folder, "seed.txt"), "w", encoding="utf-8") as f:
+            f.write("seed document")
+        create_vector_store(text_folder, rag_folder)
+
+        paths = []
+        for i in range(uploads):
+            path = os.path.join(text_folder, f"upload_{i}.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(f"Upload number {i}. " * 50)
+            paths.append(path)
+
+        manager = IndexManager(rag_folder)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=uploads) as pool:
+            futures = list(pool.map(manager.add_text_file, paths))
+        for future in futures:
+            future.result()
+        elapsed = time.perf_counter() - start
+        manager.shutdown()
+
+        manifest = Manifest.for_index(rag_folder)
+        indexed = [name for name in manifest.texts if os.path.basename(name).startswith("upload_")]
+        expected_chunks = sum(len(entry["chunk_ids"]) for entry in manifest.texts.values())
+        vectors = len(live_rows(load_index(current_index_dir(rag_folder), get_embeddings())))
+        generations = len([name for name in os.listdir(rag_folder) if name.startswith("gen-")])
+
+        click.echo(f"{uploads} uploads in {elapsed:.2f}s ({uploads / elapsed:.1f} files/s)")
+        click.echo(f"indexed {len(indexed)}/{uploads} files, {vectors} vectors for {expected_chunks} chunks, "
+                   f"{generations} generations kept")
+        if len(indexed) != uploads or vectors != expected_chunks:
+            raise click.ClickException("Lost updates")
+
+@bench.command()
+@click.option("--rag", default="rag", help="RAG folder to query")
+@click.option("--questions", default=None, help="JSONL of {\"question\", \"answer\"}; answer is text the context must contain")
+@click.option("--samples", default=100, help="Synthetic questions drawn from the index when --questions is not given")
+@click.option("--budgets", default="500,1000,2000", help="Comma-separated token budgets to try")
+def context(rag, questions, samples, budgets):
+    """Prompt size and retrieval latency vs. answer-context recall for each context strategy"""
+    embeddings = get_embeddings()
+    vector_store = load_index(current_index_dir(rag), embeddings)
+
+    if questions:
+        with open(questions, "r", encoding="utf-8") as f:
+            cases = [json.loads(line) for line in f if line.strip()]
+    else:
+        # Ask for a sentence-sized span of a random chunk using its own words
+        rng = np.random.default_rng(0)
+        cases = []
+        rows = live_rows(vector_store)
+        for row in rng.choice(rows, size=min(samples, len(rows)), replace=False):
+            words = vector_store.docstore.search(int(row)).page_content.split()
+            start = int(rng.integers(max(len(words) - 12, 1)))
+            span = " ".join(words[start:start + 12])
+            cases.append({"question": span, "answer": span})
+
+    def normalise(text):
+        return " ".join(text.lower().split())
+
+    def evaluate(label, select):
+        tokens, timings, hits = [], [], 0
+        for case in cases:
+            start = time.perf_counter()
+            question_vector = embeddings.embed_query(case["question"])
+            docs = select(case["question"], question_vector)
+            timings.append((time.perf_counter() - start) * 1000)
+            prompt_context = "\n\n".join(doc.page_content for doc in docs)
+            tokens.append(count_tokens(prompt_context))
+            hits += normalise(case["answer"]) in normalise(prompt_context)
+        click.echo(f"{label:<22} recall {hits / len(cases):.3f}  {np.mean(tokens):7.0f} context tokens  "
+                   f"{np.mean(timings):7.2f} ms/query")
+
+    click.echo(f"{len(cases)} questions")
+    evaluate("top-3 (old)", lambda question, vector: similarity_search(vector_store, vector, k=3))
+    for budget in [int(b) for b in budgets.split(",")]:
+        for rerank in ("none", "mmr"):
+            builder = ContextBuilder(embeddings, token_budget=budget, rerank=rerank)
+
+            def select(question, vector, builder=builder):
+                candidates = similarity_search(vector_store, vector, k=builder.candidates)
+                return builder.build(question, vector, candidates)
+
+            evaluate(f"{rerank} @{budget} tokens", select)
+
+@bench.command()
+@click.option("--chunks", default="10000,100000,300000", help="Comma-separated synthetic corpus sizes")
+@click.option("--queries", default=200, help="Queries timed per corpus")
+def bm25(chunks, queries):
+    """BM25 index build time, size on disk and query latency as the corpus grows"""
+    rng = np.random.default_rng(0)
+    # Zipf-distributed terms, ~150 per chunk, like real clinical text
+    vocabulary = np.array([f"term{i}" for i in range(100_000)])
+
+    for count in [int(c) for c in chunks.split(",")]:
+        ranks = np.minimum(rng.zipf(1.2, size=(count, 150)), len(vocabulary)) - 1
+        texts = [" ".join(vocabulary[row]) for row in ranks]
+        query_terms = np.minimum(rng.zipf(1.2, size=(queries, 4)), len(vocabulary)) - 1 + 50
+        query_texts = [" ".join(vocabulary[np.minimum(row, len(vocabulary) - 1)]) for row in query_terms]
+
+        with tempfile.TemporaryDirectory() as folder:
+            start = time.perf_counter()
+            write_bm25(texts, folder)
+            built = time.perf_counter() - start
+            size = sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder))
+
+            index = BM25Index(folder)
+            start = time.perf_counter()
+            for query in query_texts:
+                index.search(query, 20)
+            ms = (time.perf_counter() - start) * 1000 / queries
+
+        click.echo(f"chunks={count:<8} built in {built:6.1f}s  {size / 1e6:8.1f} MB on disk  {ms:7.3f} ms/query")
+
+def _otp_service(redis_url):
+    """Import the OTP service pointed at redis_url, or at an in-process fakeredis when None."""
+    import sys
+    import redis.asyncio as redis
+
+    # auth.py runs from its own folder and imports its neighbours as top-level modules
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend", "OTPAuth"))
+    import auth
+
+    if redis_url:
+        auth.redis_client = redis.Redis.from_url(redis_url, decode_responses=True)
+    else:
+        import fakeredis
+        auth.redis_client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    return auth
+
+@bench.command()
+@click.option("--sizes", default="100,1000,10000,100000", help="Comma-separated active session counts")
+@click.option("--checks", default=1000, help="check-session calls timed per size")
+@click.option("--redis-url", default=None, help="Redis to use (flushed!); defaults to an in-process fakeredis")
+def sessions(sizes, checks, redis_url):
+    """check-session latency as the number of active sessions grows"""
+    import asyncio
+    import json
+
+    auth = _otp_service(redis_url)
+    client = auth.redis_client
+
+    async def run(size):
+        await client.flushdb()
+        doctors = max(size // 10, 1)
+        pipe = client.pipeline(transaction=False)
+        for i in range(size):
+            doctor_id = f"doctor{i % doctors}"
+            pipe.set(f"session:patient{i}", json.dumps({"doctor_id": doctor_id}), ex=auth.SESSION_TTL)
+            pipe.sadd(auth.doctor_sessions_key(doctor_id), f"patient{i}")
+        await pipe.execute()
+
+        doctor_ids = [f"doctor{i}" for i in np.random.default_rng(0).integers(doctors * 2, size=checks)]
+        start = time.perf_counter()
+        for doctor_id in doctor_ids:
+            await auth.check_session(doctor_id)
+        return (time.perf_counter() - start) * 1000 / checks
+
+    for size in [int(n) for n in sizes.split(",")]:
+        click.echo(f"sessions={size:<7} {asyncio.run(run(size)):8.3f} ms/check")
+
+@bench.command()
+@click.option("--patients", default=2000, help="OTP flows to run")
+@click.option("--concurrency", default=64, help="Flows in flight at once")
+@click.option("--redis-url", default=None, help="Redis to use (flushed!); defaults to an in-process fakeredis")
+def otp(patients, concurrency, redis_url):
+    """OTP service throughput: generate, verify, check and end a session per patient"""
+    import asyncio
+
+    auth = _otp_service(redis_url)
+
+    async def flow(i, limit):
+        async with limit:
+            code = (await auth.generate_otp(auth.OTPRequest(user_id=f"patient{i}")))["otp"]
+            await auth.verify_otp(auth.OTPVerify(doctor_id=f"doctor{i % 50}", otp=code))
+            if not (await auth.check_session(f"doctor{i % 50}"))["session_exists"]:
+                raise click.ClickException(f"Session for patient{i} not found")
+            await auth.end_session(auth.OTPRequest(user_id=f"patient{i}"))
+
+    async def run():
+        await auth.redis_client.flushdb()
+        limit = asyncio.Semaphore(concurrency)
+        start = time.perf_counter()
+        await asyncio.gather(*(flow(i, limit) for i in range(patients)))
+        return time.perf_counter() - start
+
+    elapsed = asyncio.run(run())
+    click.echo(f"{patients} flows in {elapsed:.2f}s ({patients / elapsed:.0f} flows/s, "
+               f"{patients * 4 / elapsed:.0f} requests/s) at concurrency {concurrency}")
+
+@bench.command()
+@click.option("--notes", default=5000, help="Notes saved per run")
+@click.option("--concurrency", default="1,16,256", help="Comma-separated numbers of concurrent savers")
+def notes(notes, concurrency):
+    """Note saves/sec through the group-committed note store, against one commit per note"""
+    import asyncio
+    import sys
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend", "OTPAuth"))
+    from note_store import NoteStore
+
+    async def run(store, savers):
+        limit = asyncio.Semaphore(savers)
+
+        async def save(i):
+            async with limit:
+                return await store.aadd(f"patient{i % 500}", f"doctor{i % 50}", "Patient is stable. " * 20)
+
+        start = time.perf_counter()
+        ids = await asyncio.gather(*(save(i) for i in range(notes)))
+        return time.perf_counter() - start, len(set(ids))
+
+    for savers in [int(c) for c in concurrency.split(",")]:
+        for label, max_batch in (("group commit", 512), ("commit each ", 1)):
+            with tempfile.TemporaryDirectory() as root:
+                store = NoteStore(os.path.join(root, "notes.db"), max_batch=max_batch)
+                elapsed, saved = asyncio.run(run(store, savers))
+                start = time.perf_counter()
+                found = len(store.notes(doctor_id="doctor7", limit=notes))
+                lookup_ms = (time.perf_counter() - start) * 1000
+                store.close()
+
+            if saved != notes:
+                raise click.ClickException(f"Only {saved}/{notes} notes saved")
+            click.echo(f"savers={savers:<4} {label} {notes / elapsed:8.0f} notes/s  "
+                       f"doctor lookup {found} notes in {lookup_ms:.2f} ms")
+
+@bench.command()
+@click.option("--requests", "count", default=1000, help="LLM calls made")
+@click.option("--callers", default=200, help="Calls in flight at once")
+@click.option("--duplicates", default=0.3, help="Share of calls repeating an earlier prompt")
+@click.option("--latency", default=0.05, help="Fake LLM base latency in seconds")
+@click.option("--jitter", default=0.1, help="Extra random latency, up to this many seconds")
+@click.option("--error-rate", default=0.2, help="Share of fake LLM calls that fail")
+@click.option("--error-status", default=429, help="HTTP status of the injected errors")
+@click.option("--concurrency", default=32, help="ResilientLLM concurrency limit")
+@click.option("--rate", default=None, type=float, help="ResilientLLM calls/sec limit")
+@click.option("--timeout", default=2.0, help="ResilientLLM per-call deadline in seconds")
+def llm(count, callers, duplicates, latency, jitter, error_rate, error_status, concurrency, rate, timeout):
+    """Answered share and latency of LLM calls against a flaky fake LLM, bare and behind ResilientLLM"""
+    import asyncio
+
+    rng = random.Random(0)
+    prompts = []
+    for i in range(count):
+        if prompts and rng.random() < duplicates:
+            prompts.append(rng.choice(prompts))
+        else:
+            prompts.append(f"Question: question {i}\nAnswer:")
+
+    async def run(client):
+        limit = asyncio.Semaphore(callers)
+
+        async def call(prompt):
+            async with limit:
+                start = time.perf_counter()
+                try:
+                    await client.agenerate(prompt)
+                    ok = True
+                except Exception:
+                    ok = False
+                return ok, time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(call(prompt) for prompt in prompts))
+        return results, time.perf_counter() - start
+
+    for label in ("bare", "resilient"):
+        fake = FakeLLM(latency, error_rate=error_rate, error_status=error_status, jitter=jitter, seed=0)
+        client = fake
+        if label == "resilient":
+            client = ResilientLLM(fake, concurrency=concurrency, rate=rate, backoff=0.05, timeout=timeout)
+        results, elapsed = asyncio.run(run(client))
+
+        answered = sum(ok for ok, _ in results)
+        latencies = sorted(seconds for _, seconds in results)
+        line = (f"{label:<9} {answered / count:6.1%} answered  p50 {latencies[len(latencies) // 2] * 1000:5.0f} ms  "
+                f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:5.0f} ms  {count / elapsed:6.0f} calls/s  "
+                f"upstream calls {fake.calls}")
+        if label == "resilient":
+            stats = client.stats()
+            line += f"  coalesced {stats['coalesced']}  retries {stats['retries']}  timeouts {stats['timeouts']}"
+        click.echo(line)
+
+def _fake_llm(latency=0.0, jitter=0.0, error_rate=0.0, error_status=503, token_delay=0.0, seed=0):
+    """Serve the HTTPLLM API on localhost, with injected latency and errors; returns the server.
+
+    server.calls counts the requests received and server.errors those answered with error_status.
+    """
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            prompt = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["prompt"]
+            with lock:
+                server.calls += 1
+                delay = latency + rng.uniform(0, jitter)
+                fail = rng.random() < error_rate
+                server.errors += fail
+            try:
+                time.sleep(delay)
+                if fail:
+                    self._send(error_status, json.dumps({"error": "injected"}).encode())
+                elif self.path == "/generate":
+                    self._send(200, json.dumps({"text": f"Fake answer to: {prompt}"}).encode())
+                else:
+                    # HTTP/1.0 without Content-Length: the stream ends when the connection closes
+                    self.send_response(200)
+                    self.end_headers()
+                    for i, word in enumerate(f"Fake answer to: {prompt}".split(" ")):
+                        if i:
+                            time.sleep(token_delay)
+                        self.wfile.write(json.dumps({"text": word if i == 0 else " " + word}).encode() + b"\n")
+                        self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # the client gave up: its deadline passed
+
+        def _send(self, status, body):
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    class Server(ThreadingHTTPServer):
+        request_queue_size = 1024  # every caller may connect at once
+
+    server = Server(("127.0.0.1", 0), Handler)
+    server.calls = server.errors = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+@bench.command("llm-server")
+@click.option("--requests", "count", default=300, help="Distinct prompts sent per mode")
+@click.option("--callers", default=50, help="Calls in flight at once")
+@click.option("--latency", default=0.02, help="Fake server base latency in seconds")
+@click.option("--jitter", default=0.03, help="Extra random latency, up to this many seconds")
+@click.option("--error-rate", default=0.3, help="Share of requests the fake server fails")
+@click.option("--error-status", default=503, help="HTTP status of the injected errors")
+def llm_server(count, callers, latency, jitter, error_rate, error_status):
+    """Check ResilientLLM's retries, deadlines and coalescing over HTTP against a flaky local LLM server.
+
+    Runs the blocking, async and streaming paths; fails on the first check that does not hold.
+    """
+    import asyncio
+
+    def call_all(client, mode, prompts):
+        """Answer or raised exception for each prompt, sent through mode with callers in flight."""
+        if mode == "generate":
+            def call(prompt):
+                try:
+                    return client.generate(prompt)
+                except Exception as e:
+                    return e
+
+            with ThreadPoolExecutor(callers) as pool:
+                return list(pool.map(call, prompts))
+
+        async def call(prompt, limit):
+            async with limit:
+                try:
+                    if mode == "agenerate":
+                        return await client.agenerate(prompt)
+                    return "".join([piece async for piece in client.astream(prompt)])
+                except Exception as e:
+                    return e
+
+        async def run():
+            limit = asyncio.Semaphore(callers)
+            return await asyncio.gather(*(call(prompt, limit) for prompt in prompts))
+
+        return asyncio.run(run())
+
+    def scenario(mode, prompts, server_options, **client_options):
+        server = _fake_llm(**server_options)
+        try:
+            client = ResilientLLM(HTTPLLM(f"http://127.0.0.1:{server.server_port}"), concurrency=callers,
+                                  backoff=0.01, **client_options)
+            start = time.perf_counter()
+            results = call_all(client, mode, prompts)
+            return results, time.perf_counter() - start, server.calls, server.errors, client.stats()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def check(ok, mode, message):
+        if not ok:
+            raise click.ClickException(f"{mode}: {message}")
+
+    prompts = [f"question {i}" for i in range(count)]
+    for mode in ("generate", "agenerate", "astream"):
+        # Injected errors are retried until every prompt is answered, each exactly once
+        results, elapsed, calls, errors, stats = scenario(
+            mode, prompts, dict(latency=latency, jitter=jitter, error_rate=error_rate, error_status=error_status),
+            retries=10, timeout=30.0)
+        failed = [result for result in results if isinstance(result, Exception)]
+        check(not failed, mode, f"{len(failed)}/{count} calls failed despite retries, e.g. {failed[:1]}")
+        check(results == [f"Fake answer to: {prompt}" for prompt in prompts], mode, "answers do not match their prompts")
+        check(calls - errors == count, mode, f"{calls - errors} answers served for {count} prompts")
+        check(stats["retries"] == errors, mode, f"{stats['retries']} retries for {errors} injected errors")
+        line = f"{mode:<9} {count / elapsed:6.0f} calls/s  {errors} injected errors retried"
+
+        # Errors that persist, or that another attempt cannot fix, surface as the right exception
+        [result], _, calls, _, _ = scenario(mode, ["persistent"], dict(error_rate=1.0, error_status=503), retries=2)
+        check(isinstance(result, LLMUnavailable) and calls == 3, mode,
+              f"persistent 503: {result!r} after {calls} requests, expected LLMUnavailable after 3")
+        [result], _, calls, _, _ = scenario(mode, ["rejected"], dict(error_rate=1.0, error_status=400), retries=2)
+        check(isinstance(result, LLMError) and not isinstance(result, LLMUnavailable) and calls == 1, mode,
+              f"400: {result!r} after {calls} requests, expected LLMError after 1")
+
+        # A server slower than the deadline is abandoned at the deadline
+        [result], elapsed, _, _, stats = scenario(mode, ["slow"], dict(latency=2.0), timeout=0.3)
+        check(isinstance(result, LLMUnavailable) and stats["timeouts"] == 1, mode,
+              f"slow server: {result!r}, expected LLMUnavailable on the deadline")
+        check(elapsed < 0.6, mode, f"slow server: gave up after {elapsed:.2f}s, deadline 0.3s")
+        line += f"  deadline 0.3s kept ({elapsed:.2f}s)"
+
+        # Identical prompts in flight together share one request; streams are not coalesced
+        if mode != "astream":
+            duplicates = ["same question"] * callers
+            results, _, calls, _, stats = scenario(mode, duplicates, dict(latency=0.3))
+            check(results == ["Fake answer to: same question"] * callers, mode, "coalesced callers got different answers")
+            check(calls == 1 and stats["coalesced"] == callers - 1, mode,
+                  f"{callers} identical prompts made {calls} requests, {stats['coalesced']} coalesced")
+            line += f"  {callers} identical prompts sent once"
+        click.echo(line)
+
+def _fake_drive(files):
+    """Serve files ({file_id: path}) through a minimal Drive v3 API on localhost; returns the server."""
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path.endswith("/files"):
+                items = []
+                for file_id, path in files.items():
+                    with open(path, "rb") as f:
+                        md5 = hashlib.file_digest(f, "md5").hexdigest()
+                    items.append({"id": file_id, "name": f"{file_id}.pdf", "mimeType": "application/pdf",
+                                  "size": str(os.path.getsize(path)), "md5Checksum": md5, "modifiedTime": "0"})
+                self._send(200, json.dumps({"files": items}).encode())
+                return
+
+            path = files[url.path.rsplit("/", 1)[-1]]
+            size = os.path.getsize(path)
+            start, end = 0, size - 1
+            status, headers = 200, {}
+            if "range" in self.headers:
+                first, last = self.headers["range"].split("=")[1].split("-")
+                start, end = int(first), min(int(last), size - 1)
+                if start >= size:
+                    self._send(416, b"")
+                    return
+                status, headers = 206, {"Content-Range": f"bytes {start}-{end}/{size}"}
+            with open(path, "rb") as f:
+                f.seek(start)
+                self._send(status, f.read(end - start + 1), headers)
+
+        def _send(self, status, body, headers=None):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+@bench.command("drive-download")
+@click.option("--files", default=4, help="Number of files downloaded concurrently")
+@click.option("--size-mb", default=200, help="Size of each file")
+@click.option("--chunk-mb", default=CHUNK_SIZE // (1024 * 1024), help="Download chunk size")
+@click.option("--buffered", is_flag=True, help="Baseline: buffer each file in BytesIO before writing it")
+def drive_download(files, size_mb, chunk_mb, buffered):
+    """Drive download throughput and peak RSS against a local fake Drive server.
+
+    Peak RSS only grows over a process's life, so compare modes in separate runs.
+    """
+    import httplib2
+    from googleapiclient.discovery import build
+    from googleapiclient.http import MediaIoBaseDownload
+
+    with tempfile.TemporaryDirectory() as root:
+        sources = {}
+        for i in range(files):
+            path = os.path.join(root, f"source_{i}")
+            with open(path, "wb") as f:
+                for _ in range(size_mb):
+                    f.write(os.urandom(1024 * 1024))
+            sources[f"file{i}"] = path
+
+        server = _fake_drive(sources)
+        endpoint = f"http://127.0.0.1:{server.server_port}/"
+
+        def service_factory():
+            return build("drive", "v3", http=httplib2.Http(), static_discovery=True,
+                         client_options={"api_endpoint": endpoint})
+
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        if buffered:
+            def download(file_id):
+                request = service_factory().files().get_media(fileId=file_id)
+                fh = io.BytesIO()
+                downloader = MediaIoBaseDownload(fh, request, chunksize=chunk_mb * 1024 * 1024)
+                done = False
+                while not done:
+                    _, done = downloader.next_chunk()
+                fh.seek(0)
+                with open(os.path.join(root, f"{file_id}.pdf"), "wb") as f:
+                    f.write(fh.read())
+
+            with ThreadPoolExecutor(max_workers=files) as pool:
+                list(pool.map(download, sources))
+        else:
+            sync = DriveSync(service_factory, workers=files, chunk_size=chunk_mb * 1024 * 1024)
+            stats = sync.sync("root", os.path.join(root, "synced"))
+            if stats["failed"]:
+                raise click.ClickException(f"{stats['failed']} downloads failed")
+        elapsed = time.perf_counter() - start
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        server.shutdown()
+
+    # ru_maxrss is in KiB on Linux
+    mode = "buffered" if buffered else "streamed"
+    click.echo(f"{mode}: {files} x {size_mb} MB in {elapsed:.2f}s ({files * size_mb / elapsed:.1f} MB/s), "
+               f"peak RSS {rss_after / 1024:.0f} MiB (+{(rss_after - rss_before) / 1024:.0f} MiB during download)")
+
+if __name__ == "__main__":
+    bench()
@@ -1,17 +1,21 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
+import json
 import os
-from typing import Optional
+import shutil
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import List, Optional
 from backend.ocr_processing import process_uploads, pdf_to_text
 from backend.vector_store import create_vector_store
-from backend.query_gemini import GeminiQuery
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain.docstore.document import Document
-
-app = FastAPI()
+from backend.index_manager import IndexManager
+from backend.manifest import Manifest, patient_folder, write_metadata
+from backend.retrieval import RetrievalService
+from backend.jobs import default_job_queue
+from backend.llm import LLMError, LLMUnavailable, get_llm
 
 # Configuration
 CONFIG = {
@@ -21,6 +25,28 @@ CONFIG = {
     'ALLOWED_EXTENSIONS': {'pdf', 'txt'}
 }
 
+# /kb jobs OCR the whole uploads folder with a process pool per job; running two at once
+# would only OCR the same files twice
+KB_LOCK = threading.Lock()
+
+# Uploads are copied to disk this many bytes at a time
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One retrieval service per process, reloaded automatically when the index changes
+    app.state.retrieval = RetrievalService(CONFIG['RAG_FOLDER'])
+    app.state.retrieval.warm_up()
+    # Ingestion runs in the background; searches keep using the loaded index meanwhile
+    app.state.jobs = default_job_queue()
+    # All index writes go through a single writer that publishes whole new generations
+    app.state.index_manager = IndexManager(CONFIG['RAG_FOLDER'])
+    yield
+    app.state.jobs.shutdown()
+    app.state.index_manager.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+
 # Ensure directories exist
 for folder in [CONFIG['UPLOAD_FOLDER'], 
                CONFIG['TEXT_FOLDER'], 
@@ -30,41 +56,102 @@ for folder in [CONFIG['UPLOAD_FOLDER'],
 # Pydantic models for request/response
 class ChatRequest(BaseModel):
     prompt: str
+    # Optional scope: only search this patient's records and/or this source document
+    patient_id: Optional[str] = None
+    source: Optional[str] = None
+
+    def filters(self):
+        return {"patient_id": self.patient_id, "source": self.source}
 
 class ChatResponse(BaseModel):
     status: str
     response: str
 
+class BatchChatRequest(BaseModel):
+    requests: List[ChatRequest]
+
+class BatchChatResponse(BaseModel):
+    status: str
+    # A question whose answer failed has None here and the reason in errors
+    responses: List[Optional[str]]
+    errors: List[Optional[str]]
+    seconds: float
+    questions_per_s: float
+
 class StandardResponse(BaseModel):
     status: str
     message: str
     file_path: Optional[str] = None
     vector_store_path: Optional[str] = None
+    job_id: Optional[str] = None
+
+def llm_error_status(e: LLMError) -> int:
+    # Overload, rate limits and deadlines are temporary (503); anything else is a bad upstream reply (502)
+    return 503 if isinstance(e, LLMUnavailable) else 502
 
 def allowed_file(filename: str) -> bool:
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in CONFIG['ALLOWED_EXTENSIONS']
 
-@app.post("/kb", response_model=StandardResponse)
+def run_kb_job(job):
+    with KB_LOCK:
+        sync_uploads(job)
+
+def sync_uploads(job):
+    # Process new or modified PDFs in uploads folder
+    manifest = Manifest.for_index(CONFIG['RAG_FOLDER'])
+    before = dict(manifest.sources)
+    process_uploads(CONFIG['UPLOAD_FOLDER'], CONFIG['TEXT_FOLDER'], manifest=manifest, progress=job.progress)
+
+    def sync_index():
+        # Other files may have been indexed while OCR ran; apply our changes to the latest manifest
+        latest = Manifest.for_index(CONFIG['RAG_FOLDER'])
+        latest.update_sources(before, manifest.sources)
+        create_vector_store(CONFIG['TEXT_FOLDER'], CONFIG['RAG_FOLDER'], progress=job.progress, manifest=latest)
+
+    # Bring the vector store up to date with the text folder
+    app.state.index_manager.submit(sync_index).result()
+    app.state.retrieval.answer_cache.clear()
+
+def run_add_file_job(job, filename, text_path, source_path=None, patient_id=None):
+    if source_path is not None:
+        text_path = pdf_to_text(source_path, CONFIG['TEXT_FOLDER'], patient_id=patient_id)
+        job.progress(filename, "ocr")
+
+    # Split, embed and add the new content, replacing any earlier version of the file;
+    # concurrent uploads are batched into one index update by the writer
+    app.state.index_manager.add_text_file(text_path, source_path).result()
+    app.state.retrieval.answer_cache.clear()
+    job.progress(filename, "indexed")
+
+@app.post("/kb", response_model=StandardResponse, status_code=202)
 async def handle_kb():
     try:
-        # Process all PDFs in uploads folder
-        processed = process_uploads(CONFIG['UPLOAD_FOLDER'], CONFIG['TEXT_FOLDER'])
-        
-        # Create new vector store
-        create_vector_store(CONFIG['TEXT_FOLDER'], CONFIG['RAG_FOLDER'])
-        
+        job = app.state.jobs.submit("kb", run_kb_job)
         return StandardResponse(
-            status="success",
-            message="Knowledge base created",
-            vector_store_path=CONFIG['RAG_FOLDER']
+            status="accepted",
+            message="Knowledge base update queued",
+            vector_store_path=CONFIG['RAG_FOLDER'],
+            job_id=job.id
         )
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/kb_add_file", response_model=StandardResponse)
-async def handle_add_file(file: UploadFile = File(...)):
+def save_upload(file, path):
+    # Blocking chunked copy, run off the event loop; large scans never sit in memory whole
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    part_path = path + ".part"
+    try:
+        with open(part_path, "wb") as buffer:
+            shutil.copyfileobj(file.file, buffer, UPLOAD_CHUNK_SIZE)
+        os.replace(part_path, path)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+@app.post("/kb_add_file", response_model=StandardResponse, status_code=202)
+async def handle_add_file(file: UploadFile = File(...), patient_id: Optional[str] = Form(None)):
     if not file:
         raise HTTPException(status_code=400, detail="No file uploaded")
         
@@ -75,69 +162,137 @@ async def handle_add_file(file: UploadFile = File(...)):
         raise HTTPException(status_code=400, detail="Invalid file type")
 
     filename = file.filename  # FastAPI's UploadFile already handles secure filenames
-    text_content = ""
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200
-    )
+    source_path = None
+    text_path = None
 
     try:
-        # Handle PDF files
+        # Handle PDF files; OCR happens in the background job
+        # Each patient's files get their own subfolder, so two patients' report.pdf never clash
         if filename.lower().endswith('.pdf'):
-            pdf_path = os.path.join(CONFIG['UPLOAD_FOLDER'], filename)
-            with open(pdf_path, "wb") as buffer:
-                content = await file.read()
-                buffer.write(content)
-            text_path = pdf_to_text(pdf_path, CONFIG['TEXT_FOLDER'])
-            with open(text_path, 'r', encoding='utf-8') as f:
-                text_content = f.read()
+            source_path = os.path.join(patient_folder(CONFIG['UPLOAD_FOLDER'], patient_id), filename)
+            await run_in_threadpool(save_upload, file, source_path)
+            # Re-OCR by a later /kb or 'process --full' reads the patient from here
+            write_metadata(source_path, {"source": filename, "patient_id": patient_id})
                 
         # Handle text files
         else:
-            text_path = os.path.join(CONFIG['TEXT_FOLDER'], filename)
-            content = await file.read()
-            with open(text_path, "wb") as buffer:
-                buffer.write(content)
-            with open(text_path, 'r', encoding='utf-8') as f:
-                text_content = f.read()
-
-        # Split the new content
-        splits = text_splitter.create_documents([text_content])
-        
-        # Load existing vector store
-        embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-        vector_store = FAISS.load_local(
-            CONFIG['RAG_FOLDER'], 
-            embeddings, 
-            allow_dangerous_deserialization=True
-        )
-        
-        # Add new documents and save
-        vector_store.add_documents(splits)
-        vector_store.save_local(CONFIG['RAG_FOLDER'])
-        
+            text_path = os.path.join(patient_folder(CONFIG['TEXT_FOLDER'], patient_id), filename)
+            await run_in_threadpool(save_upload, file, text_path)
+            write_metadata(text_path, {"source": filename, "patient_id": patient_id})
+
+        job = app.state.jobs.submit("kb_add_file", run_add_file_job, filename, text_path, source_path, patient_id)
         return StandardResponse(
-            status="success",
-            message="File added to knowledge base",
-            file_path=text_path
+            status="accepted",
+            message="File queued for the knowledge base",
+            file_path=source_path or text_path,
+            job_id=job.id
         )
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/jobs/{job_id}")
+async def handle_job_status(job_id: str):
+    job = app.state.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job.to_dict()
+
 @app.post("/chat", response_model=ChatResponse)
 async def handle_chat(request: ChatRequest):
     try:
-        qa = GeminiQuery(CONFIG['RAG_FOLDER'])
-        response = qa.query(request.prompt)
+        qa = await run_in_threadpool(app.state.retrieval.get)
+        response = await qa.aquery(request.prompt, filters=request.filters())
         return ChatResponse(
             status="success",
             response=response
         )
         
+    except LLMError as e:
+        raise HTTPException(status_code=llm_error_status(e), detail=str(e))
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/chat/batch", response_model=BatchChatResponse)
+async def handle_chat_batch(request: BatchChatRequest):
+    """Answer many prompts at once: batched retrieval, concurrent rate-limited LLM calls."""
+    try:
+        qa = await run_in_threadpool(app.state.retrieval.get)
+        start = time.perf_counter()
+        results = await qa.aquery_batch(
+            [item.prompt for item in request.requests],
+            filters=[item.filters() for item in request.requests],
+            return_exceptions=True
+        )
+        elapsed = time.perf_counter() - start
+        failed = [isinstance(result, Exception) for result in results]
+        return BatchChatResponse(
+            status="partial" if any(failed) else "success",
+            responses=[None if fail else result for fail, result in zip(failed, results)],
+            errors=[str(result) if fail else None for fail, result in zip(failed, results)],
+            seconds=elapsed,
+            questions_per_s=len(results) / elapsed if elapsed else 0.0
+        )
+
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/cache/stats")
+async def handle_cache_stats():
+    return app.state.retrieval.answer_cache.stats()
+
+@app.get("/llm/stats")
+async def handle_llm_stats():
+    return get_llm().stats()
+
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+@app.post("/chat/stream")
+async def handle_chat_stream(request: ChatRequest):
+    """Stream the answer as server-sent events: one `data: {"token": ...}` event per
+    piece of text, then a `done` event with time-to-first-token and total time."""
+    try:
+        qa = await run_in_threadpool(app.state.retrieval.get)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def events():
+        start = time.perf_counter()
+        first_token_ms = None
+        try:
+            async for token in qa.astream(request.prompt, filters=request.filters()):
+                if first_token_ms is None:
+                    first_token_ms = (time.perf_counter() - start) * 1000
+                yield sse_event({"token": token})
+        except LLMError as e:
+            yield sse_event({"detail": str(e), "status": llm_error_status(e)}, event="error")
+            return
+        except Exception as e:
+            yield sse_event({"detail": str(e)}, event="error")
+            return
+
+        total_ms = (time.perf_counter() - start) * 1000
+        print(f"/chat/stream time to first token: {first_token_ms or total_ms:.0f}ms, total: {total_ms:.0f}ms")
+        yield sse_event({"ttft_ms": first_token_ms, "total_ms": total_ms}, event="done")
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 if __name__ == '__main__':
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=5000)
\ No newline at end of file
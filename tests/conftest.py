@@ -0,0 +1,54 @@
+import os
+import shutil
+import fitz
+import pytest
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from backend.index_store import current_index_dir, live_rows, load_index
+from backend.manifest import write_metadata
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture(autouse=True)
+def environment(monkeypatch):
+    # Tests never touch the developer's caches or pick up their index settings
+    monkeypatch.setenv("OCR_CACHE_DIR", "")
+    monkeypatch.delenv("INDEX_TYPE", raising=False)
+
+@pytest.fixture
+def embeddings():
+    # all-MiniLM-L6-v2's dimension, so the index shipped in rag/ can be extended
+    return DeterministicFakeEmbedding(size=384)
+
+@pytest.fixture
+def legacy_rag(tmp_path):
+    """A copy of the rag folder shipped with the repo: one save_local index, no generations or manifest."""
+    folder = tmp_path / "legacy_rag"
+    shutil.copytree(os.path.join(REPO, "rag"), folder)
+    return str(folder)
+
+def write_text(path, text, **metadata):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    if metadata:
+        write_metadata(path, metadata)
+    return path
+
+def write_pdf(path, text, patient_id=None):
+    # Enough embedded text that the page counts as digital and is never sent to Tesseract
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    document = fitz.open()
+    document.new_page().insert_textbox(fitz.Rect(50, 50, 550, 800), (text + " ") * 20)
+    document.save(path)
+    if patient_id is not None:
+        write_metadata(path, {"patient_id": patient_id})
+    return path
+
+def live_chunks(rag_folder, embeddings):
+    """(text, metadata) of every chunk searchable in the current generation, sorted."""
+    vector_store = load_index(current_index_dir(rag_folder), embeddings)
+    chunks = []
+    for row in live_rows(vector_store):
+        doc = vector_store.docstore.search(vector_store.index_to_docstore_id[int(row)])
+        chunks.append((doc.page_content, doc.metadata))
+    return sorted(chunks, key=lambda chunk: (chunk[0], sorted(chunk[1].items(), key=str)))
@@ -0,0 +1,49 @@
+import os
+from click.testing import CliRunner
+import app
+from conftest import write_pdf, write_text
+from backend.index_store import current_index_dir
+from backend.manifest import Manifest, source_key
+from backend.vector_store import add_text_files, create_vector_store
+
+def read(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+def test_process_publishes_sources_alongside_concurrent_writers(tmp_path, embeddings, monkeypatch):
+    uploads, text, rag = str(tmp_path / "uploads"), str(tmp_path / "text"), str(tmp_path / "rag")
+    write_text(os.path.join(text, "existing.txt"), "existing note " * 50)
+    create_vector_store(text, rag, embeddings)
+    first = current_index_dir(rag)
+    first_manifest = read(os.path.join(first, "manifest.json"))
+
+    pdf = write_pdf(os.path.join(uploads, "scan.pdf"), "scanned letter")
+    added = write_text(str(tmp_path / "api" / "added.txt"), "added through the api " * 50)
+    process_uploads = app.process_uploads
+    published = []
+
+    def process_while_api_writes(*args, **kwargs):
+        processed = process_uploads(*args, **kwargs)
+        # The API publishes a generation while the CLI is still busy
+        published.append(add_text_files([(added, None)], rag, embeddings))
+        return processed
+
+    monkeypatch.setattr(app, "process_uploads", process_while_api_writes)
+    result = CliRunner().invoke(app.cli, ["process", "--uploads", uploads, "--text", text, "--rag", rag,
+                                          "--workers", "1"])
+    assert result.exit_code == 0, result.output
+
+    manifest = Manifest.for_index(rag)
+    assert source_key(pdf) in manifest.sources
+    assert source_key(added) in manifest.texts  # the API's update survives
+    assert current_index_dir(rag) not in (first, published[0])
+    # Published generations are never edited in place
+    assert read(os.path.join(first, "manifest.json")) == first_manifest
+
+def test_process_before_the_first_index(tmp_path):
+    uploads, text, rag = str(tmp_path / "uploads"), str(tmp_path / "text"), str(tmp_path / "rag")
+    pdf = write_pdf(os.path.join(uploads, "scan.pdf"), "scanned letter")
+    result = CliRunner().invoke(app.cli, ["process", "--uploads", uploads, "--text", text, "--rag", rag,
+                                          "--workers", "1"])
+    assert result.exit_code == 0, result.output
+    assert source_key(pdf) in Manifest.for_index(rag).sources
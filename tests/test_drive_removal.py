@@ -0,0 +1,64 @@
+import os
+from conftest import live_chunks, write_pdf, write_text
+from backend.manifest import Manifest, source_key
+from backend.pipeline import IngestPipeline
+from backend.utils.drive_sync import DriveSync
+from backend.vector_store import add_text_files, remove_files
+
+class FakeDrive(DriveSync):
+    """Serves the files in self.files (Drive id -> writer) instead of calling the Drive API."""
+
+    def __init__(self, files):
+        super().__init__(lambda: None, workers=1)
+        self.files = files
+
+    def _list_children(self, folder_id):
+        return [{"id": file_id, "name": name, "mimeType": "application/octet-stream", "md5Checksum": file_id}
+                for file_id, (name, _) in self.files.items()]
+
+    def download(self, item, folder_path):
+        name, write = self.files[item["id"]]
+        return write(os.path.join(folder_path, name))
+
+def sync(drive, folder_path, text_folder, rag_folder, embeddings):
+    with IngestPipeline(text_folder, rag_folder, embeddings, ocr_threads=1, ocr_processes=1,
+                        patient_id="p1") as pipeline:
+        stats = drive.sync("folder", folder_path, on_file=pipeline.submit, on_removed=pipeline.remove)
+    return stats, pipeline.stats()
+
+def test_files_deleted_from_drive_leave_the_index(tmp_path, embeddings):
+    folder_path, text_folder, rag_folder = str(tmp_path / "drive"), str(tmp_path / "text"), str(tmp_path / "rag")
+    drive = FakeDrive({
+        "kept": ("kept.txt", lambda path: write_text(path, "kept note " * 50)),
+        "note": ("note.txt", lambda path: write_text(path, "deleted note " * 50)),
+        "scan": ("scan.pdf", lambda path: write_pdf(path, "deleted scan")),
+    })
+    sync(drive, folder_path, text_folder, rag_folder, embeddings)
+    sources = {metadata["source"] for _, metadata in live_chunks(rag_folder, embeddings)}
+    assert sources == {"kept.txt", "note.txt", "scan.pdf"}
+    scan_text = Manifest.for_index(rag_folder).sources[source_key(os.path.join(folder_path, "scan.pdf"))]["text_path"]
+
+    del drive.files["note"], drive.files["scan"]
+    stats, ingest = sync(drive, folder_path, text_folder, rag_folder, embeddings)
+    assert stats["removed"] == ingest["removed"] == 2 and not ingest["failed"]
+
+    assert {metadata["source"] for _, metadata in live_chunks(rag_folder, embeddings)} == {"kept.txt"}
+    manifest = Manifest.for_index(rag_folder)
+    assert manifest.sources == {}
+    assert list(manifest.texts) == [source_key(os.path.join(text_folder, "p1", "kept.txt"))]
+    # The texts extracted from them go too, so a full rebuild does not bring them back
+    assert not os.path.exists(os.path.join(text_folder, "p1", "note.txt"))
+    assert not os.path.exists(scan_text)
+
+def test_removing_every_file_leaves_an_empty_index(tmp_path, embeddings, monkeypatch):
+    monkeypatch.setenv("INDEX_TYPE", "ivf")
+    rag_folder = str(tmp_path / "rag")
+    only = write_text(str(tmp_path / "text" / "only.txt"), "only note " * 50)
+    add_text_files([(only, None)], rag_folder, embeddings)
+
+    remove_files([only], rag_folder, embeddings)
+    assert live_chunks(rag_folder, embeddings) == []
+    assert not os.path.exists(only)
+    added = write_text(str(tmp_path / "text" / "added.txt"), "added note " * 50)
+    add_text_files([(added, None)], rag_folder, embeddings)
+    assert {metadata["source"] for _, metadata in live_chunks(rag_folder, embeddings)} == {"added.txt"}
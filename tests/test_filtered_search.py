@@ -0,0 +1,97 @@
+import os
+from types import SimpleNamespace
+import faiss
+import numpy as np
+import pytest
+from conftest import write_text
+from backend.index_store import (current_index_dir, filter_rows, index_segments, live_rows, load_bm25, load_filters,
+                                 load_index)
+from backend.vector_store import add_text_files, build_index, create_vector_store, search_rows
+
+PATIENTS = ["p1", "p2", "p3"]
+
+@pytest.fixture
+def rag_folder(tmp_path, embeddings):
+    """An index of three patients' notes, with a file appended and one replaced since the base was built."""
+    text_folder = str(tmp_path / "text")
+    rag_folder = str(tmp_path / "rag")
+    for i in range(30):
+        patient_id = PATIENTS[i % 3]
+        write_text(os.path.join(text_folder, patient_id, f"note{i}.txt"),
+                   f"note {i} for {patient_id}: glucose {i} mmol blood pressure {100 + i} " * 30,
+                   source=f"note{i}.pdf", patient_id=patient_id)
+    create_vector_store(text_folder, rag_folder, embeddings)
+
+    added = write_text(os.path.join(text_folder, "p1", "added.txt"), "added note hba1c 7.2 " * 40,
+                       source="added.pdf", patient_id="p1")
+    replaced = write_text(os.path.join(text_folder, "p2", "note1.txt"), "replaced note hba1c 6.1 " * 40,
+                          source="note1.pdf", patient_id="p2")
+    add_text_files([(added, None), (replaced, None)], rag_folder, embeddings)
+    segments, deleted = index_segments(current_index_dir(rag_folder))
+    assert len(segments) == 2 and len(deleted)
+    return rag_folder
+
+def live_metadata(vector_store):
+    return {int(row): vector_store.docstore.search(vector_store.index_to_docstore_id[int(row)])
+            for row in live_rows(vector_store)}
+
+def test_filter_rows_match_chunk_metadata(rag_folder, embeddings):
+    index_dir = current_index_dir(rag_folder)
+    docs = live_metadata(load_index(index_dir, embeddings))
+    filters = load_filters(index_dir)
+
+    for patient_id in PATIENTS + ["nobody"]:
+        expected = sorted(row for row, doc in docs.items() if doc.metadata["patient_id"] == patient_id)
+        assert filter_rows(filters, {"patient_id": patient_id}).tolist() == expected
+    # Replaced chunks are gone from the filters with the rest of the index
+    assert filter_rows(filters, {"source": "note1.pdf"}).tolist() == sorted(
+        row for row, doc in docs.items() if doc.metadata["source"] == "note1.pdf")
+    assert all("replaced" in docs[row].page_content for row in filter_rows(filters, {"source": "note1.pdf"}))
+    combined = filter_rows(filters, {"patient_id": "p1", "source": "added.pdf"})
+    assert len(combined) and all(docs[row].metadata["source"] == "added.pdf" for row in combined)
+    assert filter_rows(filters, {}) is None
+    with pytest.raises(ValueError):
+        filter_rows(filters, {"page": 1})
+
+def test_filtered_search_is_exact_top_k(rag_folder, embeddings):
+    index_dir = current_index_dir(rag_folder)
+    vector_store = load_index(index_dir, embeddings)
+    docs = live_metadata(vector_store)
+    allowed = filter_rows(load_filters(index_dir), {"patient_id": "p2"})
+
+    query = np.asarray(embeddings.embed_query("hba1c"), dtype=np.float32)
+    vectors = np.asarray(embeddings.embed_documents([docs[int(row)].page_content for row in allowed]), dtype=np.float32)
+    distances = ((vectors - query) ** 2).sum(axis=1)
+    expected = [int(allowed[i]) for i in np.argsort(distances, kind="stable")[:5]]
+
+    assert search_rows(vector_store, query, k=5, rows=allowed) == expected
+    assert search_rows(vector_store, query, k=5, rows=np.zeros(0, dtype=np.int64)) == []
+
+def test_filtered_bm25_skips_other_patients_and_replaced_chunks(rag_folder, embeddings):
+    index_dir = current_index_dir(rag_folder)
+    docs = live_metadata(load_index(index_dir, embeddings))
+    bm25 = load_bm25(index_dir)
+
+    hits = bm25.search("hba1c", k=100)
+    assert hits and {docs[row].metadata["source"] for row in hits} == {"added.pdf", "note1.pdf"}
+    allowed = filter_rows(load_filters(index_dir), {"patient_id": "p1"})
+    assert {docs[row].metadata["source"] for row in bm25.search("hba1c", k=100, allowed=allowed)} == {"added.pdf"}
+
+@pytest.mark.parametrize("index_type", ["ivf", "ivfpq", "hnsw"])
+def test_selective_filter_on_approximate_index(index_type):
+    # A filter leaving a few rows of a large approximate index still finds all of them
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((20_000, 32)).astype(np.float32)
+    index = build_index(vectors, index_type)
+    index.add(vectors)
+    allowed = np.sort(rng.choice(len(vectors), 20, replace=False))
+    query = rng.standard_normal(32).astype(np.float32)
+
+    exact = faiss.IndexFlatL2(32)
+    exact.add(vectors[allowed])
+    _, nearest = exact.search(query[None], 10)
+    hits = search_rows(SimpleNamespace(index=index), query, k=10, rows=allowed)
+    assert set(hits) <= set(allowed.tolist())
+    assert len(hits) == 10
+    if index_type != "ivfpq":  # compressed codes rank approximately
+        assert hits == allowed[nearest[0]].tolist()
@@ -0,0 +1,112 @@
+import os
+import pytest
+from conftest import live_chunks, write_text
+from backend import vector_store
+from backend.index_store import current_index_dir, index_segments, index_version, load_index
+from backend.manifest import Manifest, source_key
+from backend.vector_store import add_text_files, create_vector_store
+
+def text(name, words=50):
+    return " ".join(f"{name}{i}" for i in range(words))
+
+def full_build(text_folder, rag_folder, embeddings):
+    create_vector_store(text_folder, rag_folder, embeddings, full=True)
+    return live_chunks(rag_folder, embeddings)
+
+def segment_count(rag_folder):
+    segments, _ = index_segments(current_index_dir(rag_folder))
+    return len(segments)
+
+def test_add_file_to_legacy_folder(tmp_path, legacy_rag, embeddings):
+    before = live_chunks(legacy_rag, embeddings)
+    first = write_text(str(tmp_path / "text" / "first.txt"), text("first"))
+    second = write_text(str(tmp_path / "text" / "second.txt"), text("second"))
+
+    add_text_files([(first, None)], legacy_rag, embeddings)
+    manifest = Manifest.for_index(legacy_rag)
+    assert index_version(legacy_rag) is not None
+    assert manifest.index_type == "flat"
+    assert manifest.texts is None  # the shipped chunks stay untracked until a full rebuild
+
+    # The rewritten folder is a generation, so the next file is appended to it
+    add_text_files([(second, None)], legacy_rag, embeddings)
+    assert segment_count(legacy_rag) == 2
+    after = live_chunks(legacy_rag, embeddings)
+    added = [chunk for chunk in after if chunk not in before]
+    assert len(after) == len(before) + 2
+    assert sorted(chunk[1]["source"] for chunk in added) == ["first.txt", "second.txt"]
+
+def test_legacy_folder_takes_index_type_from_environment(tmp_path, legacy_rag, embeddings, monkeypatch):
+    monkeypatch.setenv("INDEX_TYPE", "hnsw")
+    path = write_text(str(tmp_path / "text" / "note.txt"), text("note"))
+    add_text_files([(path, None)], legacy_rag, embeddings)
+    assert Manifest.for_index(legacy_rag).index_type == "hnsw"
+
+def test_replace_and_remove_match_full_rebuild(tmp_path, embeddings):
+    text_folder = str(tmp_path / "text")
+    rag_folder = str(tmp_path / "rag")
+    write_text(os.path.join(text_folder, "a.txt"), text("a", 3000))
+    write_text(os.path.join(text_folder, "b.txt"), text("b", 3000))
+    # Same name, another patient's folder: must not be taken for a.txt
+    other = write_text(os.path.join(text_folder, "p2", "a.txt"), text("other", 400), patient_id="p2")
+    create_vector_store(text_folder, rag_folder, embeddings)
+    assert segment_count(rag_folder) == 1
+
+    write_text(other, text("changed", 30), patient_id="p2")
+    add_text_files([(other, None)], rag_folder, embeddings)
+    assert segment_count(rag_folder) == 2
+    _, deleted = index_segments(current_index_dir(rag_folder))
+    assert len(deleted) > 0
+
+    os.remove(os.path.join(text_folder, "b.txt"))
+    create_vector_store(text_folder, rag_folder, embeddings)
+    texts = Manifest.for_index(rag_folder).texts
+    assert set(texts) == {source_key(os.path.join(text_folder, "a.txt")), source_key(other)}
+
+    incremental = live_chunks(rag_folder, embeddings)
+    assert incremental == full_build(text_folder, str(tmp_path / "rebuilt"), embeddings)
+    assert not any("other0" in chunk for chunk, _ in incremental)
+    assert not any(chunk.startswith("b0") for chunk, _ in incremental)
+
+def test_deltas_are_compacted(tmp_path, embeddings, monkeypatch):
+    monkeypatch.setattr(vector_store, "MAX_DELTAS", 3)
+    text_folder = str(tmp_path / "text")
+    rag_folder = str(tmp_path / "rag")
+    base = write_text(os.path.join(text_folder, "base.txt"), text("base", 2000))
+    create_vector_store(text_folder, rag_folder, embeddings)
+
+    counts = []
+    for i in range(6):
+        path = write_text(os.path.join(text_folder, f"small{i}.txt"), text(f"small{i}_", 20))
+        add_text_files([(path, None)], rag_folder, embeddings)
+        counts.append(segment_count(rag_folder))
+    # Deltas pile up to the limit, then fold back into the base
+    assert max(counts) == vector_store.MAX_DELTAS + 1
+    assert 1 in counts
+
+    # Replacing most of the base rewrites it whole
+    write_text(base, text("rewritten", 2000))
+    add_text_files([(base, None)], rag_folder, embeddings)
+    assert segment_count(rag_folder) == 1
+    _, deleted = index_segments(current_index_dir(rag_folder))
+    assert len(deleted) == 0
+
+    assert live_chunks(rag_folder, embeddings) == full_build(text_folder, str(tmp_path / "rebuilt"), embeddings)
+
+@pytest.mark.parametrize("index_type", ["flat", "hnsw"])
+def test_rows_recorded_after_compaction(tmp_path, embeddings, monkeypatch, index_type):
+    monkeypatch.setenv("INDEX_TYPE", index_type)
+    monkeypatch.setattr(vector_store, "MAX_DELTAS", 1)
+    text_folder = str(tmp_path / "text")
+    rag_folder = str(tmp_path / "rag")
+    paths = [write_text(os.path.join(text_folder, f"{i}.txt"), text(f"f{i}_", 300)) for i in range(4)]
+    create_vector_store(text_folder, rag_folder, embeddings)
+    for path in paths:
+        write_text(path, text(os.path.basename(path), 300))
+        add_text_files([(path, None)], rag_folder, embeddings)
+
+    # Every file's recorded rows still hold exactly its chunks, wherever compaction moved them
+    index = load_index(current_index_dir(rag_folder), embeddings)
+    for entry in Manifest.for_index(rag_folder).texts.values():
+        rows = range(*entry["rows"])
+        assert [index.docstore.search(index.index_to_docstore_id[row]).id for row in rows] == entry["chunk_ids"]
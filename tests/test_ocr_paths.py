@@ -0,0 +1,66 @@
+import os
+from conftest import write_pdf
+from backend.manifest import Manifest, source_key
+from backend.ocr_processing import pdf_to_text, process_uploads
+
+def read(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+def process(uploads, text, manifest):
+    return process_uploads(uploads, text, workers=1, manifest=manifest)
+
+def test_same_named_pdfs_in_different_folders(tmp_path):
+    uploads, text = str(tmp_path / "uploads"), str(tmp_path / "text")
+    top = write_pdf(os.path.join(uploads, "a.pdf"), "toplevel")
+    nested = write_pdf(os.path.join(uploads, "x", "a.pdf"), "nested")
+    manifest = Manifest(str(tmp_path / "manifest.json"))
+
+    written = process(uploads, text, manifest)
+    assert sorted(written) == sorted([os.path.join(text, "a.txt"), os.path.join(text, "x", "a.txt")])
+    assert "toplevel" in read(os.path.join(text, "a.txt"))
+    assert "nested" in read(os.path.join(text, "x", "a.txt"))
+    assert manifest.sources[source_key(top)]["text_path"] != manifest.sources[source_key(nested)]["text_path"]
+
+    # Deleting one upload removes its text only
+    os.remove(top)
+    assert process(uploads, text, manifest) == []
+    assert not os.path.exists(os.path.join(text, "a.txt"))
+    assert "nested" in read(os.path.join(text, "x", "a.txt"))
+    assert list(manifest.sources) == [source_key(nested)]
+
+def test_only_the_suffix_is_replaced(tmp_path):
+    uploads, text = str(tmp_path / "uploads"), str(tmp_path / "text")
+    write_pdf(os.path.join(uploads, "scan.pdf.v2.PDF"), "uppercase")
+    assert process_uploads(uploads, text, workers=1) == [os.path.join(text, "scan.pdf.v2.txt")]
+
+def test_patient_uploads_map_to_patient_text_folder(tmp_path):
+    uploads, text = str(tmp_path / "uploads"), str(tmp_path / "text")
+    # As /kb_add_file stores them: in the patient's subfolder, with a sidecar naming the patient
+    added = write_pdf(os.path.join(uploads, "p1", "visit.pdf"), "first visit", patient_id="p1")
+    nested = write_pdf(os.path.join(uploads, "p1", "2024", "visit.pdf"), "later visit", patient_id="p1")
+    loose = write_pdf(os.path.join(uploads, "elsewhere", "visit.pdf"), "other visit", patient_id="p1")
+
+    # /kb_add_file OCRs its upload directly; a later /kb must find the same text file
+    first = pdf_to_text(added, text, patient_id="p1")
+    manifest = Manifest(str(tmp_path / "manifest.json"))
+    process(uploads, text, manifest)
+    assert manifest.sources[source_key(added)]["text_path"] == first == os.path.join(text, "p1", "visit.txt")
+    assert manifest.sources[source_key(nested)]["text_path"] == os.path.join(text, "p1", "2024", "visit.txt")
+    assert manifest.sources[source_key(loose)]["text_path"] == os.path.join(text, "p1", "elsewhere", "visit.txt")
+    assert "first visit" in read(first)
+
+def test_texts_from_the_flat_layout_are_moved(tmp_path):
+    uploads, text = str(tmp_path / "uploads"), str(tmp_path / "text")
+    nested = write_pdf(os.path.join(uploads, "x", "a.pdf"), "nested")
+    manifest = Manifest(str(tmp_path / "manifest.json"))
+    process(uploads, text, manifest)
+
+    # As an earlier version recorded it: the text at the top of the text folder
+    old = os.path.join(text, "a.txt")
+    os.replace(os.path.join(text, "x", "a.txt"), old)
+    manifest.sources[source_key(nested)]["text_path"] = old
+
+    assert process(uploads, text, manifest) == [os.path.join(text, "x", "a.txt")]
+    assert not os.path.exists(old)
+    assert manifest.sources[source_key(nested)]["text_path"] == os.path.join(text, "x", "a.txt")
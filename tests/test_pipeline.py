@@ -0,0 +1,45 @@
+import os
+import threading
+from conftest import live_chunks, write_pdf, write_text
+from backend import pipeline
+from backend.pipeline import IngestPipeline
+
+def run_with_deadline(fn, seconds=60):
+    # A pipeline stage that dies leaves submit() or close() blocked for good
+    thread = threading.Thread(target=fn, daemon=True)
+    thread.start()
+    thread.join(seconds)
+    assert not thread.is_alive(), "pipeline hung"
+
+def test_failing_files_do_not_stop_the_pipeline(tmp_path, embeddings, monkeypatch):
+    text_folder, rag_folder = str(tmp_path / "text"), str(tmp_path / "rag")
+    downloads = tmp_path / "downloads"
+    broken_metadata = write_text(str(downloads / "broken_metadata.txt"), "cannot record metadata " * 20)
+    broken_pdf = str(downloads / "broken.pdf")
+    with open(broken_pdf, "wb") as f:
+        f.write(b"not a pdf")
+    good = [write_text(str(downloads / f"good{i}.txt"), f"good note {i} " * 20) for i in range(3)]
+    good.append(write_pdf(str(downloads / "scan.pdf"), "scanned letter"))
+
+    write_metadata = pipeline.write_metadata
+
+    def failing_write_metadata(path, metadata):
+        if metadata["source"] == "broken_metadata.txt":
+            raise OSError("disk full")
+        write_metadata(path, metadata)
+
+    monkeypatch.setattr(pipeline, "write_metadata", failing_write_metadata)
+    ingest = IngestPipeline(text_folder, rag_folder, embeddings, ocr_threads=1, ocr_processes=1, queue_size=1,
+                            patient_id="p1")
+
+    def run():
+        with ingest:
+            for path in [broken_metadata, broken_pdf] + good:
+                ingest.submit(path)
+
+    run_with_deadline(run)
+    stats = ingest.stats()
+    assert sorted(stats["failed"]) == sorted([broken_metadata, broken_pdf])
+    assert stats["indexed"] == len(good)
+    sources = {metadata["source"] for _, metadata in live_chunks(rag_folder, embeddings)}
+    assert sources == {os.path.basename(path) for path in good}
@@ -0,0 +1,72 @@
+import asyncio
+import os
+import fakeredis
+import pytest
+from fastapi import HTTPException
+from conftest import REPO
+
+@pytest.fixture
+def auth(monkeypatch):
+    # auth.py runs from its own folder and imports its neighbours as top-level modules
+    monkeypatch.syspath_prepend(os.path.join(REPO, "backend", "OTPAuth"))
+    import auth
+
+    monkeypatch.setattr(auth, "redis_client", fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer(),
+                                                                       decode_responses=True))
+    return auth
+
+async def start_session(auth, user_id, doctor_id):
+    otp = (await auth.generate_otp(auth.OTPRequest(user_id=user_id)))["otp"]
+    await auth.verify_otp(auth.OTPVerify(doctor_id=doctor_id, otp=otp))
+
+async def live(auth, doctor_id):
+    return (await auth.check_session(doctor_id))["session_exists"]
+
+def test_session_is_live_for_its_doctor_only(auth):
+    async def run():
+        await start_session(auth, "patient1", "doctorA")
+        assert await live(auth, "doctorA")
+        assert not await live(auth, "doctorB")
+        await auth.require_session("patient1", "doctorA")
+        with pytest.raises(HTTPException) as raised:
+            await auth.require_session("patient1", "doctorB")
+        assert raised.value.status_code == 403
+
+    asyncio.run(run())
+
+def test_new_session_moves_patient_to_other_doctor(auth):
+    async def run():
+        await start_session(auth, "patient1", "doctorA")
+        await start_session(auth, "patient1", "doctorB")
+        assert not await live(auth, "doctorA")
+        assert await live(auth, "doctorB")
+
+    asyncio.run(run())
+
+def test_expired_session_does_not_count_for_its_old_doctor(auth):
+    async def run():
+        await start_session(auth, "patient1", "doctorA")
+        await start_session(auth, "patient2", "doctorA")
+        # patient1's session with doctorA expires while doctorA's index lives on
+        await auth.redis_client.delete("session:patient1")
+        await start_session(auth, "patient1", "doctorB")
+
+        assert await auth.redis_client.sismember(auth.doctor_sessions_key("doctorA"), "patient1")
+        assert await live(auth, "doctorA")  # patient2 is still with doctorA
+        await auth.end_session(auth.OTPRequest(user_id="patient2"))
+        assert not await live(auth, "doctorA")
+        assert await live(auth, "doctorB")
+        # The stale member is pruned on the way
+        assert not await auth.redis_client.sismember(auth.doctor_sessions_key("doctorA"), "patient1")
+
+    asyncio.run(run())
+
+def test_ended_session_is_gone(auth):
+    async def run():
+        await start_session(auth, "patient1", "doctorA")
+        await auth.end_session(auth.OTPRequest(user_id="patient1"))
+        assert not await live(auth, "doctorA")
+        with pytest.raises(HTTPException):
+            await auth.require_session("patient1", "doctorA")
+
+    asyncio.run(run())